@@ -1,13 +1,16 @@
 import logging
 import json
+import threading
 
 from enum import Enum
 from dataclasses import dataclass, asdict, field
-from typing import List, Dict, Set, Optional
+from types import MappingProxyType
+from typing import List, Dict, FrozenSet, Optional
 
-from .s3 import get_s3_object
+from .s3 import get_s3_object_if_modified
 from .session import s3
 from .env import AWSEnv
+from .lazy import LazyObject
 
 import dacite
 
@@ -55,45 +58,188 @@ class Conf:
 
 @dataclass(frozen=True)
 class FilterConf:
-    keywords: Set[str] = field(default_factory=set)
-    lang: Set[str] = field(default_factory=set)
+    keywords: FrozenSet[str] = field(default_factory=frozenset)
+    lang: FrozenSet[str] = field(default_factory=frozenset)
+
+
+class ConfigState:
+    """One loaded version of the project configs.
+
+    Lookups used per tweet are precomputed at load time:
+    ``slugs`` maps slug -> Conf, ``storage_modes`` maps
+    StorageMode -> tuple of Confs. Only ``etag`` and ``version_id`` are
+    updated after a state is built, by ``ConfigManager.reload`` when the
+    object was rewritten unchanged, so it can be shared between threads.
+    """
+    def __init__(self, raw, etag=None, version_id=None):
+        # Sort raw by slug
+        self.dict = sorted(raw, key=lambda conf: conf['slug'])
+        self.config = tuple(
+            dacite.from_dict(
+                data_class=Conf, data=conf,
+                config=dacite.Config(type_hooks=converter))
+            for conf in self.dict)
+        self.etag = etag
+        self.version_id = version_id
+
+        self.slugs = MappingProxyType(
+            {conf.slug: conf for conf in self.config})
+        self._covid = {
+            covid: tuple(conf for conf in self.config if conf.covid == covid)
+            for covid in (True, False)}
+        self.filter_config = FilterConf(
+            keywords=frozenset(
+                keyword for conf in self._covid[False]
+                for keyword in conf.keywords),
+            lang=frozenset(
+                lang for conf in self._covid[False] for lang in conf.lang))
+        self.storage_modes = MappingProxyType({
+            mode: tuple(
+                conf for conf in self.config if conf.storage_mode == mode)
+            for mode in StorageMode})
+
+    def covid(self, covid):
+        return self._covid[bool(covid)]
+
+    def get_conf_by_slug(self, slug):
+        return self.slugs.get(slug)
 
 
 class ConfigManager:
-    """Read, write and validate project configs."""
-    def __init__(self, s3_client=s3, version_id=None):
-        self.dict, self.config = self._load(s3_client, version_id)
+    """Read, write and validate project configs.
+
+    The current configs are held in ``state``. ``reload`` (or the polling
+    thread started by ``start_polling``) builds a new state off the
+    reading threads, runs the preparers (e.g. creating delivery streams
+    for new projects) and only then swaps it in with a single assignment.
+    Readers that need several lookups to be consistent should take
+    ``state`` once. A manager created with a ``state`` doesn't read S3,
+    its configs only change through ``apply``.
+    """
+    def __init__(self, s3_client=s3, version_id=None, state=None):
+        self.s3_client = s3_client
+        if state is None:
+            state = self._load(version_id=version_id)
+        self.state = state
+        self._preparers = []
+        self._listeners = []
+        self._poller = None
+        self._stopped = threading.Event()
+
+    @property
+    def dict(self):
+        return self.state.dict
+
+    @property
+    def config(self):
+        return self.state.config
+
+    @property
+    def slugs(self):
+        return self.state.slugs
+
+    @property
+    def storage_modes(self):
+        return self.state.storage_modes
 
     @property
     def filter_config(self):
         """Pools all filtering configs to run everything in a single stream."""
-        filter_conf = FilterConf()
-        for conf in self.config:
-            if not conf.covid:
-                filter_conf.keywords.update(conf.keywords)
-                filter_conf.lang.update(conf.lang)
-        return filter_conf
+        return self.state.filter_config
 
     def covid(self, covid):
-        return [conf for conf in self.config if conf.covid == covid]
+        return self.state.covid(covid)
 
     def get_conf_by_slug(self, slug):
-        for conf in self.config:
-            if conf.slug == slug:
-                return conf
-
-    def _load(self, s3_client, version_id):
-        raw = json.loads(get_s3_object(
+        return self.state.get_conf_by_slug(slug)
+
+    def add_preparer(self, preparer):
+        """Registers ``preparer(old_state, new_state)``, called from the
+        polling thread before a changed config is swapped in. If it raises,
+        the config isn't swapped in and the next reload tries again.
+        """
+        self._preparers.append(preparer)
+
+    def add_listener(self, listener):
+        """Registers ``listener(old_state, new_state)``, called from the
+        polling thread after a changed config has been swapped in.
+        """
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        try:
+            self._listeners.remove(listener)
+        except ValueError:
+            pass
+
+    def reload(self):
+        """Swaps in the latest config. Returns True if it changed."""
+        new = self._load(etag=self.state.etag)
+        if new is None:
+            return False
+        return self.apply(new)
+
+    def apply(self, new):
+        """Prepares and swaps in ``new`` if its configs differ from the
+        current ones. Returns True if it changed.
+        """
+        old = self.state
+        if new.config == old.config:
+            # Keeps the state, and what is derived from it (e.g. keyword
+            # matchers), only the object version is new
+            old.etag, old.version_id = new.etag, new.version_id
+            return False
+
+        logger.info(
+            'Loaded new stream config, version %s.', new.version_id)
+        for preparer in list(self._preparers):
+            try:
+                preparer(old, new)
+            except Exception as exc:
+                logger.error(
+                    'Not applying config version %s, preparation failed. '
+                    '%s: %s', new.version_id, type(exc).__name__, str(exc))
+                return False
+        self.state = new
+        for listener in list(self._listeners):
+            try:
+                listener(old, new)
+            except Exception as exc:
+                logger.error(
+                    'Config listener %s: %s', type(exc).__name__, str(exc))
+        return True
+
+    def start_polling(self, interval=AWSEnv.STREAM_CONFIG_POLL_INTERVAL):
+        """Checks for a new config every ``interval`` seconds in
+        a background thread. Unchanged configs cost a conditional GET.
+        """
+        if interval <= 0 or self._poller is not None:
+            return
+        self._poller = threading.Thread(
+            target=self._poll, args=(interval,), daemon=True)
+        self._poller.start()
+
+    def stop_polling(self):
+        self._stopped.set()
+
+    def _poll(self, interval):
+        while not self._stopped.wait(interval):
+            try:
+                self.reload()
+            except Exception as exc:
+                logger.error(
+                    'Config reload failed. %s: %s',
+                    type(exc).__name__, str(exc))
+
+    def _load(self, etag=None, version_id=None):
+        response = get_s3_object_if_modified(
             AWSEnv.BUCKET_NAME, AWSEnv.STREAM_CONFIG_S3_KEY,
-            s3_client, version_id))
-        # Sort raw by slug
-        raw = sorted(raw, key=lambda conf: conf['slug'])
-        config = []
-        for conf in raw:
-            config.append(dacite.from_dict(
-                data_class=Conf, data=conf,
-                config=dacite.Config(type_hooks=converter)))
-        return raw, config
+            etag, self.s3_client, version_id)
+        if response is None:
+            return
+        body, etag, version_id = response
+        return ConfigState(json.loads(body), etag, version_id)
 
 
-config_manager = ConfigManager()
+# Loads the config from S3 on first use
+config_manager = LazyObject(ConfigManager)
@@ -27,9 +27,6 @@ class Env(Constant):
     PROJECT_ROOT = os.path.abspath(os.path.join(APP_DIR, os.pardir))
     CONFIG_PATH = os.path.abspath(os.path.join(APP_DIR, 'config'))
 
-    # Other
-    NUM_WORKERS = os.environ.get('NUM_WORKERS', 4)
-
 
 class AWSEnv(Env):
     """AWS config (for storing in S3, accessing Elasticsearch)."""
@@ -48,6 +45,11 @@ class AWSEnv(Env):
         'AWS_STREAM_CONFIG_S3_KEY', 'configs/stream/stream.json')
     STREAM_STATE_S3_KEY = os.environ.get(
         'AWS_STREAM_STATE_S3_KEY', 'configs/stream/state.json')
+    # Seconds between checks for a new stream config, 0 disables hot reload
+    STREAM_CONFIG_POLL_INTERVAL = float(os.environ.get(
+        'AWS_STREAM_CONFIG_POLL_INTERVAL', '0'))
+    # Seconds small config objects are cached before being revalidated
+    CONFIG_CACHE_TTL = float(os.environ.get('AWS_CONFIG_CACHE_TTL', '300'))
     ENDPOINTS_PREFIX = os.environ.get(
         'ENDPOINTS_PREFIX', 'configs/models/')
     SAMPLES_PREFIX = os.environ.get(
@@ -72,6 +74,34 @@ class KFEnv(AWSEnv):
     BUFFER_INTERVAL = int(os.environ.get('AWS_KF_BUFFER_INTERVAL', '60'))
     UNMATCHED_STREAM_NAME = os.environ.get(
         'AWS_KF_UNMATCHED_STREAM_NAME', 'unmatched')
+    # PutRecordBatch limits: 500 records, 4 MiB per call
+    BATCH_MAX_RECORDS = min(
+        int(os.environ.get('AWS_KF_BATCH_MAX_RECORDS', '500')), 500)
+    BATCH_MAX_BYTES = min(
+        int(os.environ.get('AWS_KF_BATCH_MAX_BYTES', str(4 * 1024 * 1024))),
+        4 * 1024 * 1024)
+    BATCH_INTERVAL = float(os.environ.get('AWS_KF_BATCH_INTERVAL', '1'))
+    BATCH_MAX_RETRIES = int(os.environ.get('AWS_KF_BATCH_MAX_RETRIES', '5'))
+    # Full batches waiting for a sender, beyond that producers block
+    BATCH_MAX_PENDING = int(os.environ.get('AWS_KF_BATCH_MAX_PENDING', '20'))
+    # Concurrent PutRecordBatch calls per producer
+    SEND_CONCURRENCY = int(os.environ.get('AWS_KF_SEND_CONCURRENCY', '10'))
+    # Records that failed or found the sender saturated are spooled to disk
+    # and replayed. Off by default: SPOOL_DIR has to be on a mounted volume
+    # (e.g. EFS) that outlives the task for the spool to be durable
+    SPOOL_DIR = os.environ.get('AWS_KF_SPOOL_DIR', '')
+    SPOOL_SEGMENT_BYTES = int(os.environ.get(
+        'AWS_KF_SPOOL_SEGMENT_BYTES', str(64 * 1024 * 1024)))
+    SPOOL_FSYNC_RECORDS = int(os.environ.get(
+        'AWS_KF_SPOOL_FSYNC_RECORDS', '1000'))
+    SPOOL_FSYNC_INTERVAL = float(os.environ.get(
+        'AWS_KF_SPOOL_FSYNC_INTERVAL', '1'))
+    SPOOL_MMAP = int(os.environ.get('AWS_KF_SPOOL_MMAP', 'False') == 'True')
+    # Records per second and seconds between replays
+    SPOOL_REPLAY_RATE = float(os.environ.get(
+        'AWS_KF_SPOOL_REPLAY_RATE', '1000'))
+    SPOOL_REPLAY_INTERVAL = float(os.environ.get(
+        'AWS_KF_SPOOL_REPLAY_INTERVAL', '10'))
 
 
 class LEnv(AWSEnv):
@@ -97,6 +127,23 @@ class ESEnv(AWSEnv):
     DOMAIN = os.environ.get('ES_DOMAIN', Env.APP_NAME + '-' + Env.ENV)
     CONFIG_S3_KEY = os.environ.get(
         'ES_CONFIG_S3_KEY', 'configs/stream/elasticsearch.json')
+    # Bulk indexing
+    BULK_CHUNK_SIZE = int(os.environ.get('ES_BULK_CHUNK_SIZE', '500'))
+    BULK_MAX_CHUNK_BYTES = int(os.environ.get(
+        'ES_BULK_MAX_CHUNK_BYTES', str(10 * 1024 * 1024)))
+    # Retries of documents rejected with 429, with exponential backoff
+    BULK_MAX_RETRIES = int(os.environ.get('ES_BULK_MAX_RETRIES', '5'))
+    BULK_INITIAL_BACKOFF = float(
+        os.environ.get('ES_BULK_INITIAL_BACKOFF', '1'))
+    BULK_MAX_BACKOFF = float(os.environ.get('ES_BULK_MAX_BACKOFF', '60'))
+    # Statuses read from S3 and processed at a time
+    LOAD_CHUNK_SIZE = int(os.environ.get('ES_LOAD_CHUNK_SIZE', '2000'))
+    # Index built with awstools.geo, the geocode package is used if unset
+    GEO_INDEX_DIR = os.environ.get('ES_GEO_INDEX_DIR', '')
+    # Geocoded locations kept across invocations
+    GEO_CACHE_SIZE = int(os.environ.get('ES_GEO_CACHE_SIZE', '100000'))
+    # Geonames dump compiled into the Lambda layer on deployment
+    GEONAMES_PATH = os.environ.get('ES_GEONAMES_PATH', '')
 
 
 class ECSEnv(AWSEnv):
@@ -108,6 +155,16 @@ class ECSEnv(AWSEnv):
 class SMEnv(AWSEnv):
     BATCH_SIZE_DEFAULT = int(os.environ.get('BATCH_SIZE_DEFAULT', '1'))
     BATCH_SIZE_FASTTEXT = int(os.environ.get('BATCH_SIZE_FASTTEXT', '100'))
+    # Concurrent invocations in total and per endpoint
+    MAX_CONCURRENCY = int(os.environ.get('SM_MAX_CONCURRENCY', '16'))
+    ENDPOINT_CONCURRENCY = int(os.environ.get('SM_ENDPOINT_CONCURRENCY', '4'))
+    # Retries of failed batches, with exponential backoff
+    MAX_RETRIES = int(os.environ.get('SM_MAX_RETRIES', '3'))
+    INITIAL_BACKOFF = float(os.environ.get('SM_INITIAL_BACKOFF', '0.5'))
+    MAX_BACKOFF = float(os.environ.get('SM_MAX_BACKOFF', '10'))
+    # Larger batches are split, endpoints accept at most 6 MB
+    MAX_PAYLOAD_BYTES = int(os.environ.get(
+        'SM_MAX_PAYLOAD_BYTES', str(5 * 1024 * 1024)))
 
 
 class SagemakerTrainEnv(AWSEnv):
@@ -1,9 +1,20 @@
+import asyncio
 import logging
+import struct
+import threading
 import time
 import re
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from queue import Queue, Full
+
+from botocore.exceptions import BotoCoreError, ClientError
 
 from .env import KFEnv
+from .metrics import metrics
 from .session import iam, firehose
+from .spool import Spool, Replayer
 
 logger = logging.getLogger(__name__)
 
@@ -37,6 +48,7 @@ def get_policy_name_arn(slug):
     return policy_name, policy_arn
 
 
+@lru_cache(maxsize=None)
 def get_stream_name_arn(slug):
     slug = re.sub('[^a-zA-Z0-9_]+', '', slug)  # Only leave letters and numbers
     stream_name = f'{KFEnv.APP_NAME}-{slug}-{KFEnv.ENV}'
@@ -187,3 +199,413 @@ def create_delivery_stream(slug, prefix):
         )
 
     return
+
+
+# A single record can't be larger than 1000 KiB
+MAX_RECORD_BYTES = 1000 * 1024
+
+_STREAM_NAME_LENGTH = struct.Struct('<H')
+
+
+def pack_record(stream_name, data):
+    """Spool payload of a record for a delivery stream."""
+    stream_name = stream_name.encode('utf-8')
+    return _STREAM_NAME_LENGTH.pack(len(stream_name)) + stream_name + data
+
+
+def unpack_record(payload):
+    (length,) = _STREAM_NAME_LENGTH.unpack_from(payload)
+    start = _STREAM_NAME_LENGTH.size
+    return (
+        payload[start:start + length].decode('utf-8'),
+        payload[start + length:])
+
+
+def get_spool(directory=KFEnv.SPOOL_DIR):
+    if not directory:
+        return None
+    return Spool(
+        directory,
+        segment_bytes=KFEnv.SPOOL_SEGMENT_BYTES,
+        fsync_records=KFEnv.SPOOL_FSYNC_RECORDS,
+        fsync_interval=KFEnv.SPOOL_FSYNC_INTERVAL,
+        use_mmap=KFEnv.SPOOL_MMAP)
+
+
+class BatchProducer:
+    """Buffers records per delivery stream and sends them with
+    PutRecordBatch once a buffer is full or ``interval`` seconds passed.
+
+    Full batches are sent by ``num_senders`` background threads. At most
+    ``max_pending`` batches wait for them, beyond that ``put`` blocks, so
+    callers are slowed down when Firehose falls behind.
+
+    With a ``spool``, ``put`` spools batches instead of blocking, as do
+    records that still fail after the retries. They are replayed in the
+    background once Firehose recovers.
+    """
+    def __init__(
+            self, client=firehose,
+            max_records=KFEnv.BATCH_MAX_RECORDS,
+            max_bytes=KFEnv.BATCH_MAX_BYTES,
+            interval=KFEnv.BATCH_INTERVAL,
+            max_retries=KFEnv.BATCH_MAX_RETRIES,
+            num_senders=KFEnv.SEND_CONCURRENCY,
+            max_pending=KFEnv.BATCH_MAX_PENDING,
+            spool=None
+    ):
+        self.client = client
+        self.max_records = max_records
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self.max_retries = max_retries
+        self.num_senders = num_senders
+        self.set_spool(spool)
+        self._buffers = defaultdict(list)
+        self._sizes = defaultdict(int)
+        self._pending = Queue(maxsize=max_pending)
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._flusher = None
+        self._senders = []
+        self._adopted = []
+
+    def set_spool(self, spool):
+        """Replaces the spool, only before the first ``put``."""
+        self.spool = spool
+        self.replayer = None
+        if spool is not None:
+            self.replayer = Replayer(
+                spool, self._replay,
+                rate=KFEnv.SPOOL_REPLAY_RATE,
+                interval=KFEnv.SPOOL_REPLAY_INTERVAL,
+                batch_size=self.max_records)
+
+    def adopt_spool(self, spool):
+        """Also replays a spool that no producer writes to anymore, e.g.
+        one left behind by a worker process that no longer exists.
+        """
+        replayer = Replayer(
+            spool, self._replay,
+            rate=KFEnv.SPOOL_REPLAY_RATE,
+            interval=KFEnv.SPOOL_REPLAY_INTERVAL,
+            batch_size=self.max_records)
+        self._adopted.append(replayer)
+        replayer.start()
+
+    def put(self, stream_name, data):
+        """Adds a record to the buffer of a delivery stream."""
+        if len(data) > MAX_RECORD_BYTES:
+            logger.error(
+                'Record of %d bytes for stream %s exceeds the Firehose '
+                'record size limit. Dropping.', len(data), stream_name)
+            return
+        batches = []
+        with self._lock:
+            self._start_threads()
+            if self._sizes[stream_name] + len(data) > self.max_bytes:
+                batches.append(self._take(stream_name))
+            self._buffers[stream_name].append(data)
+            self._sizes[stream_name] += len(data)
+            if len(self._buffers[stream_name]) >= self.max_records:
+                batches.append(self._take(stream_name))
+        for batch in batches:
+            if batch:
+                self._enqueue(stream_name, batch)
+
+    def flush(self):
+        """Sends everything that is currently buffered and waits until
+        the senders are done.
+        """
+        self._flush_buffers()
+        self._pending.join()
+
+    def _flush_buffers(self):
+        """Hands everything that is currently buffered to the senders,
+        without waiting for them.
+        """
+        with self._lock:
+            batches = [
+                (stream_name, self._take(stream_name))
+                for stream_name in list(self._buffers)]
+        for stream_name, batch in batches:
+            if not batch:
+                continue
+            if self._senders:
+                self._pending.put((stream_name, batch))
+            else:
+                self.send(stream_name, batch)
+
+    def close(self):
+        """Stops the background threads and flushes the buffers."""
+        self._stopped.set()
+        if self._flusher is not None:
+            self._flusher.join()
+        if self.replayer is not None:
+            self.replayer.stop()
+        for replayer in self._adopted:
+            replayer.stop()
+            replayer.spool.close()
+        self._adopted = []
+        self.flush()
+        for _ in self._senders:
+            self._pending.put(None)
+        for sender in self._senders:
+            sender.join()
+        self._senders = []
+        if self.spool is not None:
+            self.spool.close()
+
+    def send(self, stream_name, records, spool=True):
+        """Sends records to a delivery stream in batches, retrying only the
+        records that failed. Returns the records that could not be sent,
+        which are spooled unless ``spool`` is False.
+        """
+        failed = []
+        while records:
+            batch, records = self.split_batch(records)
+            failed.extend(self._send_batch(stream_name, batch))
+        if failed:
+            self.give_up(stream_name, failed, spool)
+        return failed
+
+    def give_up(self, stream_name, failed, spool=True):
+        """Accounts for records that failed all retries."""
+        logger.error(
+            'Failed to send %d record(s) to stream %s after %d retries.',
+            len(failed), stream_name, self.max_retries)
+        metrics.counter(
+            'firehose_records_failed_total', stream=stream_name
+        ).inc(len(failed))
+        if spool:
+            self.spool_records(stream_name, failed)
+
+    def spool_records(self, stream_name, records):
+        """Writes records to the spool, returns False without one."""
+        if self.spool is None:
+            return False
+        self.spool.append([pack_record(stream_name, data) for data in records])
+        metrics.counter(
+            'firehose_records_spooled_total', stream=stream_name
+        ).inc(len(records))
+        logger.warning(
+            'Spooled %d record(s) for stream %s.', len(records), stream_name)
+        return True
+
+    def _replay(self, payloads):
+        records = defaultdict(list)
+        for payload in payloads:
+            stream_name, data = unpack_record(payload)
+            records[stream_name].append(data)
+        failed = []
+        for stream_name, data in records.items():
+            failed.extend(
+                pack_record(stream_name, record)
+                for record in self.send(stream_name, data, spool=False))
+        return failed
+
+    def _send_batch(self, stream_name, batch):
+        for attempt in range(self.max_retries + 1):
+            if attempt > 0:
+                time.sleep(self.backoff(attempt))
+            batch = self.put_batch(stream_name, batch, attempt)
+            if not batch:
+                return []
+        return batch
+
+    @staticmethod
+    def backoff(attempt):
+        return min(0.1 * 2 ** attempt, 10)
+
+    def put_batch(self, stream_name, batch, attempt=0):
+        """A single PutRecordBatch call. Returns the records that failed,
+        all of them if the call failed.
+        """
+        errors = metrics.counter(
+            'firehose_put_errors_total', stream=stream_name)
+        try:
+            with metrics.histogram('firehose_put_seconds').time():
+                response = self.client.put_record_batch(
+                    DeliveryStreamName=stream_name,
+                    Records=[{'Data': data} for data in batch])
+        except (BotoCoreError, ClientError) as exc:
+            errors.inc()
+            logger.warning(
+                'PutRecordBatch to stream %s failed, attempt %d. '
+                '%s: %s', stream_name, attempt + 1,
+                type(exc).__name__, str(exc))
+            return batch
+
+        metrics.counter('firehose_records_sent_total', stream=stream_name).inc(
+            len(batch) - response['FailedPutCount'])
+        if response['FailedPutCount'] == 0:
+            logger.debug(
+                'Pushed %d record(s) to stream %s.', len(batch), stream_name)
+            return []
+        errors.inc()
+        logger.warning(
+            '%d/%d record(s) failed for stream %s, attempt %d.',
+            response['FailedPutCount'], len(batch), stream_name, attempt + 1)
+        return [
+            data for data, result in zip(batch, response['RequestResponses'])
+            if 'ErrorCode' in result]
+
+    def split_batch(self, records):
+        """Splits off the records that fit in one PutRecordBatch call."""
+        size = 0
+        for i, data in enumerate(records[:self.max_records]):
+            size += len(data)
+            if size > self.max_bytes and i > 0:
+                return records[:i], records[i:]
+        return records[:self.max_records], records[self.max_records:]
+
+    def _enqueue(self, stream_name, batch):
+        try:
+            self._pending.put_nowait((stream_name, batch))
+        except Full:
+            # All senders are busy, spool rather than block if possible
+            if not self.spool_records(stream_name, batch):
+                self._pending.put((stream_name, batch))
+
+    def _take(self, stream_name):
+        batch = self._buffers.pop(stream_name, [])
+        self._sizes.pop(stream_name, None)
+        return batch
+
+    def _start_threads(self):
+        if self._flusher is None:
+            for _ in range(self.num_senders):
+                sender = threading.Thread(
+                    target=self._send_pending, daemon=True)
+                sender.start()
+                self._senders.append(sender)
+            self._flusher = threading.Thread(
+                target=self._flush_periodically, daemon=True)
+            self._flusher.start()
+            if self.replayer is not None:
+                # Also drains what a previous run left in the spool
+                self.replayer.start()
+
+    def _send_pending(self):
+        while True:
+            item = self._pending.get()
+            if item is None:
+                self._pending.task_done()
+                return
+            try:
+                self.send(*item)
+            except Exception as exc:
+                logger.error('%s: %s', type(exc).__name__, str(exc))
+            finally:
+                self._pending.task_done()
+
+    def _flush_periodically(self):
+        # Waiting for the senders would hold back the buffers of quiet
+        # streams while a busy one keeps them occupied
+        while not self._stopped.wait(self.interval):
+            try:
+                self._flush_buffers()
+            except Exception as exc:
+                logger.error('%s: %s', type(exc).__name__, str(exc))
+
+
+batch_producer = BatchProducer(spool=get_spool())
+
+
+class AsyncBatchProducer:
+    """asyncio counterpart of BatchProducer, to be used from a single event
+    loop. Full batches are sent by a pool of threads with the
+    producer's limits and retries, so the loop never waits for Firehose
+    and the threads don't wait out the backoff between retries.
+    At most ``concurrency`` batches are in flight, beyond that ``put``
+    waits for a send to finish, or the batch is spooled if the producer
+    has a spool. The producer's replayer is started on the first ``put``.
+    """
+    def __init__(
+            self, producer=batch_producer,
+            concurrency=KFEnv.SEND_CONCURRENCY
+    ):
+        self.producer = producer
+        self.concurrency = concurrency
+        self._buffers = defaultdict(list)
+        self._sizes = defaultdict(int)
+        self._executor = ThreadPoolExecutor(concurrency)
+        self._in_flight = set()
+        self._flusher = None
+
+    async def put(self, stream_name, data):
+        if len(data) > MAX_RECORD_BYTES:
+            logger.error(
+                'Record of %d bytes for stream %s exceeds the Firehose '
+                'record size limit. Dropping.', len(data), stream_name)
+            return
+        if self._flusher is None:
+            self._flusher = asyncio.ensure_future(self._flush_periodically())
+            if self.producer.replayer is not None:
+                # Replays what is spooled when saturated, and what
+                # a previous run left in the spool
+                self.producer.replayer.start()
+        if self._sizes[stream_name] + len(data) > self.producer.max_bytes:
+            await self._send(stream_name)
+        self._buffers[stream_name].append(data)
+        self._sizes[stream_name] += len(data)
+        if len(self._buffers[stream_name]) >= self.producer.max_records:
+            await self._send(stream_name)
+
+    async def flush(self):
+        for stream_name in list(self._buffers):
+            await self._send(stream_name)
+
+    async def close(self):
+        if self._flusher is not None:
+            self._flusher.cancel()
+        await self.flush()
+        if self._in_flight:
+            await asyncio.wait(self._in_flight)
+
+    async def _send(self, stream_name):
+        batch = self._buffers.pop(stream_name, [])
+        self._sizes.pop(stream_name, None)
+        if not batch:
+            return
+        if len(self._in_flight) >= self.concurrency and \
+                self.producer.spool_records(stream_name, batch):
+            return
+        while len(self._in_flight) >= self.concurrency:
+            await asyncio.wait(
+                self._in_flight, return_when=asyncio.FIRST_COMPLETED)
+        future = asyncio.ensure_future(self._send_records(stream_name, batch))
+        self._in_flight.add(future)
+        future.add_done_callback(self._done)
+
+    async def _send_records(self, stream_name, records):
+        """Only the PutRecordBatch calls run in the threads, the backoff
+        between retries is waited for on the loop.
+        """
+        loop = asyncio.get_running_loop()
+        producer = self.producer
+        failed = []
+        while records:
+            batch, records = producer.split_batch(records)
+            for attempt in range(producer.max_retries + 1):
+                if attempt > 0:
+                    await asyncio.sleep(producer.backoff(attempt))
+                batch = await loop.run_in_executor(
+                    self._executor, producer.put_batch, stream_name, batch,
+                    attempt)
+                if not batch:
+                    break
+            failed.extend(batch)
+        if failed:
+            producer.give_up(stream_name, failed)
+
+    def _done(self, future):
+        self._in_flight.discard(future)
+        if not future.cancelled() and future.exception() is not None:
+            exc = future.exception()
+            logger.error('%s: %s', type(exc).__name__, str(exc))
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.producer.interval)
+            await self.flush()
@@ -0,0 +1,393 @@
+"""
+Precompiled geocoding index
+===========================
+
+Compiles geonames data into flat files that are memory-mapped at query
+time, so loading is near instant and the pages are shared between
+processes.
+
+    python -m awstools.geo allCountries.txt layer/python/geoindex
+
+The places and names are those of ``geocode.Geocode``: features with
+fewer than 30000 inhabitants are dropped and each lowercased name is
+kept for one place only, chosen by ``PRIORITIES`` then population.
+
+Files in the index directory (integers are native-endian uint32):
+  places.dat   one fixed-size PLACE record per place
+  strings.*    official and matched place names, .idx holds n + 1
+               offsets into .dat
+  names.*      lowercased names sorted by their UTF-8 bytes, .ref holds
+               the place and the string of each name
+  grid.*       city places by 1x1 degree cell, .idx holds 180 * 360 + 1
+               offsets into .dat
+  meta.json    counts and byte order
+"""
+
+import argparse
+import json
+import logging
+import math
+import mmap
+import os
+import struct
+import sys
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from string import ascii_letters, digits
+
+from .env import Env
+
+logger = logging.getLogger(__name__)
+
+if Env.DEBUG == 1:
+    logger.setLevel(logging.DEBUG)
+else:
+    logger.setLevel(logging.INFO)
+
+# geoname_id, latitude, longitude, population, official name,
+# country code, location type
+PLACE = struct.Struct('=IffII2sBx')
+
+LOCATION_TYPES = [
+    'city', 'place', 'country', 'admin1', 'admin2', 'admin3', 'admin4',
+    'admin5', 'admin6', 'admin_other', 'continent', 'region']
+COUNTRY_CODES = {'PCL', 'PCLD', 'PCLF', 'PCLI', 'PCLIX', 'PCLS'}
+ADMIN_CODES = {'ADM%d' % level: 'admin%d' % level for level in range(1, 7)}
+# Which place keeps a name shared by several, cities above
+# LARGE_CITY_POPULATION rank as 'large_city'
+PRIORITIES = [
+    'large_city', 'admin1', 'country', 'city', 'place', 'admin2', 'admin3',
+    'admin4', 'admin5', 'admin6', 'admin_other', 'continent', 'region']
+MIN_POPULATION = 30000
+LARGE_CITY_POPULATION = 200000
+GRID_CELLS = 180 * 360
+
+# Characters names are matched within, as in flashtext
+WORD_CHARS = frozenset(ascii_letters + digits + '_')
+
+
+def location_type(feature_class, feature_code):
+    if feature_class == 'P':
+        return 'city'
+    if feature_class == 'A':
+        if feature_code in COUNTRY_CODES:
+            return 'country'
+        return ADMIN_CODES.get(feature_code, 'admin_other')
+    if feature_code == 'CONT':
+        return 'continent'
+    if feature_code == 'RGN':
+        return 'region'
+    return 'place'
+
+
+def priority(place):
+    loc_type = place['location_type']
+    if loc_type == 'city' and \
+            place['population'] > LARGE_CITY_POPULATION:
+        loc_type = 'large_city'
+    return PRIORITIES.index(loc_type)
+
+
+def read_geonames(path, min_population=MIN_POPULATION):
+    """Yields (place, names) of the features with at least
+    ``min_population`` inhabitants in a geonames TSV dump.
+    """
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            row = line.rstrip('\n').split('\t')
+            if len(row) < 15:
+                continue
+            population = int(row[14] or 0)
+            if population < min_population:
+                continue
+            names = {row[1], row[2]}
+            names.update(row[3].split(','))
+            yield {
+                'geoname_id': int(row[0]),
+                'latitude': float(row[4]),
+                'longitude': float(row[5]),
+                'population': min(population, 2**32 - 1),
+                'official_name': row[1],
+                'country_code': row[8][:2],
+                'location_type': location_type(row[6], row[7])
+            }, {name.strip() for name in names} - {''}
+
+
+def build_index(paths, directory, min_population=MIN_POPULATION):
+    """Compiles geonames TSV files into an index directory."""
+    os.makedirs(directory, exist_ok=True)
+    strings = []
+    # lowercased name -> (priority, -population, place, name)
+    names = {}
+    cells = [[] for _ in range(GRID_CELLS)]
+    places = 0
+    with open(os.path.join(directory, 'places.dat'), 'wb') as f:
+        for path in paths:
+            for place, place_names in read_geonames(path, min_population):
+                i = places
+                places += 1
+                strings.append(place['official_name'].encode('utf-8'))
+                f.write(PLACE.pack(
+                    place['geoname_id'], place['latitude'],
+                    place['longitude'], place['population'],
+                    len(strings) - 1,
+                    place['country_code'].encode('ascii', 'replace'),
+                    LOCATION_TYPES.index(place['location_type'])))
+                rank = (priority(place), -place['population'], i)
+                for name in place_names:
+                    key = name.lower()
+                    if key not in names or rank < names[key][:3]:
+                        names[key] = rank + (name,)
+                if place['location_type'] == 'city':
+                    cells[cell(
+                        place['latitude'], place['longitude'])].append(i)
+
+    keys = sorted(names, key=lambda key: key.encode('utf-8'))
+    refs = []
+    for key in keys:
+        *_, i, name = names[key]
+        refs.extend((i, len(strings)))
+        strings.append(name.encode('utf-8'))
+    _write_strings(directory, 'strings', strings)
+    _write_strings(directory, 'names', [key.encode('utf-8') for key in keys])
+    _write_array(directory, 'names.ref', refs)
+    grid = []
+    offsets = [0]
+    for cell_places in cells:
+        grid.extend(cell_places)
+        offsets.append(len(grid))
+    _write_array(directory, 'grid.idx', offsets)
+    _write_array(directory, 'grid.dat', grid)
+
+    meta = {
+        'places': places, 'names': len(keys),
+        'max_name_length': max(map(len, keys), default=0),
+        'byteorder': sys.byteorder, 'min_population': min_population}
+    with open(os.path.join(directory, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    logger.info(
+        'Built index of %d places and %d names in %s.',
+        meta['places'], meta['names'], directory)
+    return meta
+
+
+def _write_strings(directory, name, strings):
+    offsets = [0]
+    with open(os.path.join(directory, name + '.dat'), 'wb') as f:
+        for string in strings:
+            f.write(string)
+            offsets.append(offsets[-1] + len(string))
+    _write_array(directory, name + '.idx', offsets)
+
+
+def _write_array(directory, name, values):
+    with open(os.path.join(directory, name), 'wb') as f:
+        array('I', values).tofile(f)
+
+
+def cell(latitude, longitude):
+    row = min(max(int(math.floor(latitude)) + 90, 0), 179)
+    col = int(math.floor(longitude)) % 360
+    return row * 360 + col
+
+
+class _Strings:
+    """Sequence of the byte strings of a .idx/.dat pair."""
+    def __init__(self, offsets, data):
+        self.offsets = offsets
+        self.data = data
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.data[self.offsets[i]:self.offsets[i + 1]]
+
+
+class MappedGeocode:
+    """Geocoder querying an index built by ``build_index``.
+
+    ``decode`` gives the results of ``geocode.Geocode.decode`` for the
+    same geonames data.
+    """
+    def __init__(self, directory):
+        with open(os.path.join(directory, 'meta.json')) as f:
+            meta = json.load(f)
+        if meta['byteorder'] != sys.byteorder:
+            raise ValueError(
+                f"Index built for {meta['byteorder']}-endian machines.")
+        self.directory = directory
+        self.max_name_length = meta['max_name_length']
+        self._maps = []
+        self._views = []
+        self.places = self._map('places.dat')
+        self.strings = _Strings(
+            self._map_array('strings.idx'), self._map('strings.dat'))
+        self.names = _Strings(
+            self._map_array('names.idx'), self._map('names.dat'))
+        self.name_refs = self._map_array('names.ref')
+        self.grid_offsets = self._map_array('grid.idx')
+        self.grid = self._map_array('grid.dat')
+
+    def load(self):
+        """Nothing to load, kept for compatibility with Geocode."""
+
+    def _map(self, name):
+        with open(os.path.join(self.directory, name), 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return b''
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._maps.append(mapped)
+        return mapped
+
+    def _map_array(self, name):
+        data = self._map(name)
+        if not data:
+            return []
+        view = memoryview(data).cast('I')
+        self._views.append(view)
+        return view
+
+    def place(self, i, name=None):
+        (
+            geoname_id, latitude, longitude, population, name_ref,
+            country_code, loc_type
+        ) = PLACE.unpack_from(self.places, i * PLACE.size)
+        official_name = self.strings[name_ref].decode('utf-8')
+        return {
+            'name': official_name if name is None else name,
+            'official_name': official_name,
+            'country_code': country_code.decode('ascii'),
+            'longitude': round(longitude, 5),
+            'latitude': round(latitude, 5),
+            'geoname_id': str(geoname_id),
+            'location_type': LOCATION_TYPES[loc_type],
+            'population': population
+        }
+
+    def lookup(self, name):
+        """Place called ``name`` and its name as spelled in geonames, or
+        None if there isn't any.
+        """
+        key = name.lower().encode('utf-8')
+        k = bisect_left(self.names, key)
+        if k == len(self.names) or self.names[k] != key:
+            return None
+        i, name_ref = self.name_refs[2 * k:2 * k + 2]
+        return i, self.strings[name_ref].decode('utf-8')
+
+    def decode(self, input_string):
+        """Places named in a free text location, in order of appearance.
+
+        Names are matched as flashtext does: case-insensitively, the
+        longest one first, starting and ending next to characters other
+        than ASCII letters, digits and underscores.
+        """
+        text = input_string.lower()
+        # Positions a name can start at, and end at
+        bounds = [
+            k for k, char in enumerate(text) if char not in WORD_CHARS]
+        starts = [0] + [k + 1 for k in bounds]
+        ends = bounds + [len(text)]
+        matches = []
+        matched_end = -1
+        for start in starts:
+            if start <= matched_end:
+                continue
+            for end in reversed(ends[bisect_left(ends, start + 1):bisect_left(
+                    ends, start + self.max_name_length + 1)]):
+                found = self.lookup(text[start:end])
+                if found is not None:
+                    matches.append(self.place(*found))
+                    matched_end = end
+                    break
+        return matches
+
+    def nearest(self, latitude, longitude):
+        """Nearest city to a coordinate, looking in the surrounding 3x3
+        degree cells. Returns None if there isn't any.
+        """
+        row = int(math.floor(latitude)) + 90
+        col = int(math.floor(longitude))
+        best, best_distance = None, None
+        for r in range(max(row - 1, 0), min(row + 2, 180)):
+            for c in range(col - 1, col + 2):
+                k = r * 360 + c % 360
+                for j in range(self.grid_offsets[k], self.grid_offsets[k + 1]):
+                    i = self.grid[j]
+                    _, lat, lon = PLACE.unpack_from(
+                        self.places, i * PLACE.size)[:3]
+                    dlon = (lon - longitude + 180) % 360 - 180
+                    distance = (lat - latitude) ** 2 + (
+                        dlon * math.cos(math.radians(latitude))) ** 2
+                    if best_distance is None or distance < best_distance:
+                        best, best_distance = i, distance
+        return None if best is None else self.place(best)
+
+    def close(self):
+        for view in self._views:
+            view.release()
+        self._views = []
+        for mapped in self._maps:
+            mapped.close()
+        self._maps = []
+
+
+class CachedGeocode:
+    """LRU cache in front of a geocoder.
+
+    ``decode`` results are cached by location string, lowercased and
+    stripped, which doesn't change what the geocoder matches. Callers get
+    copies of the cached places. Hits and misses are counted until the
+    next ``log_stats``.
+    """
+    def __init__(self, geo_code, maxsize=100000):
+        self.geo_code = geo_code
+        self.maxsize = maxsize
+        self._cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def decode(self, input_string):
+        key = input_string.lower().strip()
+        try:
+            places = self._cache[key]
+        except KeyError:
+            self.misses += 1
+            places = self.geo_code.decode(input_string)
+            self._cache[key] = places
+            if len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+        else:
+            self.hits += 1
+            self._cache.move_to_end(key)
+        return [dict(place) for place in places]
+
+    def log_stats(self):
+        lookups = self.hits + self.misses
+        logger.info(
+            'Geocoding cache: %d/%d hits (%.1f%%), %d entries.',
+            self.hits, lookups, 100 * self.hits / lookups if lookups else 0,
+            len(self._cache))
+        self.hits = 0
+        self.misses = 0
+
+    def __getattr__(self, name):
+        return getattr(self.geo_code, name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('geonames', nargs='+', help='geonames TSV dumps')
+    parser.add_argument('directory', help='index directory to write')
+    parser.add_argument(
+        '--min-population', type=int, default=MIN_POPULATION,
+        help='smallest population of the places to keep')
+    args = parser.parse_args()
+
+    build_index(args.geonames, args.directory, args.min_population)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+"""
+Reports the modules that take the most time to import.
+
+    python -m awstools.importtime awstools.s3_to_es --top 20
+
+Runs ``python -X importtime -c 'import <module>'`` in a fresh interpreter
+and sorts its report by cumulative time.
+"""
+
+import argparse
+import subprocess
+import sys
+
+
+def profile(module):
+    """Returns a list of (self_us, cumulative_us, module) tuples."""
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        stderr=subprocess.PIPE, universal_newlines=True)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.splitlines()[-1])
+
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split(
+            '|', 2)
+        imports.append((int(self_us), int(cumulative_us), name.rstrip()))
+    return imports
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('module', nargs='+', help='modules to import')
+    parser.add_argument(
+        '--top', type=int, default=20, help='number of imports to show')
+    args = parser.parse_args()
+
+    for module in args.module:
+        imports = profile(module)
+        total = max(cumulative for _, cumulative, _ in imports)
+        print(f'{module}: {total / 1000:.1f} ms')
+        print(f'{"self [ms]":>10} {"cumulative [ms]":>16}  module')
+        for self_us, cumulative_us, name in sorted(
+                imports, key=lambda x: x[1], reverse=True)[:args.top]:
+            print(
+                f'{self_us / 1000:>10.1f} {cumulative_us / 1000:>16.1f}  '
+                f'{name}')
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+import threading
+
+
+class LazyObject:
+    """Proxy that builds the wrapped object on first attribute access.
+
+    Module-level clients and managers are wrapped so that importing a
+    module doesn't pay for objects the caller never uses.
+    """
+    def __init__(self, factory):
+        self.__dict__['_factory'] = factory
+        self.__dict__['_wrapped'] = None
+        self.__dict__['_lock'] = threading.Lock()
+
+    def _setup(self):
+        with self._lock:
+            if self._wrapped is None:
+                self.__dict__['_wrapped'] = self._factory()
+        return self._wrapped
+
+    def set(self, wrapped):
+        """Uses ``wrapped`` instead of building the object."""
+        with self._lock:
+            self.__dict__['_wrapped'] = wrapped
+
+    @property
+    def initialized(self):
+        return self._wrapped is not None
+
+    def __getattr__(self, name):
+        wrapped = self._wrapped
+        if wrapped is None:
+            wrapped = self._setup()
+        return getattr(wrapped, name)
+
+    def __setattr__(self, name, value):
+        wrapped = self._wrapped
+        if wrapped is None:
+            wrapped = self._setup()
+        setattr(wrapped, name, value)
+
+    def __repr__(self):
+        if self._wrapped is None:
+            return f'<LazyObject {self._factory!r}>'
+        return repr(self._wrapped)
@@ -0,0 +1,258 @@
+"""
+In-process metrics: counters, gauges and fixed-bucket histograms.
+
+    from awstools.metrics import metrics
+
+    metrics.counter('tweets_received_total', version='v1').inc()
+    metrics.histogram('match_seconds').observe(elapsed)
+
+``start_http_server`` serves all metrics in the Prometheus text format on
+``/metrics``, ``start_reporting`` logs a summary every interval.
+"""
+
+import logging
+import threading
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .env import Env
+
+logger = logging.getLogger(__name__)
+
+if Env.DEBUG == 1:
+    logger.setLevel(logging.DEBUG)
+else:
+    logger.setLevel(logging.INFO)
+
+# Seconds
+LATENCY_BUCKETS = (
+    .0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5,
+    1., 2.5, 5., 10.)
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, n=1):
+        with self._lock:
+            self.value += n
+
+
+class Gauge:
+    """Either set explicitly or read from ``func`` when collected."""
+    kind = 'gauge'
+
+    def __init__(self, func=None):
+        self.func = func
+        self._value = 0
+
+    def set(self, value):
+        self._value = value
+
+    @property
+    def value(self):
+        return self.func() if self.func is not None else self._value
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def time(self):
+        return _Timer(self)
+
+    def quantile(self, q, counts=None):
+        """Upper bound of the bucket holding the q-quantile."""
+        counts = counts or self.counts
+        total = sum(counts)
+        if total == 0:
+            return 0.
+        seen = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            seen += count
+            if seen >= q * total:
+                return bound
+        return float('inf')
+
+
+class _Timer:
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *args):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+        self._server = None
+        self._reporter = None
+
+    def counter(self, name, **labels):
+        return self._get(Counter, name, labels)
+
+    def gauge(self, name, func=None, **labels):
+        gauge = self._get(Gauge, name, labels)
+        if func is not None:
+            gauge.func = func
+        return gauge
+
+    def histogram(self, name, buckets=LATENCY_BUCKETS, **labels):
+        return self._get(Histogram, name, labels, buckets)
+
+    def _get(self, cls, name, labels, *args):
+        key = (name, tuple(sorted(labels.items())))
+        metric = self._metrics.get(key)
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.get(key)
+                if metric is None:
+                    metric = self._metrics[key] = cls(*args)
+        if not isinstance(metric, cls):
+            raise TypeError(f'{name} is a {metric.kind}.')
+        return metric
+
+    def collect(self):
+        """Sorted list of (name, labels, metric)."""
+        with self._lock:
+            items = list(self._metrics.items())
+        return [(name, labels, metric) for (name, labels), metric in sorted(
+            items, key=lambda item: item[0])]
+
+    def render(self):
+        """All metrics in the Prometheus text format."""
+        lines = []
+        kinds = {}
+        for name, labels, metric in self.collect():
+            if name not in kinds:
+                kinds[name] = metric.kind
+                lines.append(f'# TYPE {name} {metric.kind}')
+            if metric.kind != 'histogram':
+                lines.append(
+                    f'{name}{_format_labels(labels)} {metric.value}')
+                continue
+            cumulative = 0
+            for bound, count in zip(
+                    metric.buckets + (float('inf'),), list(metric.counts)):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(
+                    f'{name}_bucket'
+                    f'{_format_labels(labels + (("le", le),))} {cumulative}')
+            lines.append(f'{name}_sum{_format_labels(labels)} {metric.sum}')
+            lines.append(
+                f'{name}_count{_format_labels(labels)} {metric.count}')
+        return '\n'.join(lines) + '\n'
+
+    def start_http_server(self, port, host='0.0.0.0'):
+        """Serves the metrics on http://host:port/metrics."""
+        if self._server is not None:
+            return
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header(
+                    'Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(
+            target=self._server.serve_forever, daemon=True).start()
+        logger.info('Serving metrics on port %d.', port)
+
+    def start_reporting(self, interval):
+        """Logs a summary every ``interval`` seconds."""
+        if self._reporter is not None:
+            return
+        self._reporter = threading.Thread(
+            target=self._report_periodically, args=(interval,), daemon=True)
+        self._reporter.start()
+
+    def _report_periodically(self, interval):
+        previous = {}
+        last = time.time()
+        while True:
+            time.sleep(interval)
+            now = time.time()
+            previous = self.report(previous, now - last)
+            last = now
+
+    def report(self, previous, elapsed):
+        """Logs rates and latencies since ``previous``, the snapshot
+        returned by the last call.
+        """
+        snapshot = {}
+        lines = []
+        for name, labels, metric in self.collect():
+            key = name + _format_labels(labels)
+            if metric.kind == 'counter':
+                value = metric.value
+                snapshot[key] = value
+                lines.append('%s %d (%.1f/s)' % (
+                    key, value, (value - previous.get(key, 0)) / elapsed))
+            elif metric.kind == 'gauge':
+                lines.append(f'{key} {metric.value}')
+            else:
+                counts = list(metric.counts)
+                snapshot[key] = counts
+                delta = [
+                    count - before for count, before in zip(
+                        counts, previous.get(key, [0] * len(counts)))]
+                if sum(delta):
+                    lines.append('%s n=%d p50<=%gs p99<=%gs' % (
+                        key, sum(delta), metric.quantile(.5, delta),
+                        metric.quantile(.99, delta)))
+        if lines:
+            logger.info('Metrics:\n%s', '\n'.join(lines))
+        return snapshot
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        '%s="%s"' % (key, _escape(str(value)))
+        for key, value in labels) + '}'
+
+
+def _escape(value):
+    """Escapes a label value as the Prometheus text format requires."""
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n')
+
+
+metrics = Registry()
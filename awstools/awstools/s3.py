@@ -1,9 +1,12 @@
 import logging
+import json
+import time
+import zlib
 
 from botocore.exceptions import ClientError
 
 from .session import s3
-from .env import Env
+from .env import Env, AWSEnv
 
 logger = logging.getLogger(__name__)
 
@@ -55,3 +58,146 @@ def get_s3_object(bucket, key, s3_client=s3, version_id=None):
     response = s3_client.get_object(**params)
 
     return response['Body'].read().decode('utf-8')
+
+
+def get_s3_object_if_modified(
+        bucket, key, etag=None, s3_client=s3, version_id=None):
+    """Conditional GET. Returns (body, etag, version_id) of an S3 object
+    or None if its ETag still matches ``etag``.
+    """
+    params = {'Bucket': bucket, 'Key': key}
+    if version_id:
+        params['VersionId'] = version_id
+    if etag:
+        params['IfNoneMatch'] = etag
+    try:
+        response = s3_client.get_object(**params)
+    except ClientError as exc:
+        if exc.response['Error']['Code'] in ['304', 'NotModified']:
+            return None
+        raise exc
+
+    return (
+        response['Body'].read().decode('utf-8'),
+        response.get('ETag'), response.get('VersionId'))
+
+
+class S3ConfigCache:
+    """Parsed JSON config objects, kept across warm Lambda invocations.
+
+    An entry is served from memory for ``ttl`` seconds, then revalidated
+    with a conditional GET. An entry checked since the last ``begin()``
+    is never checked again, so each object is fetched at most once per
+    invocation. If revalidating fails, the cached value is served until
+    the next attempt succeeds, errors are only raised for objects that
+    were never fetched.
+    """
+    def __init__(self, ttl=AWSEnv.CONFIG_CACHE_TTL, s3_client=s3):
+        self.ttl = ttl
+        self.s3_client = s3_client
+        self._entries = {}
+        self._invocation_start = None
+
+    def begin(self):
+        """Marks the start of an invocation."""
+        self._invocation_start = time.time()
+
+    def get(self, bucket, key):
+        entry = self._entries.get((bucket, key))
+        now = time.time()
+        if entry is not None:
+            value, etag, checked_at = entry
+            if now - checked_at < self.ttl or (
+                    self._invocation_start is not None and
+                    checked_at >= self._invocation_start):
+                return value
+        else:
+            value, etag = None, None
+
+        try:
+            response = get_s3_object_if_modified(
+                bucket, key, etag=etag, s3_client=self.s3_client)
+        except Exception as exc:
+            if entry is None:
+                raise
+            logger.warning(
+                'Serving the cached %s, revalidating failed. %s: %s',
+                key, type(exc).__name__, str(exc))
+            return value
+        if response is None:
+            logger.debug('Not modified: %s.', key)
+        else:
+            logger.debug('Fetched: %s.', key)
+            value, etag = json.loads(response[0]), response[1]
+        self._entries[bucket, key] = (value, etag, now)
+        return value
+
+    def clear(self):
+        self._entries.clear()
+
+
+config_cache = S3ConfigCache()
+
+
+def iter_s3_jsonl(
+        bucket, key, chunk_size=1000, s3_client=s3, read_size=1024 * 1024):
+    """Streams a JSONL object, gzipped or not, with a plain GET.
+    Yields lists of at most ``chunk_size`` parsed records while the object
+    is still being downloaded.
+    """
+    try:
+        response = s3_client.get_object(Bucket=bucket, Key=key)
+    except ClientError as exc:
+        if exc.response['Error']['Code'] == 'NoSuchKey':
+            logger.error(
+                '%s: %s Key: %s',
+                exc.response['Error']['Code'],
+                exc.response['Error']['Message'],
+                key)
+            return
+        raise exc
+
+    records = []
+    pending = b''
+    for data in _decompress(response['Body'].iter_chunks(read_size)):
+        lines = (pending + data).split(b'\n')
+        pending = lines.pop()
+        for line in lines:
+            _parse_jsonl(line, records)
+            if len(records) >= chunk_size:
+                yield records
+                records = []
+    _parse_jsonl(pending, records)
+    if records:
+        yield records
+
+
+def _decompress(chunks):
+    """Decompresses gzip data incrementally, passes anything else through.
+    Handles concatenated gzip members.
+    """
+    decompressor = None
+    for i, chunk in enumerate(chunks):
+        if i == 0 and chunk[:2] == b'\x1f\x8b':
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        if decompressor is None:
+            yield chunk
+            continue
+        while chunk:
+            yield decompressor.decompress(chunk)
+            chunk = decompressor.unused_data if decompressor.eof else b''
+            if decompressor.eof:
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if decompressor is not None:
+        yield decompressor.flush()
+
+
+def _parse_jsonl(line, records):
+    line = line.strip()
+    if not line:
+        return
+    try:
+        records.append(json.loads(line))
+    except json.JSONDecodeError as exc:
+        logger.error('%s: %s', type(exc).__name__, str(exc))
+        logger.error('JSONL:\n%s', line.decode('utf-8', 'replace'))
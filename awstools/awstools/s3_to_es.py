@@ -1,28 +1,60 @@
+import hashlib
 import logging
 import json
 # import re
 import os
-from copy import deepcopy
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from importlib import import_module
+from itertools import zip_longest
 
-from elasticsearch import ConflictError, ElasticsearchException, RequestError
-# from elasticsearch.helpers import bulk
-from geocode.geocode import Geocode
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
 
-import twiprocess as twp
-from twiprocess.processtweet import ProcessTweet
 from awstools.env import ESEnv, SMEnv
-from awstools.session import session, es
-from awstools.s3 import get_long_s3_object
+from awstools.session import client, es
+from awstools.s3 import config_cache
+from awstools.lazy import LazyObject
+from awstools.geo import CachedGeocode, MappedGeocode
 
 DEFAULT_STANDARDIZE_FUNC_NAME = 'standardize_anonymize'
+RETRYABLE_ERROR_CODES = {
+    'ThrottlingException', 'ModelNotReadyException',
+    'ServiceUnavailable', 'InternalFailure'}
+TOO_LARGE_ERROR_CODES = {
+    'RequestEntityTooLarge', 'RequestEntityTooLargeException',
+    'PayloadTooLarge'}
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
-geo_code = Geocode()
-geo_code.load()
 
-sagemaker = session.client('sagemaker-runtime')
+def load_geocode():
+    if ESEnv.GEO_INDEX_DIR:
+        return MappedGeocode(ESEnv.GEO_INDEX_DIR)
+
+    from geocode.geocode import Geocode
+
+    geo_code = Geocode()
+    geo_code.load()
+    return geo_code
+
+
+# Loaded on first use, the geocoding data takes a while to read.
+# The cache lives as long as the Lambda container.
+geo_code = CachedGeocode(
+    LazyObject(load_geocode), maxsize=ESEnv.GEO_CACHE_SIZE)
+
+sagemaker = LazyObject(lambda: client(
+    'sagemaker-runtime',
+    config=Config(max_pool_connections=SMEnv.MAX_CONCURRENCY)))
+
+_executor = ThreadPoolExecutor(SMEnv.MAX_CONCURRENCY)
+_endpoint_slots = defaultdict(
+    lambda: threading.BoundedSemaphore(SMEnv.ENDPOINT_CONCURRENCY))
 
 
 def get_batch_size(model_type):
@@ -56,112 +88,346 @@ def labels_to_int(labels):
     return label_vals
 
 
-def preprocess(preprocessing_config, texts):
-    # Preprocess data
+@lru_cache(maxsize=None)
+def get_standardize_func(standardize_func_name):
+    return getattr(
+        import_module('twiprocess.standardize'), standardize_func_name)
+
+
+def config_key(preprocessing_config):
+    """Hash of the canonical JSON form of a preprocessing config."""
+    return hashlib.sha1(json.dumps(
+        preprocessing_config, sort_keys=True, separators=(',', ':')
+    ).encode()).hexdigest()
+
+
+def get_run_config(endpoint_name):
+    """Run config of an endpoint, cached across invocations. A cached
+    config is kept if S3 fails, an empty one is used if none was ever
+    fetched.
+    """
+    key = os.path.join(ESEnv.ENDPOINTS_PREFIX, endpoint_name + '.json')
+    logger.debug(f'Key: {key}')
     try:
-        standardize_func_name = preprocessing_config['standardize_func_name']
-        del preprocessing_config['standardize_func_name']
-    except KeyError:
-        standardize_func_name = DEFAULT_STANDARDIZE_FUNC_NAME
+        return config_cache.get(ESEnv.BUCKET_NAME, key)
+    except Exception as exc:
+        logger.error(
+            'No run config for endpoint %s, not preprocessing. %s: %s',
+            endpoint_name, type(exc).__name__, str(exc))
+        return {'preprocess': {}}
+
+
+def preprocess(preprocessing_config, texts):
+    # Preprocess data, leaving the caller's config untouched
+    preprocessing_config = dict(preprocessing_config)
+    standardize_func_name = preprocessing_config.pop(
+        'standardize_func_name', DEFAULT_STANDARDIZE_FUNC_NAME)
     if standardize_func_name is not None:
         logger.debug('Standardizing data...')
-        standardize_func = getattr(
-            __import__(
-                'twiprocess.standardize',
-                fromlist=[standardize_func_name]),
-            standardize_func_name)
+        standardize_func = get_standardize_func(standardize_func_name)
         texts = [standardize_func(text) for text in texts]
     if preprocessing_config != {}:
+        import twiprocess as twp
+
         logger.debug('Preprocessing data...')
         texts = [
             twp.preprocess(text, **preprocessing_config) for text in texts]
     return texts
 
 
-def predict(endpoint_name, preprocessing_config, texts, batch_size):
-    """Runs prediction in batches."""
-    outputs = []
-    for i in range(0, len(texts), batch_size):
-        logger.debug('Batch %d', i)
-        batch = preprocess(preprocessing_config, texts[i:i + batch_size])
-        logger.debug('Batch:\n%s', batch)
+def invoke_endpoint(endpoint_name, batch):
+    """Predicts a single preprocessed batch.
 
+    Failed requests are retried with exponential backoff, batches too
+    large for the endpoint are split in halves. Returns None in place of
+    the outputs that couldn't be predicted.
+    """
+    logger.debug('Batch:\n%s', batch)
+    body = json.dumps({'text': batch})
+    if len(body) > SMEnv.MAX_PAYLOAD_BYTES and len(batch) > 1:
+        return split_batch(endpoint_name, batch)
+
+    backoff = SMEnv.INITIAL_BACKOFF
+    for attempt in range(SMEnv.MAX_RETRIES + 1):
+        if attempt > 0:
+            time.sleep(backoff)
+            backoff = min(backoff * 2, SMEnv.MAX_BACKOFF)
         try:
-            response = sagemaker.invoke_endpoint(
-                EndpointName=endpoint_name,
-                Body=json.dumps({'text': batch}),
-                ContentType='application/json'
-            )
-        except sagemaker.exceptions.ModelError as exc:
-            logger.error('%s: %s', type(exc).__name__, str(exc))
-            outputs.extend([None] * batch_size)
-        finally:
-            predictions = json.loads(
-                response['Body'].read().decode('utf-8')
-            )['predictions']
-            outputs.extend([{
+            with _endpoint_slots[endpoint_name]:
+                response = sagemaker.invoke_endpoint(
+                    EndpointName=endpoint_name,
+                    Body=body,
+                    ContentType='application/json'
+                )
+                predictions = json.loads(
+                    response['Body'].read().decode('utf-8')
+                )['predictions']
+        except (BotoCoreError, ClientError) as exc:
+            if is_too_large(exc) and len(batch) > 1:
+                return split_batch(endpoint_name, batch)
+            logger.warning(
+                'Endpoint %s, attempt %d: %s: %s', endpoint_name,
+                attempt + 1, type(exc).__name__, str(exc))
+            if not is_retryable(exc):
+                break
+            continue
+        except (ValueError, KeyError) as exc:
+            logger.warning(
+                'Endpoint %s, attempt %d: invalid response, %s: %s',
+                endpoint_name, attempt + 1, type(exc).__name__, str(exc))
+            continue
+
+        if len(predictions) == len(batch):
+            return [{
                 'labels': pred['labels'],
                 'probabilities': pred['probabilities']
-            } for pred in predictions])
+            } for pred in predictions]
+        logger.warning(
+            'Endpoint %s, attempt %d: %d predictions for %d texts.',
+            endpoint_name, attempt + 1, len(predictions), len(batch))
+
+    logger.error(
+        'Endpoint %s: no predictions for %d text(s).',
+        endpoint_name, len(batch))
+    return [None] * len(batch)
 
-    label_valss = [labels_to_int(output['labels']) for output in outputs]
-    if all(label_valss):
-        outputs = [{
-            'label_vals': label_vals, **output
-        } for output, label_vals in zip(outputs, label_valss)]
 
-    return outputs
+def split_batch(endpoint_name, batch):
+    half = len(batch) // 2
+    logger.info(
+        'Endpoint %s: splitting a batch of %d.', endpoint_name, len(batch))
+    return (
+        invoke_endpoint(endpoint_name, batch[:half]) +
+        invoke_endpoint(endpoint_name, batch[half:]))
 
 
-def create_doc(
-        status_id, status_es, index_name, loads, errors, request_errors):
-    try:
-        es.create(
-            index=index_name, id=status_id,
-            body=json.dumps(status_es), doc_type='_doc')
-        logger.debug('Loaded status with id %s.', status_id)
-        loads += 1
-    except ConflictError as exc:
-        # Happens when a document with the same ID
-        # already exists.
-        errors += 1
-        logger.warning(
-            'Status with id %s already exists.', status_id)
-        # logger.error('%s: %s', type(exc).__name__, str(exc))
-    except RequestError as exc:
-        errors += 1
-        request_errors += 1
-        if request_errors < 5:
-            # logger.error(json.dumps(status_es))
-            # logger.error(type(status_es['geo_info']['country_code']))
-            logger.error(
-                '%s: %s. Retrying...', type(exc).__name__, str(exc))
-            _ = create_doc(
-                status_id, status_es, index_name,
-                loads, errors, request_errors)
-        else:
-            request_errors = 0
-    except ElasticsearchException as exc:
-        errors += 1
-        logger.error('%s: %s', type(exc).__name__, str(exc))
-    return loads, errors
+def _status_codes(exc):
+    if not isinstance(exc, ClientError):
+        return None, None
+    return (
+        exc.response.get('ResponseMetadata', {}).get('HTTPStatusCode'),
+        exc.response.get('OriginalStatusCode'))
+
+
+def is_too_large(exc):
+    if not isinstance(exc, ClientError):
+        return False
+    return exc.response['Error'].get('Code') in TOO_LARGE_ERROR_CODES or \
+        413 in _status_codes(exc)
+
+
+def is_retryable(exc):
+    if isinstance(exc, BotoCoreError):
+        # Connection errors and timeouts
+        return True
+    status_code, original_status_code = _status_codes(exc)
+    return exc.response['Error'].get('Code') in RETRYABLE_ERROR_CODES or \
+        any(code is not None and (code == 429 or code >= 500)
+            for code in (status_code, original_status_code))
+
+
+def predict_all(jobs, texts):
+    """Runs prediction for several endpoints concurrently.
+
+    ``jobs`` is a list of (endpoint_name, preprocessing_config, batch_size).
+    All (endpoint, batch) requests go to a thread pool at once, with at most
+    SMEnv.ENDPOINT_CONCURRENCY requests in flight per endpoint.
+    Returns the outputs of each job, in order.
+    """
+    # Each distinct preprocessing config runs once over all texts
+    preprocessed = {}
+    keys = []
+    for endpoint_name, preprocessing_config, _ in jobs:
+        # Create the semaphores before the threads use them
+        _endpoint_slots[endpoint_name]
+        key = config_key(preprocessing_config)
+        if key not in preprocessed:
+            preprocessed[key] = preprocess(preprocessing_config, texts)
+        keys.append(key)
+    logger.debug(
+        '%d distinct preprocessing config(s) for %d endpoint(s).',
+        len(preprocessed), len(jobs))
+
+    starts = [range(0, len(texts), batch_size) for _, _, batch_size in jobs]
+    # Interleave the endpoints, so that the pool isn't filled with
+    # batches waiting for the slots of a single endpoint
+    futures = {}
+    for batches in zip_longest(*[
+            [(i, start) for start in job_starts]
+            for i, job_starts in enumerate(starts)]):
+        for i, start in filter(None, batches):
+            endpoint_name, _, batch_size = jobs[i]
+            logger.debug('Endpoint %s, batch %d', endpoint_name, start)
+            futures[i, start] = _executor.submit(
+                invoke_endpoint, endpoint_name,
+                preprocessed[keys[i]][start:start + batch_size])
+
+    results = []
+    for i, job_starts in enumerate(starts):
+        outputs = []
+        for start in job_starts:
+            outputs.extend(futures[i, start].result())
+
+        label_valss = [
+            None if output is None else labels_to_int(output['labels'])
+            for output in outputs]
+        if all(
+                label_vals for output, label_vals in zip(outputs, label_valss)
+                if output is not None):
+            outputs = [None if output is None else {
+                'label_vals': label_vals, **output
+            } for output, label_vals in zip(outputs, label_valss)]
+        results.append(outputs)
+
+    return results
+
+
+def predict(endpoint_name, preprocessing_config, texts, batch_size):
+    """Runs prediction in batches."""
+    return predict_all(
+        [(endpoint_name, preprocessing_config, batch_size)], texts)[0]
+
+
+PREDICTION_MISSING = {'missing': True}
+
+
+class Predictions:
+    """Predictions of several endpoints for a batch of documents.
+
+    Each endpoint is stored as columns (label, label value, probability)
+    and turned into a per-document dict only by ``document``. A document
+    an endpoint failed to predict gets PREDICTION_MISSING for that run.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.columns = []
+
+    def add(self, question_tag, run_name, outputs, primary=False):
+        """Adds the outputs of an endpoint, None for failed documents."""
+        import numpy as np
+
+        present = [output for output in outputs if output is not None]
+        width = max(
+            [len(output['probabilities']) for output in present], default=1)
+        probabilities = np.full((len(outputs), width), -np.inf)
+        for i, output in enumerate(outputs):
+            if output is not None:
+                probs = output['probabilities']
+                probabilities[i, :len(probs)] = probs
+        index = probabilities.argmax(axis=1)
+        max_probabilities = probabilities[np.arange(len(outputs)), index]
+
+        labels = []
+        label_vals = []
+        for output, j in zip(outputs, index.tolist()):
+            if output is None:
+                labels.append(None)
+                label_vals.append(None)
+                continue
+            labels.append(output['labels'][j])
+            label_vals.append(
+                output['label_vals'][j] if 'label_vals' in output else None)
+
+        self.columns.append((
+            question_tag, run_name, primary,
+            [output is not None for output in outputs],
+            labels, label_vals, max_probabilities.tolist()))
+
+    def document(self, i):
+        """Predictions of the i-th document, None without endpoints."""
+        predictions = {}
+        for (
+            question_tag, run_name, primary, valid,
+            labels, label_vals, probabilities
+        ) in self.columns:
+            endpoints = predictions.setdefault(
+                question_tag, {'endpoints': {}})['endpoints']
+            if not valid[i]:
+                endpoints[run_name] = dict(PREDICTION_MISSING)
+                continue
+            prediction = {
+                'probability': probabilities[i],
+                'label': labels[i],
+                'label_val': label_vals[i]
+            }
+            endpoints[run_name] = prediction
+            if primary:
+                endpoints['primary'] = dict(prediction)
+        return predictions or None
 
 
 def load_to_es(statuses_es, index_name):
+    """Creates documents with the bulk API. Documents that already exist
+    are counted, not overwritten. Returns the number of loaded, already
+    existing and failed documents.
+    """
+    # Imported on use, like the Elasticsearch client
+    from elasticsearch.helpers import streaming_bulk
+
     loads = 0
     errors = 0
-    request_errors = 0
-
-    for status_es in statuses_es:
-        logger.debug(status_es)
-        status_id = status_es.pop('id')
-        loads, errors = create_doc(
-            status_id, status_es, index_name,
-            loads, errors, request_errors)
+    conflicts = 0
+
+    def actions():
+        for status_es in statuses_es:
+            logger.debug(status_es)
+            status_id = status_es.pop('id')
+            yield {
+                '_op_type': 'create', '_index': index_name,
+                '_id': status_id, '_source': status_es}
+
+    for ok, item in streaming_bulk(
+            es, actions(),
+            chunk_size=ESEnv.BULK_CHUNK_SIZE,
+            max_chunk_bytes=ESEnv.BULK_MAX_CHUNK_BYTES,
+            max_retries=ESEnv.BULK_MAX_RETRIES,
+            initial_backoff=ESEnv.BULK_INITIAL_BACKOFF,
+            max_backoff=ESEnv.BULK_MAX_BACKOFF,
+            raise_on_error=False, raise_on_exception=False):
+        result = item['create']
+        if ok:
+            logger.debug('Loaded status with id %s.', result['_id'])
+            loads += 1
+        elif result.get('status') == 409:
+            # Happens when a document with the same ID already exists
+            logger.warning(
+                'Status with id %s already exists.', result['_id'])
+            conflicts += 1
+        else:
+            logger.error(
+                'Status with id %s: %s', result.get('_id'),
+                result.get('error', result.get('exception')))
+            errors += 1
 
+    total = len(statuses_es)
     logger.info(
-        'Loaded %d/%d to Elasticsearch, already exist %d/%d.',
-        loads, len(statuses_es), errors, len(statuses_es))
+        'Loaded %d/%d to Elasticsearch, already exist %d/%d, failed %d/%d.',
+        loads, total, conflicts, total, errors, total)
+    return loads, conflicts, errors
+
+
+def statuses_to_es(statuses, predictions=None):
+    """Converts a batch of statuses to Elasticsearch documents.
+
+    Locations go through the geocoding cache. ``Predictions``, if given,
+    are attached in the same pass. A tweet without any prediction is
+    still stored, without the 'predictions' field.
+    """
+    from twiprocess.processtweet import ProcessTweet
+
+    statuses_es = []
+    for i, status in enumerate(statuses):
+        status_es = ProcessTweet(
+            status, standardize_func='standardize_anonymize',
+            geo_code=geo_code
+        ).extract_es(extract_geo=True)
+        prediction = None if predictions is None \
+            else predictions.document(i)
+        if prediction is not None:
+            status_es['predictions'] = prediction
+        statuses_es.append(status_es)
+
+    return statuses_es
 
 
 def handle_jsonls(jsonls, model_endpoints):
@@ -174,12 +440,16 @@ def handle_jsonls(jsonls, model_endpoints):
             logger.error('JSONL:\n%s', str(jsonl))
             continue
 
+    return handle_statuses(statuses, model_endpoints)
+
+
+def handle_statuses(statuses, model_endpoints):
+    """Predicts and converts parsed statuses to Elasticsearch documents."""
     logger.debug('Num statuses: %s.', len(statuses))
 
     texts = [status['text'] for status in statuses]
 
-    # Read off stream config and prepare a template for metadata
-    prediction = {}
+    # Read off stream config
     endpoint_names = {}
     run_names = {}
     model_types = {}
@@ -188,7 +458,6 @@ def handle_jsonls(jsonls, model_endpoints):
         endpoint_names[question_tag] = []
         run_names[question_tag] = []
         model_types[question_tag] = []
-        prediction[question_tag] = {'endpoints': {}}
         preprocessing_configs[question_tag] = []
         for endpoint_name, info in \
                 model_endpoints[question_tag]['active'].items():
@@ -196,42 +465,15 @@ def handle_jsonls(jsonls, model_endpoints):
             run_names[question_tag].append(info['run_name'])
             model_types[question_tag].append(info['model_type'])
 
-            key = os.path.join(
-                ESEnv.ENDPOINTS_PREFIX, endpoint_name + '.json')
-            logger.debug(f'Key: {key}')
-
-            try:
-                logger.debug('Trying to load from S3')
-                run_config = json.loads(get_long_s3_object(
-                    ESEnv.BUCKET_NAME, key,
-                    {'CompressionType': 'NONE', 'JSON':
-                        {'Type': 'DOCUMENT'}}))
-            except Exception:
-                logger.debug('Some error, addind an empty config')
-                run_config = {'preprocess': {}}
-
             preprocessing_configs[question_tag].append(
-                run_config['preprocess'])
+                get_run_config(endpoint_name)['preprocess'])
 
-    predictions = [deepcopy(prediction)] * len(texts)
     logger.info('Endpoint names:\n%s.', endpoint_names)
 
-    def predictions_from_output(output, primary=False):
-        max_prob = max(output['probabilities'])
-        ind_max_prob = output['probabilities'].index(max_prob)
-        predictions = {
-            'probability': max_prob,
-            'label': output['labels'][ind_max_prob],
-            'label_val': output['label_vals'][ind_max_prob]
-        }
-        if primary:
-            return {'primary': predictions}
-        else:
-            return predictions
-
-    # Fill metadata with predictions
+    # Predict with all endpoints at once
+    jobs = []
+    job_info = []
     for question_tag in endpoint_names:
-        primary_endpoint_name = model_endpoints[question_tag]['primary']
         for (
             endpoint_name,
             model_type,
@@ -244,37 +486,19 @@ def handle_jsonls(jsonls, model_endpoints):
             preprocessing_configs[question_tag]
         ):
             batch_size = get_batch_size(model_type)
-
-            outputs = predict(
-                endpoint_name, preprocessing_config, texts, batch_size)
-
-            if outputs is None:
-                continue
-
-            if endpoint_name == primary_endpoint_name:
-                for i, output in enumerate(outputs):
-                    predictions[i][question_tag]['endpoints'] = \
-                        predictions_from_output(output, primary=True)
-
-            for i, output in enumerate(outputs):
-                predictions[i][question_tag]['endpoints'][run_name] = \
-                    predictions_from_output(output)
-
-    # Process tweets for ES
-    statuses_es = []
-    for status in statuses:
-        statuses_es.append(ProcessTweet(
-            status, standardize_func='standardize_anonymize', geo_code=geo_code
-        ).extract_es(extract_geo=True))
-
-    # Add 'predictions' field to statuses
-    for i in range(len(statuses)):
-        # This way, if prediction fails, we at least store the tweet
-        if predictions[i] != prediction:
-            # Add the 'predictions' field to statuses that were
-            # successfully predicted
-            statuses_es[i]['predictions'] = predictions[i]
-        # Else, keep the failed/inexistent predictions empty
+            jobs.append((endpoint_name, preprocessing_config, batch_size))
+            job_info.append((question_tag, endpoint_name, run_name))
+
+    # Collect predictions
+    predictions = Predictions(len(texts))
+    for (question_tag, endpoint_name, run_name), outputs in zip(
+            job_info, predict_all(jobs, texts)):
+        predictions.add(
+            question_tag, run_name, outputs,
+            primary=endpoint_name == model_endpoints[question_tag]['primary'])
+
+    # Process tweets for ES, attaching the predictions
+    statuses_es = statuses_to_es(statuses, predictions)
 
     logger.debug('\n\n'.join([json.dumps(status) for status in statuses_es]))
 
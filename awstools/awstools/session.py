@@ -1,8 +1,10 @@
+import threading
+
 import boto3
-from elasticsearch import Elasticsearch, RequestsHttpConnection
 # from requests_aws4auth import AWS4Auth
 
 from .env import AWSEnv, ESEnv
+from .lazy import LazyObject
 
 # https://forums.aws.amazon.com/thread.jspa?threadID=197439
 if AWSEnv.SESSION_TOKEN == '':
@@ -21,14 +23,25 @@ else:
         # aws_session_token=AWSEnv.SESSION_TOKEN
     )
 
-s3 = session.client('s3')
-aws_lambda = session.client('lambda')
-iam = session.client('iam')
-firehose = session.client('firehose')
-ecs = session.client('ecs')
-ecr = session.client('ecr')
+# Session.client isn't thread-safe, and lazy clients can be created from
+# several threads at once
+_client_lock = threading.Lock()
+
+
+def client(service_name, **kwargs):
+    with _client_lock:
+        return session.client(service_name, **kwargs)
+
+
+# Clients are created on first use
+s3 = LazyObject(lambda: client('s3'))
+aws_lambda = LazyObject(lambda: client('lambda'))
+iam = LazyObject(lambda: client('iam'))
+firehose = LazyObject(lambda: client('firehose'))
+ecs = LazyObject(lambda: client('ecs'))
+ecr = LazyObject(lambda: client('ecr'))
 
-credentials = session.get_credentials()
+credentials = LazyObject(session.get_credentials)
 
 # Login to AWS Elasticsearch, outdated
 # awsauth = AWS4Auth(
@@ -46,12 +59,19 @@ credentials = session.get_credentials()
 #     request_timeout=120
 # )
 
-# Login to Elastic CLoud Elasticsearch
-es = Elasticsearch(
-    cloud_id=ESEnv.CLOUD_ID,
-    api_key=ESEnv.API_KEY,
-    use_ssl=True,
-    verify_certs=True,
-    connection_class=RequestsHttpConnection,
-    request_timeout=120
-)
+
+def connect_es():
+    # Login to Elastic CLoud Elasticsearch
+    from elasticsearch import Elasticsearch, RequestsHttpConnection
+
+    return Elasticsearch(
+        cloud_id=ESEnv.CLOUD_ID,
+        api_key=ESEnv.API_KEY,
+        use_ssl=True,
+        verify_certs=True,
+        connection_class=RequestsHttpConnection,
+        request_timeout=120
+    )
+
+
+es = LazyObject(connect_es)
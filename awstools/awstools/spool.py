@@ -0,0 +1,237 @@
+"""
+Durable local spool for records the sink can't take right now.
+
+Records are appended to segment files as
+``<length: uint32><crc32: uint32><payload>`` (little-endian). A segment is
+rotated once it reaches ``segment_bytes``, and writes are fsynced in
+batches, every ``fsync_records`` records or ``fsync_interval`` seconds.
+A ``Replayer`` drains closed segments into a sink at a limited rate.
+Segments with a truncated or corrupt record are kept for inspection.
+"""
+
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+from .env import Env
+
+logger = logging.getLogger(__name__)
+
+if Env.DEBUG == 1:
+    logger.setLevel(logging.DEBUG)
+else:
+    logger.setLevel(logging.INFO)
+
+HEADER = struct.Struct('<II')
+SUFFIX = '.seg'
+CORRUPT_SUFFIX = '.corrupt'
+
+
+class Spool:
+    """Append-only segmented log of byte records."""
+    def __init__(
+            self, directory,
+            segment_bytes=64 * 1024 * 1024,
+            fsync_records=1000,
+            fsync_interval=1.,
+            use_mmap=False
+    ):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.fsync_records = fsync_records
+        self.fsync_interval = fsync_interval
+        self.use_mmap = use_mmap
+        self._file = None
+        self._size = 0
+        self._unsynced = 0
+        self._synced_at = time.time()
+        self._lock = threading.Lock()
+
+    def append(self, payloads):
+        """Appends a list of byte records."""
+        with self._lock:
+            for payload in payloads:
+                if self._file is None:
+                    self._open()
+                record = HEADER.pack(
+                    len(payload), zlib.crc32(payload)) + payload
+                self._file.write(record)
+                self._size += len(record)
+                self._unsynced += 1
+                if self._size >= self.segment_bytes:
+                    self._close()
+            if self._file is not None and (
+                    self._unsynced >= self.fsync_records or
+                    time.time() - self._synced_at >= self.fsync_interval):
+                self._sync()
+
+    def rotate(self):
+        """Closes the current segment, so that it can be replayed."""
+        with self._lock:
+            if self._file is not None:
+                self._close()
+
+    def close(self):
+        self.rotate()
+
+    def segments(self):
+        """Closed segments, oldest first."""
+        with self._lock:
+            current = self._file.name if self._file is not None else None
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(
+            path for path in (
+                os.path.join(self.directory, name)
+                for name in os.listdir(self.directory)
+                if name.endswith(SUFFIX))
+            if path != current)
+
+    @property
+    def pending(self):
+        """True if there are records in the current segment."""
+        return self._file is not None and self._size > 0
+
+    def read(self, path, offset=0):
+        """Yields (end offset, payload) of the records of a segment from
+        ``offset``. Stops at a truncated or corrupt record.
+        """
+        with open(path, 'rb') as f:
+            if self.use_mmap and os.fstat(f.fileno()).st_size > 0:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                data = f.read()
+        try:
+            while offset + HEADER.size <= len(data):
+                length, crc = HEADER.unpack_from(data, offset)
+                start = offset + HEADER.size
+                payload = bytes(data[start:start + length])
+                if len(payload) < length:
+                    logger.warning('Truncated record in %s.', path)
+                    return
+                if zlib.crc32(payload) != crc:
+                    logger.error(
+                        'Corrupt record in %s at offset %d.', path, offset)
+                    return
+                offset = start + length
+                yield offset, payload
+        finally:
+            if isinstance(data, mmap.mmap):
+                data.close()
+
+    def quarantine(self, path, offset):
+        """Renames a segment that can't be read past ``offset``, so that
+        it is no longer replayed but its remaining records are kept.
+        """
+        corrupt_path = path[:-len(SUFFIX)] + CORRUPT_SUFFIX
+        os.rename(path, corrupt_path)
+        logger.error(
+            'Kept %d unreadable byte(s) of %s in %s.',
+            os.path.getsize(corrupt_path) - offset, path, corrupt_path)
+
+    def _open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self._file = open(os.path.join(
+            self.directory, f'{time.time_ns():020d}{SUFFIX}'), 'ab')
+        self._size = 0
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self._synced_at = time.time()
+
+    def _close(self):
+        self._sync()
+        self._file.close()
+        self._file = None
+        self._size = 0
+
+
+class Replayer:
+    """Background thread that feeds spooled records back to a sink.
+
+    ``sink(payloads)`` returns the payloads it couldn't take, in which
+    case replay pauses until the next ``interval``. At most ``rate``
+    records are replayed per second. Segments are deleted once fully
+    replayed, or quarantined if replay stopped at a bad record; after a
+    restart, a partly replayed segment is replayed from its start.
+    """
+    def __init__(
+            self, spool, sink, rate=1000., interval=10., batch_size=500):
+        self.spool = spool
+        self.sink = sink
+        self.rate = rate
+        self.interval = interval
+        self.batch_size = batch_size
+        self.replayed = 0
+        self._offsets = {}
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def replay(self):
+        """Replays closed segments. Returns False if the sink failed."""
+        if self.spool.pending:
+            self.spool.rotate()
+        for path in self.spool.segments():
+            offset = end = self._offsets.get(path, 0)
+            batch = []
+            for end, payload in self.spool.read(path, offset):
+                batch.append(payload)
+                if len(batch) >= self.batch_size:
+                    if not self._send(path, batch, end):
+                        return False
+                    batch = []
+                if self._stopped.is_set():
+                    return False
+            if batch:
+                if not self._send(path, batch, end):
+                    return False
+            self._offsets.pop(path, None)
+            if end < os.path.getsize(path):
+                # Stopped at a truncated or corrupt record
+                self.spool.quarantine(path, end)
+                continue
+            os.remove(path)
+            logger.info('Replayed spool segment %s.', path)
+        return True
+
+    def _send(self, path, batch, end):
+        start = time.time()
+        failed = self.sink(batch)
+        if failed:
+            logger.warning(
+                'Sink refused %d/%d spooled record(s), pausing replay.',
+                len(failed), len(batch))
+            # Only the refused records are kept for the next attempt
+            self.spool.append(failed)
+            self._offsets[path] = end
+            return False
+        self._offsets[path] = end
+        self.replayed += len(batch)
+        # Limit the rate
+        wait = len(batch) / self.rate - (time.time() - start)
+        if wait > 0:
+            self._stopped.wait(wait)
+        return True
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.replay()
+            except Exception as exc:
+                logger.error('%s: %s', type(exc).__name__, str(exc))
@@ -1,11 +1,10 @@
 import logging
-import json
 
-from awstools.s3_to_es import load_to_es, handle_jsonls
+from awstools.s3_to_es import load_to_es, handle_statuses, geo_code
 # from awstools.s3_to_es import logger as logger_s3_to_es
 from awstools.env import ESEnv
 from awstools.config import config_manager
-from awstools.s3 import get_long_s3_object
+from awstools.s3 import config_cache, iter_s3_jsonl
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -14,6 +13,8 @@ logger.setLevel(logging.INFO)
 
 def handler(event, context):
     logger.debug(event)
+    # Configs are fetched at most once for all records of the event
+    config_cache.begin()
     for record in event['Records']:
         # Get bucket name and key for new file
         bucket = record['s3']['bucket']['name']
@@ -32,18 +33,15 @@ def handler(event, context):
         # Get model endpoints from config
         model_endpoints = config_manager.get_conf_by_slug(slug).model_endpoints
 
-        # Get S3 object
-        jsonls = get_long_s3_object(
-            bucket, key,
-            {'CompressionType': 'GZIP', 'JSON': {'Type': 'LINES'}})
-
-        statuses_es = handle_jsonls(jsonls, model_endpoints)
-
-        # Load to Elasticsearch
-        indices = json.loads(get_long_s3_object(
-            ESEnv.BUCKET_NAME, ESEnv.CONFIG_S3_KEY,
-            {'CompressionType': 'NONE', 'JSON': {'Type': 'DOCUMENT'}}))
+        # Get index
+        indices = config_cache.get(ESEnv.BUCKET_NAME, ESEnv.CONFIG_S3_KEY)
         index_name = indices[slug][-1]
         logger.debug(index_name)
 
-        load_to_es(statuses_es, index_name)
+        # Stream the S3 object, predict and load to Elasticsearch in chunks
+        for statuses in iter_s3_jsonl(
+                bucket, key, chunk_size=ESEnv.LOAD_CHUNK_SIZE):
+            statuses_es = handle_statuses(statuses, model_endpoints)
+            load_to_es(statuses_es, index_name)
+
+    geo_code.log_stats()
@@ -5,7 +5,8 @@ from awstools.llambda import (create_lambda,
                               create_lambda_layer,
                               zip_lambda_func,
                               zip_lambda_layer)
-from awstools.env import AWSEnv
+from awstools.env import ESEnv
+from awstools.geo import build_index
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -18,6 +19,14 @@ def main():
     policy_path = os.path.join(
         lambda_dir, 'function/config/lambda_policy.json')
 
+    # Compile the geocoding index into the layer, it ends up in /opt/python
+    more_env_vars = None
+    if ESEnv.GEONAMES_PATH:
+        build_index(
+            [ESEnv.GEONAMES_PATH],
+            os.path.join(lambda_dir, 'layer/python/geoindex'))
+        more_env_vars = {'ES_GEO_INDEX_DIR': '/opt/python/geoindex'}
+
     lambda_local_zip_path = zip_lambda_func(lambda_dir)
     layer_local_zip_path = zip_lambda_layer(lambda_dir)
 
@@ -32,7 +41,8 @@ def main():
         policy_path,
         push_to_s3=True,
         add_s3_permission=True,
-        memory_size=1024
+        memory_size=1024,
+        more_env_vars=more_env_vars
     )
 
 
@@ -87,6 +87,29 @@ def start_streamer():
     wait_for_desired_count(ECSEnv.CLUSTER, ECSEnv.SERVICE, 1)
 
 
+def streamer_polls_config(cluster_name, service_name):
+    """True if the streamer hot-reloads the stream config, as set in the
+    environment of the task definition the ECS service runs.
+    """
+    response = ecs.describe_services(
+        cluster=cluster_name,
+        services=[service_name]
+    )
+    for service in response['services']:
+        if service['serviceName'] != service_name:
+            continue
+        task_definition = ecs.describe_task_definition(
+            taskDefinition=service['taskDefinition'])['taskDefinition']
+        for container in task_definition['containerDefinitions']:
+            for variable in container.get('environment', []):
+                if variable['name'] == 'AWS_STREAM_CONFIG_POLL_INTERVAL':
+                    try:
+                        return float(variable['value']) > 0
+                    except ValueError:
+                        return False
+    return False
+
+
 def stop_streamer():
     # To stop the streamer, set the desired count to 0 and wait
     # until tasks are stopped
@@ -120,7 +143,11 @@ def handle_stream_config():
 
     # Restart streaming if configs are different
     if config_manager_old.config != config_manager_new.config:
-        if state is True:
+        if state is True and streamer_polls_config(
+                ECSEnv.CLUSTER, ECSEnv.SERVICE):
+            # The running streamer polls the config and applies it in place
+            logger.info('The config changed. The streamer will reload it.')
+        elif state is True:
             logger.info('The config changed. Going to restart the streamer.')
             stop_streamer()
             start_streamer()
@@ -131,10 +158,10 @@ def handle_stream_config():
 
         # Update bucket Lambda event notifications
         s3_prefixes = []
-        for conf in config_manager_new.config:
-            if conf.storage_mode not in [StorageMode.S3,
-                                         StorageMode.S3_NO_RETWEETS]:
-                s3_prefixes.append(AWSEnv.STORAGE_BUCKET_PREFIX + conf.slug)
+        for mode, confs in config_manager_new.storage_modes.items():
+            if mode not in [StorageMode.S3, StorageMode.S3_NO_RETWEETS]:
+                s3_prefixes.extend(
+                    AWSEnv.STORAGE_BUCKET_PREFIX + conf.slug for conf in confs)
         set_s3_triggers(AWSEnv.LAMBDA_S3_ES_NAME, s3_prefixes)
 
 
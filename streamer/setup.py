@@ -9,7 +9,7 @@ setuptools.setup(
     url="https://github.com/digitalepidemiologylab/crowdbreaks-streamer",
     packages=setuptools.find_packages(),
     install_requires=[
-        'python-dotenv', 'aenum', 'dacite', 'tweepy',
+        'python-dotenv', 'aenum', 'dacite', 'tweepy[async]',
         'awstools @ git+https://github.com/digitalepidemiologylab/crowdbreaks-streamer.git#egg=awstools&subdirectory=awstools'],
     entry_points={'console_scripts': [
         'run-stream=streamer.run:main',
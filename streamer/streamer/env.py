@@ -9,13 +9,59 @@ load_dotenv(dotenv_path=env_path)
 
 
 class TwiEnv(Constant):
-    """Twitter API config."""
+    """Twitter API and streamer config."""
     CONSUMER_KEY = os.environ.get('TWI_CONSUMER_KEY', '')
     CONSUMER_SECRET = os.environ.get('TWI_CONSUMER_SECRET', '')
     OAUTH_TOKEN = os.environ.get('TWI_OAUTH_TOKEN', '')
     OAUTH_TOKEN_SECRET = os.environ.get('TWI_OAUTH_TOKEN_SECRET', '')
 
     BEARER_TOKEN = os.environ.get('TWI_BEARER_TOKEN', '')
+    # Read the v2 stream with asyncio
+    STREAM_ASYNC = int(os.environ.get('TWI_STREAM_ASYNC', 'False') == 'True')
+    # Forward v2 payloads as received instead of parsing and re-serializing
+    PASSTHROUGH = int(os.environ.get('TWI_PASSTHROUGH', 'False') == 'True')
+    # Prefix of the v2 stream rule tags of this deployment. Rules belong
+    # to the app of the bearer token, and only the rules with this prefix
+    # are managed here: deployments sharing a token need distinct prefixes
+    RULE_TAG_PREFIX = os.environ.get('TWI_RULE_TAG_PREFIX', '')
+    # 'json' or 'orjson' (if installed) for encoding Firehose records
+    JSON_BACKEND = os.environ.get('JSON_BACKEND', 'json')
+
+    # Pipeline
+    NUM_WORKERS = int(os.environ.get('NUM_WORKERS', '4'))
+    QUEUE_MAX_SIZE = int(os.environ.get('QUEUE_MAX_SIZE', '10000'))
+    # Above this fraction of QUEUE_MAX_SIZE, unmatched tweets aren't stored
+    QUEUE_SHED_THRESHOLD = float(
+        os.environ.get('QUEUE_SHED_THRESHOLD', '0.8'))
+    QUEUE_REPORT_INTERVAL = float(
+        os.environ.get('QUEUE_REPORT_INTERVAL', '60'))
+    # Seconds to send what was already received when a stream stops
+    QUEUE_DRAIN_TIMEOUT = float(os.environ.get('QUEUE_DRAIN_TIMEOUT', '30'))
+    # Worker processes of the v1 stream, 0 handles tweets in NUM_WORKERS
+    # threads of the reading process instead
+    NUM_PROCESSES = int(os.environ.get('NUM_PROCESSES', '0'))
+    # Raw tweets are sent to the worker processes in batches
+    PROCESS_BATCH_SIZE = int(os.environ.get('PROCESS_BATCH_SIZE', '100'))
+    PROCESS_BATCH_INTERVAL = float(
+        os.environ.get('PROCESS_BATCH_INTERVAL', '0.05'))
+    # Seconds a sent (tweet id, project) pair is remembered to drop
+    # duplicates. Off by default: a false positive drops a tweet that was
+    # never sent
+    DEDUP_WINDOW = float(os.environ.get('DEDUP_WINDOW', '0'))
+    # Pairs expected per window and the accepted false positive rate,
+    # which together set the memory of the filters
+    DEDUP_CAPACITY = int(os.environ.get('DEDUP_CAPACITY', '1000000'))
+    DEDUP_ERROR_RATE = float(os.environ.get('DEDUP_ERROR_RATE', '0.00001'))
+    # Local overflow of the stream queues. The v1 pipeline spills what is
+    # still queued on exit only here, which has to be on a mounted volume
+    # to outlive the task. Unset, the overflow goes to the temp directory
+    # and queued tweets are dropped on exit
+    SPILL_DIR = os.environ.get('SPILL_DIR', '')
+    # Port of the /metrics endpoint, 0 disables it
+    METRICS_PORT = int(os.environ.get('METRICS_PORT', '0'))
+    # Seconds between metrics summaries in the log, 0 disables them
+    METRICS_REPORT_INTERVAL = float(
+        os.environ.get('METRICS_REPORT_INTERVAL', '60'))
 
     COVID_STREAM_NAME = os.environ.get('COVID_STREAM_NAME', 'None')
     COVID_PARTITION = os.environ.get('COVID_PARTITION', '0')
@@ -0,0 +1,542 @@
+import atexit
+import json
+import logging
+import multiprocessing
+import os
+import re
+import signal
+import tempfile
+import threading
+import time
+import traceback
+
+from itertools import chain, islice
+from queue import Queue, Empty, Full
+
+from awstools.config import ConfigManager, ConfigState, config_manager
+from awstools.env import KFEnv
+from awstools.firehose import batch_producer, get_spool
+from awstools.metrics import metrics
+
+from .env import TwiEnv
+from .setup_logging import setup_logging
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+class Spill:
+    """Append-only local files for items that didn't fit in the queue.
+    A ``persistent`` spill outlives the container.
+    """
+    def __init__(
+            self, directory, serialize=json.dumps, deserialize=json.loads,
+            persistent=True):
+        self.directory = directory
+        self.persistent = persistent
+        self.serialize = serialize
+        self.deserialize = deserialize
+        self._file = None
+        self._lock = threading.Lock()
+
+    def write(self, item):
+        with self._lock:
+            if self._file is None:
+                os.makedirs(self.directory, exist_ok=True)
+                self._file = open(os.path.join(
+                    self.directory, f'{time.time_ns()}.jsonl'), 'ab')
+            self._file.write(self._encode(item) + b'\n')
+
+    def close(self):
+        """Closes the current file, the next write starts a new one."""
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def segments(self):
+        """Closes the current file and returns all spilled files,
+        oldest first.
+        """
+        self.close()
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(
+            os.path.join(self.directory, name)
+            for name in os.listdir(self.directory) if name.endswith('.jsonl'))
+
+    def read(self, path):
+        with open(path, 'rb') as f:
+            for line in f:
+                line = line.rstrip(b'\n')
+                if line:
+                    yield self.deserialize(line)
+
+    def keep_on_exit(self, items):
+        """Spills the items left on exit if the spill is persistent, drops
+        them otherwise. Returns how many were spilled.
+        """
+        if not items:
+            return 0
+        if not self.persistent:
+            metrics.counter(
+                'tweets_dropped_total', reason='exit').inc(len(items))
+            logger.error(
+                'Dropped %d queued item(s) on exit. Set SPILL_DIR to a '
+                'mounted volume to keep them.', len(items))
+            return 0
+        for item in items:
+            self.write(item)
+        self.close()
+        logger.warning('Spilled %d queued item(s) on exit.', len(items))
+        return len(items)
+
+    def _encode(self, item):
+        data = self.serialize(item)
+        return data if isinstance(data, bytes) else data.encode()
+
+
+def get_spill(directory=TwiEnv.SPILL_DIR, **kwargs):
+    """Spill in ``directory``, or in the temp directory if unset."""
+    if directory:
+        return Spill(directory, **kwargs)
+    return Spill(
+        os.path.join(tempfile.gettempdir(), 'streamer-spill'),
+        persistent=False, **kwargs)
+
+
+class Pipeline:
+    """Bounded queue between the socket reader and the worker threads.
+
+    The reader never blocks: when the queue is full, items are spilled to
+    local disk and fed back once the queue has drained. Above the shedding
+    threshold workers are told to skip optional work (storing unmatched
+    tweets), ``handle(item, shed)`` returns True if it dropped the item.
+    Sending is done by the workers through the Firehose batch producer,
+    whose bounded buffers block them when Firehose falls behind. On exit,
+    what the workers can't handle within ``drain_timeout`` seconds is
+    spilled if the spill is persistent, and dropped otherwise.
+    """
+    def __init__(
+            self, handle,
+            num_workers=TwiEnv.NUM_WORKERS,
+            max_size=TwiEnv.QUEUE_MAX_SIZE,
+            shed_threshold=TwiEnv.QUEUE_SHED_THRESHOLD,
+            report_interval=TwiEnv.QUEUE_REPORT_INTERVAL,
+            drain_timeout=TwiEnv.QUEUE_DRAIN_TIMEOUT,
+            spill=None
+    ):
+        self.handle = handle
+        self.num_workers = num_workers
+        self.q = Queue(maxsize=max_size)
+        self.shed_size = int(max_size * shed_threshold)
+        self.report_interval = report_interval
+        self.drain_timeout = drain_timeout
+        self.spill = spill or get_spill()
+        self.counts = {'received': 0, 'spilled': 0, 'replayed': 0, 'shed': 0}
+        self.max_depth = 0
+        self._threads = []
+        self._lock = threading.Lock()
+        self._counts_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._handle_seconds = metrics.histogram('pipeline_handle_seconds')
+        metrics.gauge('pipeline_queue_depth', func=self.q.qsize)
+        self._counters = {
+            event: metrics.counter('pipeline_items_total', event=event)
+            for event in self.counts}
+
+    @property
+    def shedding(self):
+        return self.q.qsize() >= self.shed_size
+
+    def put(self, item):
+        """Called from the socket reading thread."""
+        if not self._threads:
+            self.start()
+        self._count('received')
+        try:
+            self.q.put_nowait(item)
+        except Full:
+            self.spill.write(item)
+            self._count('spilled')
+
+    def _count(self, event, n=1):
+        # Updated from the reader, worker and monitor threads
+        with self._counts_lock:
+            self.counts[event] += n
+        self._counters[event].inc(n)
+
+    def start(self):
+        with self._lock:
+            if self._threads:
+                return
+            for _ in range(self.num_workers):
+                self._threads.append(self._start_thread(self._work))
+            self._monitor_thread = self._start_thread(self._monitor)
+            self._threads.append(self._monitor_thread)
+            # Runs before the daemon threads are stopped
+            atexit.register(self.close)
+            logger.info('Started %d worker(s).', self.num_workers)
+
+    def close(self):
+        """Gives the workers ``drain_timeout`` seconds to handle the queued
+        items, then spills the rest, or drops them without a persistent
+        spill.
+        """
+        if not self._threads or self._stopped.is_set():
+            return
+        self._stopped.set()
+        deadline = time.time() + self.drain_timeout
+        # Lets a replay in progress finish
+        self._monitor_thread.join(self.drain_timeout)
+        while self.q.unfinished_tasks and time.time() < deadline:
+            time.sleep(0.05)
+        left = []
+        while True:
+            try:
+                left.append(self.q.get_nowait())
+            except Empty:
+                break
+            self.q.task_done()
+        spilled = self.spill.keep_on_exit(left)
+        if spilled:
+            self._count('spilled', spilled)
+
+    def _start_thread(self, target):
+        thread = threading.Thread(target=target, daemon=True)
+        thread.start()
+        return thread
+
+    def _work(self):
+        while True:
+            item = self.q.get()
+            try:
+                with self._handle_seconds.time():
+                    if self.handle(item, self.shedding):
+                        self._count('shed')
+            except Exception as exc:
+                logger.error(
+                    '%s: %s. Traceback: %s', type(exc).__name__, str(exc),
+                    '; '.join(traceback.format_tb(exc.__traceback__)))
+            self.q.task_done()
+
+    def _monitor(self):
+        last_report = time.time()
+        while not self._stopped.wait(1):
+            self.max_depth = max(self.max_depth, self.q.qsize())
+            if self.q.qsize() < self.shed_size // 2:
+                self._replay()
+            if time.time() - last_report >= self.report_interval:
+                self._report()
+                last_report = time.time()
+
+    def _replay(self):
+        for path in self.spill.segments():
+            for item in self.spill.read(path):
+                # Blocking put, the workers set the pace
+                self.q.put(item)
+                self._count('replayed')
+            os.remove(path)
+
+    def _report(self):
+        logger.info(
+            'Queue depth %d (max %d), received %d, spilled %d, '
+            'replayed %d, shed %d.',
+            self.q.qsize(), self.max_depth, self.counts['received'],
+            self.counts['spilled'], self.counts['replayed'],
+            self.counts['shed'])
+        self.max_depth = 0
+
+
+class ProcessPipeline:
+    """Bounded queue between the socket reader and worker processes, for
+    when the worker threads of a ``Pipeline`` are held back by the GIL.
+
+    The reader only forwards raw tweet lines, in batches of ``batch_size``
+    or whatever arrived within ``batch_interval`` seconds. The workers
+    don't read the config from S3: the reading process sends them each
+    config it swapped in, so only configs its preparers created the
+    delivery streams and indices of are used. Otherwise they share
+    nothing: each compiles its own matcher and sends through its own
+    batch producer, spooling to its own subdirectory of the spool.
+    Worker 0 also replays the spools left behind by other layouts, see
+    ``adopt_orphaned_spools``.
+    ``handle(data_raw, shed)`` runs in the workers, so it must be
+    a module level function. Spilling, shedding and draining on exit
+    work as in ``Pipeline``, the queue holds batches.
+    """
+    def __init__(
+            self, handle,
+            num_processes=TwiEnv.NUM_PROCESSES,
+            max_size=TwiEnv.QUEUE_MAX_SIZE,
+            shed_threshold=TwiEnv.QUEUE_SHED_THRESHOLD,
+            batch_size=TwiEnv.PROCESS_BATCH_SIZE,
+            batch_interval=TwiEnv.PROCESS_BATCH_INTERVAL,
+            report_interval=TwiEnv.QUEUE_REPORT_INTERVAL,
+            drain_timeout=TwiEnv.QUEUE_DRAIN_TIMEOUT,
+            spill=None
+    ):
+        self.handle = handle
+        self.num_processes = int(num_processes)
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.max_batches = max(max_size // batch_size, 1)
+        self.shed_size = max(int(self.max_batches * shed_threshold), 1)
+        self.report_interval = report_interval
+        self.drain_timeout = drain_timeout
+        self.spill = spill or get_spill(serialize=bytes, deserialize=bytes)
+        self.counts = {'received': 0, 'spilled': 0, 'replayed': 0}
+        self.max_depth = 0
+        # Created on start, the workers import this module too
+        self.q = None
+        self._context = None
+        self._processes = []
+        self._config_queues = []
+        self._batch = []
+        self._lock = threading.Lock()
+        self._counts_lock = threading.Lock()
+        self._counters = {
+            event: metrics.counter('pipeline_items_total', event=event)
+            for event in self.counts}
+        self._stopped = threading.Event()
+        self._monitor_thread = None
+
+    def put(self, data_raw):
+        """Called from the socket reading thread."""
+        if not self._processes:
+            self.start()
+        self._count('received')
+        with self._lock:
+            self._batch.append(data_raw)
+            if len(self._batch) < self.batch_size:
+                return
+            batch, self._batch = self._batch, []
+        self._put_batch(batch)
+
+    def _count(self, event, n=1):
+        # Updated from the reader, worker and monitor threads
+        with self._counts_lock:
+            self.counts[event] += n
+        self._counters[event].inc(n)
+
+    def start(self):
+        with self._lock:
+            if self._processes:
+                return
+            self._context = multiprocessing.get_context('spawn')
+            self.q = self._context.JoinableQueue(maxsize=self.max_batches)
+            for index in range(self.num_processes):
+                self._config_queues.append(self._context.Queue())
+                self._processes.append(self._start_process(index))
+            config_manager.add_listener(self._send_config)
+            self._monitor_thread = threading.Thread(
+                target=self._monitor, daemon=True)
+            self._monitor_thread.start()
+            metrics.gauge('pipeline_queue_depth', func=self.q.qsize)
+            # Runs before multiprocessing terminates the daemon processes
+            atexit.register(self.close)
+            logger.info('Started %d worker process(es).', self.num_processes)
+
+    def _start_process(self, index):
+        process = self._context.Process(
+            target=_work_process,
+            args=(
+                self.q, self.handle, index, self.shed_size,
+                self.num_processes, _pack_state(config_manager.state),
+                self._config_queues[index]),
+            daemon=True)
+        process.start()
+        return process
+
+    def _send_config(self, old, new):
+        """Config listener, forwards a config once it was prepared."""
+        packed = _pack_state(new)
+        for config_queue in self._config_queues:
+            config_queue.put(packed)
+
+    def join(self):
+        """Waits until the workers handled everything put so far."""
+        self._flush()
+        self.q.join()
+
+    def close(self):
+        """Gives the workers ``drain_timeout`` seconds to handle the queued
+        batches, spills the rest as ``Pipeline.close`` does and stops the
+        workers.
+        """
+        if not self._processes or self._stopped.is_set():
+            return
+        self._stopped.set()
+        config_manager.remove_listener(self._send_config)
+        deadline = time.time() + self.drain_timeout
+        # Lets a replay in progress finish
+        self._monitor_thread.join(self.drain_timeout)
+        self._flush()
+        while self.q.qsize() and time.time() < deadline:
+            time.sleep(0.05)
+        left = []
+        while True:
+            try:
+                left.extend(self.q.get_nowait())
+            except Empty:
+                break
+            self.q.task_done()
+        spilled = self.spill.keep_on_exit(left)
+        if spilled:
+            self._count('spilled', spilled)
+        for _ in self._processes:
+            try:
+                self.q.put(None, timeout=1)
+            except Full:
+                break
+        for process in self._processes:
+            process.join(timeout=max(deadline - time.time(), 1))
+        logger.info('Stopped %d worker process(es).', len(self._processes))
+
+    def _flush(self):
+        with self._lock:
+            batch, self._batch = self._batch, []
+        if batch:
+            self._put_batch(batch)
+
+    def _put_batch(self, batch):
+        try:
+            self.q.put_nowait(batch)
+        except Full:
+            for data_raw in batch:
+                self.spill.write(data_raw)
+            self._count('spilled', len(batch))
+
+    def _monitor(self):
+        last_check = last_report = time.time()
+        while not self._stopped.wait(self.batch_interval):
+            self._flush()
+            if time.time() - last_check < 1:
+                continue
+            last_check = time.time()
+            self.max_depth = max(self.max_depth, self.q.qsize())
+            if self.q.qsize() < self.shed_size // 2:
+                self._replay()
+            for index, process in enumerate(self._processes):
+                if not process.is_alive():
+                    logger.error(
+                        'Worker process %d exited with code %s. Restarting.',
+                        process.pid, process.exitcode)
+                    self._processes[index] = self._start_process(index)
+            if time.time() - last_report >= self.report_interval:
+                self._report()
+                last_report = time.time()
+
+    def _replay(self):
+        for path in self.spill.segments():
+            items = self.spill.read(path)
+            while True:
+                batch = list(islice(items, self.batch_size))
+                if not batch:
+                    break
+                try:
+                    # Waits for the workers, but not for so long that
+                    # dead ones aren't restarted
+                    self.q.put(batch, timeout=1)
+                except Full:
+                    # Spilled again, to be replayed later
+                    for data_raw in chain(batch, items):
+                        self.spill.write(data_raw)
+                    self.spill.close()
+                    os.remove(path)
+                    return
+                self._count('replayed', len(batch))
+            os.remove(path)
+
+    def _report(self):
+        logger.info(
+            'Queue depth %d batches (max %d), received %d, spilled %d, '
+            'replayed %d.',
+            self.q.qsize(), self.max_depth, self.counts['received'],
+            self.counts['spilled'], self.counts['replayed'])
+        self.max_depth = 0
+
+
+def adopt_orphaned_spools(
+        num_processes, directory=KFEnv.SPOOL_DIR, producer=batch_producer):
+    """Replays the spools no process writes to with ``num_processes``
+    worker processes (0 for worker threads), left behind when it changed
+    between deploys: the ``worker-*`` spools of missing worker indices
+    and, with worker processes, the spool of the reading process. Called
+    once, by worker 0 or by the reading process without workers.
+    """
+    if not directory or not os.path.isdir(directory):
+        return
+    orphans = []
+    if num_processes > 0:
+        orphans.append(directory)
+    for name in sorted(os.listdir(directory)):
+        match = re.fullmatch(r'worker-(\d+)', name)
+        if match is not None and int(match.group(1)) >= num_processes:
+            orphans.append(os.path.join(directory, name))
+    for orphan in orphans:
+        logger.info('Replaying the orphaned spool %s.', orphan)
+        producer.adopt_spool(get_spool(orphan))
+
+
+def _pack_state(state):
+    # Config states hold mapping proxies, which can't be pickled
+    return state.dict, state.etag, state.version_id
+
+
+def _apply_configs(config_queue):
+    """Swaps in the configs the reading process sent, in order."""
+    while True:
+        try:
+            packed = config_queue.get_nowait()
+        except Empty:
+            return
+        config_manager.apply(ConfigState(*packed))
+
+
+def _work_process(
+        q, handle, index, shed_size, num_processes, state, config_queue):
+    """Main loop of a worker process of a ``ProcessPipeline``."""
+    # The reading process coordinates the shutdown
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    setup_logging()
+    if KFEnv.SPOOL_DIR:
+        batch_producer.set_spool(get_spool(
+            os.path.join(KFEnv.SPOOL_DIR, f'worker-{index}')))
+        if index == 0:
+            adopt_orphaned_spools(num_processes)
+    # The config of the reading process, which prepared it
+    config_manager.set(ConfigManager(state=ConfigState(*state)))
+    if TwiEnv.METRICS_REPORT_INTERVAL:
+        # The /metrics endpoint only covers the reading process
+        metrics.start_reporting(TwiEnv.METRICS_REPORT_INTERVAL)
+    handle_seconds = metrics.histogram('pipeline_handle_seconds')
+    shed_count = metrics.counter('pipeline_items_total', event='shed')
+    parent = os.getppid()
+    try:
+        while True:
+            try:
+                batch = q.get(timeout=1)
+            except Empty:
+                if os.getppid() != parent:
+                    logger.error('Reading process is gone. Exiting.')
+                    break
+                continue
+            if batch is None:
+                q.task_done()
+                break
+            _apply_configs(config_queue)
+            shed = q.qsize() >= shed_size
+            for data_raw in batch:
+                try:
+                    with handle_seconds.time():
+                        if handle(data_raw, shed):
+                            shed_count.inc()
+                except Exception as exc:
+                    logger.error(
+                        '%s: %s. Traceback: %s', type(exc).__name__, str(exc),
+                        '; '.join(traceback.format_tb(exc.__traceback__)))
+            q.task_done()
+    finally:
+        batch_producer.close()
@@ -1,4 +1,6 @@
+import atexit
 import logging
+import signal
 import sys
 import os
 import time
@@ -6,11 +8,13 @@ import traceback
 
 from awstools.env import KFEnv
 from awstools.config import config_manager
-from awstools.firehose import create_delivery_stream
+from awstools.firehose import create_delivery_stream, batch_producer
 from awstools.elasticsearch import create_index
 from awstools.llambda import set_s3_triggers
+from awstools.metrics import metrics
 
 from .env import TwiEnv
+from .pipeline import adopt_orphaned_spools
 from .stream import StreamManagerFilter, StreamManagerCovid
 from .setup_logging import setup_logging
 
@@ -50,6 +54,9 @@ def run():
             n_errors_last_hour = update_error_count(
                 n_errors_last_hour, last_error_time)
             last_error_time = time.time()
+        if stream.config_changed:
+            # Disconnected on purpose to apply a new config
+            continue
         wait_some_time(n_errors_last_hour)
 
 
@@ -68,6 +75,20 @@ def wait_some_time(n_errors_last_hour):
         time.sleep(min(base_delay * n_errors_last_hour, 1800))
 
 
+def prepare_projects(confs):
+    """Creates delivery streams and ES indices for projects."""
+    for conf in confs:
+        create_delivery_stream(
+            conf.slug, f'{KFEnv.STORAGE_BUCKET_PREFIX}{conf.slug}/')
+        create_index(conf.slug, conf.lang[0], only_new=True)
+
+
+def prepare_new_projects(old, new):
+    prepare_projects(
+        conf for conf in new.covid(TwiEnv.COVID_STREAM_NAME != 'None')
+        if old.get_conf_by_slug(conf.slug) is None)
+
+
 def main():
     setup_logging()
     logger.info('Twitter API v1.1')
@@ -80,8 +101,19 @@ def main():
             KFEnv.UNMATCHED_STREAM_NAME,
             f'{KFEnv.UNMATCHED_STREAM_NAME}/')
     # Create delivery streams and ES indices for the listed projects
-    for conf in config_manager.covid(TwiEnv.COVID_STREAM_NAME != 'None'):
-        create_delivery_stream(
-            conf.slug, f'{KFEnv.STORAGE_BUCKET_PREFIX}{conf.slug}/')
-        create_index(conf.slug, conf.lang[0], only_new=True)
+    prepare_projects(
+        config_manager.covid(TwiEnv.COVID_STREAM_NAME != 'None'))
+    # Pick up config changes without restarting the container
+    config_manager.add_preparer(prepare_new_projects)
+    config_manager.start_polling()
+    if TwiEnv.METRICS_PORT:
+        metrics.start_http_server(TwiEnv.METRICS_PORT)
+    if TwiEnv.METRICS_REPORT_INTERVAL:
+        metrics.start_reporting(TwiEnv.METRICS_REPORT_INTERVAL)
+    if TwiEnv.NUM_PROCESSES == 0:
+        # Spools of worker processes from a previous deploy
+        adopt_orphaned_spools(0)
+    # Flush buffered records when the container is stopped
+    atexit.register(batch_producer.close)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit())
     run()
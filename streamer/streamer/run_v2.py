@@ -1,4 +1,7 @@
+import asyncio
+import atexit
 import logging
+import signal
 import sys
 import os
 import time
@@ -6,12 +9,14 @@ import traceback
 
 from awstools.env import KFEnv
 from awstools.config import config_manager
-from awstools.firehose import create_delivery_stream
+from awstools.firehose import create_delivery_stream, batch_producer
 from awstools.elasticsearch import create_index
 from awstools.llambda import set_s3_triggers
+from awstools.metrics import metrics
 
 from .env import TwiEnv
-from .stream_v2 import StreamManagerFilter
+from .pipeline import adopt_orphaned_spools
+from .stream_v2 import StreamManagerFilter, AsyncStreamManagerFilter
 from .setup_logging import setup_logging
 
 logger = logging.getLogger(__name__)
@@ -29,9 +34,15 @@ def run():
     n_errors_last_hour = 0
     while True:
         logger.debug('Trying to connect to Twitter API.')
-        stream = StreamManagerFilter()
+        if TwiEnv.STREAM_ASYNC == 1:
+            stream = AsyncStreamManagerFilter()
+        else:
+            stream = StreamManagerFilter()
         try:
-            stream.start()
+            if TwiEnv.STREAM_ASYNC == 1:
+                asyncio.run(stream.start())
+            else:
+                stream.start()
         except KeyboardInterrupt:
             logger.info('Shutting down...')
             sys.exit()
@@ -68,6 +79,20 @@ def wait_some_time(n_errors_last_hour):
         time.sleep(min(base_delay * n_errors_last_hour, 1800))
 
 
+def prepare_projects(confs):
+    """Creates delivery streams and ES indices for projects."""
+    for conf in confs:
+        create_delivery_stream(
+            conf.slug, f'{KFEnv.STORAGE_BUCKET_PREFIX}{conf.slug}/')
+        create_index(conf.slug, conf.lang[0], only_new=True)
+
+
+def prepare_new_projects(old, new):
+    prepare_projects(
+        conf for conf in new.covid(TwiEnv.COVID_STREAM_NAME != 'None')
+        if old.get_conf_by_slug(conf.slug) is None)
+
+
 def main():
     setup_logging()
     logger.info('Twitter API v2')
@@ -80,8 +105,18 @@ def main():
             KFEnv.UNMATCHED_STREAM_NAME,
             f'{KFEnv.UNMATCHED_STREAM_NAME}/')
     # Create delivery streams and ES indices for the listed projects
-    for conf in config_manager.covid(TwiEnv.COVID_STREAM_NAME != 'None'):
-        create_delivery_stream(
-            conf.slug, f'{KFEnv.STORAGE_BUCKET_PREFIX}{conf.slug}/')
-        create_index(conf.slug, conf.lang[0], only_new=True)
+    prepare_projects(
+        config_manager.covid(TwiEnv.COVID_STREAM_NAME != 'None'))
+    # Pick up config changes without restarting the container
+    config_manager.add_preparer(prepare_new_projects)
+    config_manager.start_polling()
+    if TwiEnv.METRICS_PORT:
+        metrics.start_http_server(TwiEnv.METRICS_PORT)
+    if TwiEnv.METRICS_REPORT_INTERVAL:
+        metrics.start_reporting(TwiEnv.METRICS_REPORT_INTERVAL)
+    # Spools of v1 worker processes from a previous deploy
+    adopt_orphaned_spools(0)
+    # Flush buffered records when the container is stopped
+    atexit.register(batch_producer.close)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit())
     run()
@@ -1,10 +1,6 @@
 import logging
 import time
 import json
-import traceback
-
-from queue import Queue
-from threading import Thread
 
 import tweepy
 
@@ -12,8 +8,10 @@ from awstools.config import config_manager
 
 from .utils.errors import ERROR_CODES
 from .tasks import handle_tweet
+from .pipeline import Pipeline, ProcessPipeline, get_spill
 from .env import TwiEnv
 from awstools.env import Env
+from awstools.metrics import metrics
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
@@ -27,6 +25,7 @@ class StreamManager():
             consumer_secret=TwiEnv.CONSUMER_SECRET,
             access_token=TwiEnv.OAUTH_TOKEN,
             access_token_secret=TwiEnv.OAUTH_TOKEN_SECRET)
+        self.config_changed = False
 
     def stop(self):
         logger.info('Stopping stream.')
@@ -39,9 +38,23 @@ class StreamManagerFilter(StreamManager):
         logger.info(
             'Starting to track for keywords %s in languages %s.',
             config.keywords, config.lang)
-        self.stream.filter(
-            track=config.keywords, languages=config.lang,
-            stall_warnings=True)
+        config_manager.add_listener(self.reconnect_on_change)
+        try:
+            self.stream.filter(
+                track=config.keywords, languages=config.lang,
+                stall_warnings=True)
+        finally:
+            config_manager.remove_listener(self.reconnect_on_change)
+
+    def reconnect_on_change(self, old, new):
+        """v1.1 filter parameters can't be changed on a running stream.
+        Matching picks up a hot-reloaded config on its own, a new keyword
+        or language list needs a reconnect.
+        """
+        if new.filter_config != old.filter_config:
+            logger.info('Tracked keywords or languages changed. Reconnecting.')
+            self.config_changed = True
+            self.stream.disconnect()
 
 
 class StreamManagerCovid(StreamManager):
@@ -50,33 +63,54 @@ class StreamManagerCovid(StreamManager):
         self.stream.covid(int(TwiEnv.COVID_PARTITION))
 
 
+# v1.1 tweets start with this key, control messages with their type
+TWEET_PREFIX = b'{"created_at"'
+
+
+def handle_raw(data_raw, shed):
+    """Parses a raw tweet line, in a worker. Returns True if the tweet
+    was dropped to shed load.
+    """
+    status = json.loads(data_raw)
+    return handle_tweet(status, config_manager, store_unmatched=not shed)
+
+
+# One pipeline for the whole process, streams are recreated on reconnect
+if TwiEnv.NUM_PROCESSES > 0:
+    pipeline = ProcessPipeline(handle_raw)
+else:
+    pipeline = Pipeline(
+        handle_raw,
+        spill=get_spill(serialize=bytes, deserialize=bytes))
+
+
 class Stream(tweepy.Stream):
     """Handles data received from the stream."""
-    def __init__(self, q=Queue(), *args, **kwargs):
+    def __init__(self, *args, **kwargs):
         # Threads and queues are to avoid IncompleteRead error:
         # https://stackoverflow.com/a/48046123/4949133
         super().__init__(*args, **kwargs)
         self.rate_error_count = 0
-        self.q = q
-        for _ in range(4):
-            thread = Thread(target=self.handle_status)
-            thread.daemon = True
-            thread.start()
+        self.pipeline = pipeline
+        self.received = metrics.counter('tweets_received_total', version='v1')
+
+    def on_data(self, raw_data):
+        """Queues tweets unparsed, so that the reading thread holds the
+        GIL as briefly as possible. Control messages (delete, limit,
+        warning, ...) are rare and left to tweepy.
+        """
+        if isinstance(raw_data, str):
+            raw_data = raw_data.encode()
+        if raw_data.startswith(TWEET_PREFIX):
+            self.received.inc()
+            self.pipeline.put(raw_data)
+            return
+        return super().on_data(raw_data)
 
     def on_status(self, status):
-        # Put to the queue
-        self.q.put(status)
-
-    def handle_status(self):
-        while True:
-            status = self.q.get()
-            try:
-                handle_tweet(status._json, config_manager)
-            except Exception as exc:
-                logger.error(
-                    '%s: %s. Traceback: %s', type(exc).__name__, str(exc),
-                    '; '.join(traceback.format_tb(exc.__traceback__)))
-            self.q.task_done()
+        # A tweet with an unexpected key order
+        self.received.inc()
+        self.pipeline.put(json.dumps(status._json).encode())
 
     def on_request_error(self, status_code):
         if status_code in ERROR_CODES:
@@ -1,16 +1,22 @@
+import asyncio
 import json
 import logging
+import os
 import time
 import traceback
 
 from requests import Response
 
 from tweepy import StreamingClient, StreamRule
+from tweepy.asynchronous import AsyncStreamingClient
 
 from awstools.config import config_manager
+from awstools.firehose import AsyncBatchProducer
+from awstools.metrics import metrics
 
 from .utils.errors import ERROR_CODES
-from .tasks_v2 import handle_response
+from .tasks_v2 import handle_response, prepare_records
+from .pipeline import get_spill
 from .env import TwiEnv
 
 logger = logging.getLogger(__name__)
@@ -67,34 +73,75 @@ class StreamManager():
         self.stream.disconnect()
 
 
-def create_rule(conf):
+def create_rule(conf, prefix=TwiEnv.RULE_TAG_PREFIX):
     rule_keywords = '(' + ' OR '.join(conf.keywords) + ')'
     rule_langs = ' '.join(map(lambda l: f'lang:{l}', conf.lang))
-    return StreamRule(f'{rule_keywords} {rule_langs}', tag=conf.slug)
+    return StreamRule(
+        f'{rule_keywords} {rule_langs}', tag=f'{prefix}{conf.slug}')
+
+
+def sync_rules(client, config, prefix=TwiEnv.RULE_TAG_PREFIX):
+    """Makes the stream rules tagged with ``prefix`` match config. Only the
+    rules that changed are deleted or added, so a running stream doesn't
+    need to reconnect. Rules of other prefixes are left alone; with an
+    empty prefix, all rules of the token's app are managed.
+    """
+    rules = {
+        (rule.value, rule.tag): rule
+        for rule in (create_rule(conf, prefix) for conf in config)}
+    current = [
+        rule for rule in client.get_rules().data or []
+        if (rule.tag or '').startswith(prefix)]
+
+    to_delete = [
+        rule for rule in current if (rule.value, rule.tag) not in rules]
+    current = {(rule.value, rule.tag) for rule in current}
+    to_add = [rule for key, rule in rules.items() if key not in current]
+
+    if to_delete:
+        logger.info(
+            'Deleting outdated rule(s) for %s.',
+            ', '.join(str(rule.tag) for rule in to_delete))
+        client.delete_rules([rule.id for rule in to_delete])
+    if to_add:
+        logger.info(
+            'Adding rule(s) for %s.', ', '.join(rule.tag for rule in to_add))
+        client.add_rules(to_add)
 
 
 class StreamManagerFilter(StreamManager):
     def start(self):
-        rules = []
         for conf in config_manager.config:
             logger.info(
                 'Starting to track for keywords %s in languages %s.',
                 conf.keywords, conf.lang)
-            rules.append(create_rule(conf))
-        self.stream.add_rules(rules)
-        self.stream.filter(
-            expansions=expansions,
-            media_fields=media_fields,
-            place_fields=place_fields,
-            poll_fields=poll_fields,
-            tweet_fields=tweet_fields,
-            user_fields=user_fields,
-            threaded=False
-        )
+        sync_rules(self.stream, config_manager.config)
+        config_manager.add_listener(self.update_rules)
+        try:
+            self.stream.filter(
+                expansions=expansions,
+                media_fields=media_fields,
+                place_fields=place_fields,
+                poll_fields=poll_fields,
+                tweet_fields=tweet_fields,
+                user_fields=user_fields,
+                threaded=False
+            )
+        finally:
+            config_manager.remove_listener(self.update_rules)
+
+    def update_rules(self, old, new):
+        """Applies a hot-reloaded config to the running stream."""
+        # A separate client, the stream's session is busy reading
+        sync_rules(StreamingClient(TwiEnv.BEARER_TOKEN), new.config)
+
+
+received = metrics.counter('tweets_received_total', version='v2')
 
 
 class Stream(StreamingClient):
     def on_data(self, data):
+        received.inc()
         handle_response(data, config_manager)
 
     def on_request_error(self, status_code):
@@ -116,3 +163,148 @@ class Stream(StreamingClient):
     def on_connect(self):
         self.rate_error_count = 0  # Reset error count
         logger.info('Successfully connected to Twitter Streaming API.')
+
+
+class AsyncStreamManagerFilter(StreamManagerFilter):
+    def __init__(self):
+        self.stream = AsyncStream(TwiEnv.BEARER_TOKEN)
+
+    async def start(self):
+        for conf in config_manager.config:
+            logger.info(
+                'Starting to track for keywords %s in languages %s.',
+                conf.keywords, conf.lang)
+        await asyncio.get_running_loop().run_in_executor(
+            None, sync_rules,
+            StreamingClient(TwiEnv.BEARER_TOKEN), config_manager.config)
+        config_manager.add_listener(self.update_rules)
+        try:
+            await self.stream.run(
+                expansions=expansions,
+                media_fields=media_fields,
+                place_fields=place_fields,
+                poll_fields=poll_fields,
+                tweet_fields=tweet_fields,
+                user_fields=user_fields
+            )
+        finally:
+            config_manager.remove_listener(self.update_rules)
+
+
+class AsyncStream(AsyncStreamingClient):
+    """Reading the socket, processing and sending to Firehose are separate
+    coroutines connected by bounded queues, so reading never waits for
+    downstream I/O. What doesn't fit in the queue is spilled to disk and
+    read back once the queue has drained.
+    """
+    def __init__(
+            self, *args,
+            max_size=TwiEnv.QUEUE_MAX_SIZE,
+            drain_timeout=TwiEnv.QUEUE_DRAIN_TIMEOUT,
+            sender=None,
+            **kwargs
+    ):
+        super().__init__(*args, **kwargs)
+        self.max_size = max_size
+        self.drain_timeout = drain_timeout
+        self.spill = get_spill(serialize=bytes, deserialize=bytes)
+        self.sender = sender
+        self.rate_error_count = 0
+
+    async def run(self, **params):
+        self.received = asyncio.Queue(self.max_size)
+        self.records = asyncio.Queue(self.max_size)
+        metrics.gauge(
+            'stream_queue_depth', func=self.received.qsize, queue='received')
+        metrics.gauge(
+            'stream_queue_depth', func=self.records.qsize, queue='records')
+        if self.sender is None:
+            self.sender = AsyncBatchProducer()
+        tasks = [
+            asyncio.ensure_future(coro)
+            for coro in (self.process(), self.send(), self.replay())]
+        try:
+            await self.filter(**params)
+        finally:
+            await self.shutdown(tasks)
+
+    async def shutdown(self, tasks):
+        """Sends what was already received, for at most ``drain_timeout``
+        seconds. The queues can only drain while the processing tasks are
+        running, asyncio.run cancels them on Ctrl-C.
+        """
+        try:
+            if not any(task.done() for task in tasks):
+                await asyncio.wait_for(self._drain(), self.drain_timeout)
+        except asyncio.TimeoutError:
+            logger.warning(
+                'Queues not drained after %g s, dropping %d response(s) '
+                'and %d record(s).', self.drain_timeout,
+                self.received.qsize(), self.records.qsize())
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            try:
+                await asyncio.wait_for(
+                    self.sender.close(), self.drain_timeout)
+            except asyncio.TimeoutError:
+                logger.warning(
+                    'Sender not closed after %g s.', self.drain_timeout)
+
+    async def _drain(self):
+        await self.received.join()
+        await self.records.join()
+
+    async def on_data(self, raw_data):
+        received.inc()
+        try:
+            self.received.put_nowait(raw_data)
+        except asyncio.QueueFull:
+            self.spill.write(raw_data)
+            metrics.counter('stream_spilled_total').inc()
+
+    async def process(self):
+        while True:
+            data_raw = await self.received.get()
+            try:
+                for record in prepare_records(data_raw, config_manager):
+                    await self.records.put(record)
+            except Exception as exc:
+                logger.error(
+                    '%s: %s. Traceback: %s', type(exc).__name__, str(exc),
+                    '; '.join(traceback.format_tb(exc.__traceback__)))
+            self.received.task_done()
+
+    async def send(self):
+        while True:
+            stream_name, record = await self.records.get()
+            try:
+                await self.sender.put(stream_name, record)
+            except Exception as exc:
+                logger.error('%s: %s', type(exc).__name__, str(exc))
+            self.records.task_done()
+
+    async def replay(self):
+        while True:
+            await asyncio.sleep(1)
+            if self.received.qsize() >= self.max_size // 2:
+                continue
+            for path in self.spill.segments():
+                for data_raw in self.spill.read(path):
+                    await self.received.put(data_raw)
+                os.remove(path)
+
+    async def on_request_error(self, status_code):
+        if status_code in ERROR_CODES:
+            logger.error(
+                '%d Error. %s. %s',
+                status_code,
+                ERROR_CODES[status_code]['text'],
+                ERROR_CODES[status_code]['description'])
+        else:
+            logger.error('Unknown %d Error.', status_code)
+
+    async def on_connect(self):
+        self.rate_error_count = 0  # Reset error count
+        logger.info('Successfully connected to Twitter Streaming API.')
@@ -5,11 +5,14 @@ import json
 from twiprocess.processtweet import ProcessTweet
 from awstools.env import Env, KFEnv
 from awstools.config import StorageMode
-from awstools.firehose import firehose, get_stream_name_arn
+from awstools.firehose import batch_producer, get_stream_name_arn
+from awstools.metrics import metrics
 
 from .env import TwiEnv
 from .setup_logging import LogDirs
+from .utils.dedup import is_duplicate
 from .utils.match_keywords import match_keywords
+from .utils.records import Record
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
@@ -17,18 +20,24 @@ logger.setLevel(logging.DEBUG)
 
 def handle_tweet(
         status, config_manager,
-        store_for_testing=False
+        store_for_testing=False,
+        store_unmatched=True
 ):
-    if TwiEnv.COVID_STREAM_NAME != 'None':
-        _ = firehose.put_record(
-            DeliveryStreamName=TwiEnv.COVID_STREAM_NAME,
-            Record={'Data': f'{json.dumps(status)}\n'.encode()})
+    """Sends a status to the streams of the projects it matches. Returns
+    True if it was unmatched and dropped because of ``store_unmatched``.
+    """
+    record = Record(status)
+    if TwiEnv.COVID_STREAM_NAME != 'None' and not is_duplicate(
+            status.get('id'), TwiEnv.COVID_STREAM_NAME):
+        batch_producer.put(TwiEnv.COVID_STREAM_NAME, record.encode())
 
     tweet = ProcessTweet(status)
     status_id = tweet.id
+    # The config can be hot-reloaded, use the same version for the whole tweet
+    config = config_manager.state
     # Reverse match to find project
     matching_keywords = match_keywords(
-        tweet, config_manager.covid(TwiEnv.COVID_STREAM_NAME != 'None'))
+        tweet, config.covid(TwiEnv.COVID_STREAM_NAME != 'None'))
 
     matching_projects = list(matching_keywords.keys())
     if matching_projects == []:
@@ -38,6 +47,11 @@ def handle_tweet(
         logger.debug(
             'Status %s could not be matched against any existing projects.',
             status_id)
+        metrics.counter('tweets_unmatched_total', version='v1').inc()
+        if not store_unmatched:
+            # Shedding load
+            metrics.counter('tweets_dropped_total', reason='shed').inc()
+            return True
         if Env.UNMATCHED_STORE_LOCALLY == 1:
             # Store to a separate file for later analysis
             with open(os.path.join(
@@ -45,10 +59,9 @@ def handle_tweet(
             ), 'w') as f:
                 json.dump(status, f)
         if Env.UNMATCHED_STORE_S3 == 1:
-            _ = firehose.put_record(
-                DeliveryStreamName=f'{KFEnv.APP_NAME}-'
-                                   f'{KFEnv.UNMATCHED_STREAM_NAME}',
-                Record={'Data': f'{json.dumps(status)}\n'.encode()})
+            batch_producer.put(
+                f'{KFEnv.APP_NAME}-{KFEnv.UNMATCHED_STREAM_NAME}',
+                record.encode())
         return
     else:
         logger.debug(
@@ -64,15 +77,12 @@ def handle_tweet(
 
     for slug in matching_projects:
         # Get config
-        conf = config_manager.get_conf_by_slug(slug)
+        conf = config.get_conf_by_slug(slug)
         if conf.storage_mode == StorageMode.TEST_MODE:
             logger.debug('Running in test mode. Not sending to S3.')
+            metrics.counter('tweets_dropped_total', reason='test_mode').inc()
             return
 
-        # Add tracking info
-        status['project'] = slug
-        status['matching_keywords'] = matching_keywords.get(slug)
-
         if conf.storage_mode in [StorageMode.S3, StorageMode.S3_ES,
                                  StorageMode.S3_NO_RETWEETS,
                                  StorageMode.S3_ES_NO_RETWEETS]:
@@ -81,13 +91,21 @@ def handle_tweet(
                 StorageMode.S3_ES_NO_RETWEETS
             ]:
                 # Do not store retweets
+                metrics.counter('tweets_dropped_total', reason='retweet').inc()
                 return
+            if is_duplicate(status_id, slug):
+                logger.debug(
+                    'Status %s was already sent to project %s.',
+                    status_id, slug)
+                continue
             # Send to the corresponding delivery stream
             stream_name, _ = get_stream_name_arn(slug)
-            _ = firehose.put_record(
-                DeliveryStreamName=stream_name,
-                Record={'Data': f'{json.dumps(status)}\n'.encode()})
+            # Add tracking info
+            batch_producer.put(stream_name, record.encode(
+                project=slug,
+                matching_keywords=matching_keywords.get(slug)))
+            metrics.counter('tweets_matched_total', project=slug).inc()
 
             logger.debug(
-                'Pushed processed with id %s to stream %s.',
+                'Queued processed with id %s for stream %s.',
                 status_id, stream_name)
@@ -3,9 +3,13 @@ import logging
 import os
 
 from awstools.config import StorageMode
-from awstools.firehose import firehose, get_stream_name_arn
+from awstools.firehose import batch_producer, get_stream_name_arn
+from awstools.metrics import metrics
 
+from .env import TwiEnv
 from .setup_logging import LogDirs
+from .utils.dedup import is_duplicate
+from .utils.records import Record, scan_response
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
@@ -20,14 +24,39 @@ def is_retweet(data):
     return False
 
 
+def rule_slugs(matching_rules, prefix=TwiEnv.RULE_TAG_PREFIX):
+    """Project slugs of the matching rules of this deployment."""
+    return [
+        rule['tag'][len(prefix):] for rule in matching_rules
+        if rule.get('tag') is not None and rule['tag'].startswith(prefix)]
+
+
 def handle_response(
         data_raw, config_manager,
         store_for_testing=False
-):  
-    data = json.loads(data_raw)
+):
+    for stream_name, record in prepare_records(
+            data_raw, config_manager, store_for_testing):
+        batch_producer.put(stream_name, record)
+
+
+def prepare_records(
+        data_raw, config_manager,
+        store_for_testing=False
+):
+    """Returns a list of (delivery stream name, record) for a response."""
+    records = []
+    data = scan_response(data_raw) if TwiEnv.PASSTHROUGH == 1 else None
+    if data is not None:
+        # Only 'data' and 'matching_rules' are parsed, the payload
+        # is forwarded as received
+        record = Record.from_raw(data_raw, data)
+    else:
+        data = json.loads(data_raw)
+        record = Record(data)
     tweet_id = data.get('data', {}).get('id')
-    matching_rules = list(map(lambda x: x.get('tag'), data.get('matching_rules')))
-    
+    matching_rules = rule_slugs(data.get('matching_rules'))
+
     logger.debug(
         'SUCCESS: Found %d project(s) %s that match this tweet.',
         len(matching_rules), matching_rules)
@@ -36,34 +65,45 @@ def handle_response(
         # Store for testing
         with open(os.path.join(
                 LogDirs.MATCH_TEST.value, f"{tweet_id}.json"
-        ), 'w') as f:
-            json.dump(data, f)
+        ), 'wb') as f:
+            f.write(record.body)
 
+    config = config_manager.state
     for slug in matching_rules:
         # Get config
-        conf = config_manager.get_conf_by_slug(slug)
+        conf = config.get_conf_by_slug(slug)
+        if conf is None:
+            # Rules and config are out of sync while a new config is applied
+            logger.warning('No config for rule tag %s. Skipping.', slug)
+            metrics.counter('tweets_dropped_total', reason='no_config').inc()
+            continue
         if conf.storage_mode == StorageMode.TEST_MODE:
             logger.debug('Running in test mode. Not sending to S3.')
-            return
-
-        # Add tracking info
-        data['project'] = slug
+            metrics.counter('tweets_dropped_total', reason='test_mode').inc()
+            return records
 
         if conf.storage_mode in [StorageMode.S3, StorageMode.S3_ES,
                                  StorageMode.S3_NO_RETWEETS,
                                  StorageMode.S3_ES_NO_RETWEETS]:
-            if is_retweet(data) and conf.storage_mode in [
+            if is_retweet(data.get('data', {})) and conf.storage_mode in [
                 StorageMode.S3_NO_RETWEETS,
                 StorageMode.S3_ES_NO_RETWEETS
             ]:
                 # Do not store retweets
-                return
+                metrics.counter('tweets_dropped_total', reason='retweet').inc()
+                return records
+            if is_duplicate(tweet_id, slug):
+                logger.debug(
+                    'Tweet %s was already sent to project %s.',
+                    tweet_id, slug)
+                continue
             # Send to the corresponding delivery stream
             stream_name, _ = get_stream_name_arn(slug)
-            _ = firehose.put_record(
-                DeliveryStreamName=stream_name,
-                Record={'Data': f'{json.dumps(data)}\n'.encode()})
+            # Add tracking info
+            records.append((stream_name, record.encode(project=slug)))
+            metrics.counter('tweets_matched_total', project=slug).inc()
 
             logger.debug(
-                'Pushed processed with id %s to stream %s.',
+                'Queued processed with id %s for stream %s.',
                 tweet_id, stream_name)
+    return records
@@ -0,0 +1,143 @@
+"""
+Drops tweets that were already sent to a project, e.g. when the stream
+replays tweets after a reconnect.
+
+Sent (tweet id, project) keys are remembered in a pair of Bloom filters.
+New keys go into the current filter, which replaces the previous one
+every ``window`` seconds, so a key is remembered for at least ``window``
+and at most 2 * ``window`` seconds in fixed memory. A false positive
+drops a tweet that wasn't sent yet. A lookup checks both filters, each
+sized for ``error_rate`` / 2, so the rate stays below ``error_rate`` as
+long as at most ``capacity`` keys are added per window. Above that it
+rises quickly; the estimated rate is exported as a gauge.
+
+Each process has its own filters: with worker processes, a replayed
+tweet handled by another process than the original isn't detected.
+"""
+
+import logging
+import math
+import threading
+import time
+from hashlib import blake2b
+
+from awstools.metrics import metrics
+
+from ..env import TwiEnv
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+class RotatingBloomFilter:
+    def __init__(
+            self,
+            window=TwiEnv.DEDUP_WINDOW,
+            capacity=TwiEnv.DEDUP_CAPACITY,
+            error_rate=TwiEnv.DEDUP_ERROR_RATE,
+            clock=time.monotonic
+    ):
+        self.window = window
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.clock = clock
+        # Optimal number of bits and hash functions per filter
+        self.num_bits = max(int(math.ceil(
+            -capacity * math.log(error_rate / 2) / math.log(2) ** 2)), 8)
+        self.num_hashes = max(int(round(
+            self.num_bits / capacity * math.log(2))), 1)
+        self._current = bytearray((self.num_bits + 7) // 8)
+        self._previous = bytearray(len(self._current))
+        self._current_keys = 0
+        self._previous_keys = 0
+        self._warned = False
+        self._rotated_at = clock()
+        self._lock = threading.Lock()
+
+    def add(self, key):
+        """Adds a key, returns True if it was already there."""
+        positions = self._positions(key)
+        with self._lock:
+            # After an idle gap of two windows, both filters are outdated
+            elapsed = self.clock() - self._rotated_at
+            for _ in range(min(int(elapsed // self.window), 2)):
+                self._rotate()
+            if self._contains(self._current, positions):
+                return True
+            if self._contains(self._previous, positions):
+                # Keep it for another window
+                self._set(positions)
+                return True
+            self._set(positions)
+            if not self._warned and self.keys >= self.capacity:
+                rate = self.false_positive_rate()
+                if rate > self.error_rate:
+                    self._warned = True
+                    logger.warning(
+                        'Deduplication filters hold %d keys, for a capacity '
+                        'of %d per window. Estimated false positive rate '
+                        '%.2g, above %.2g.',
+                        self.keys, self.capacity, rate, self.error_rate)
+            return False
+
+    @property
+    def keys(self):
+        """Keys held in the current and the previous filter, a key kept
+        for another window counts in both.
+        """
+        return self._current_keys + self._previous_keys
+
+    def false_positive_rate(self):
+        """Estimated probability that a new key is taken for a sent one."""
+        miss = 1.
+        for keys in (self._current_keys, self._previous_keys):
+            fill = 1 - math.exp(-self.num_hashes * keys / self.num_bits)
+            miss *= 1 - fill ** self.num_hashes
+        return 1 - miss
+
+    def _positions(self, key):
+        digest = blake2b(key, digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    @staticmethod
+    def _contains(bits, positions):
+        for position in positions:
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def _set(self, positions):
+        for position in positions:
+            self._current[position >> 3] |= 1 << (position & 7)
+        self._current_keys += 1
+
+    def _rotate(self):
+        self._previous = self._current
+        self._current = bytearray(len(self._previous))
+        self._rotated_at = self.clock()
+        self._previous_keys = self._current_keys
+        self._current_keys = 0
+        self._warned = False
+
+
+# None if deduplication is disabled
+recently_sent = RotatingBloomFilter() if TwiEnv.DEDUP_WINDOW > 0 else None
+if recently_sent is not None:
+    metrics.gauge('dedup_window_keys', func=lambda: recently_sent.keys)
+    metrics.gauge(
+        'dedup_false_positive_rate',
+        func=recently_sent.false_positive_rate)
+
+
+def is_duplicate(tweet_id, slug):
+    """True if the tweet was already sent to the project recently.
+    Otherwise it is remembered as sent.
+    """
+    if recently_sent is None or tweet_id is None:
+        return False
+    if recently_sent.add(f'{tweet_id}:{slug}'.encode()):
+        metrics.counter('tweets_dropped_total', reason='duplicate').inc()
+        return True
+    return False
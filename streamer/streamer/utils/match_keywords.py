@@ -4,44 +4,143 @@ keyword lists and languages.
 """
 
 import logging
-import re
-from collections import defaultdict
+import time
+from collections import deque
+
+from awstools.metrics import metrics
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
+_match_seconds = metrics.histogram('match_keywords_seconds')
+
+
+class Automaton:
+    """Aho-Corasick automaton that finds all given words in a text
+    in a single pass.
+    """
+    def __init__(self, words):
+        # Trie
+        self._goto = [{}]
+        self._out = [set()]
+        for word in words:
+            node = 0
+            for char in word:
+                if char not in self._goto[node]:
+                    self._goto.append({})
+                    self._out.append(set())
+                    self._goto[node][char] = len(self._goto) - 1
+                node = self._goto[node][char]
+            self._out[node].add(word)
+
+        # Failure links, resolved into full transitions so that the scan
+        # is a single dict lookup per character
+        alphabet = {char for word in words for char in word}
+        fail = [0] * len(self._goto)
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self._goto[node].items():
+                queue.append(child)
+                state = fail[node]
+                while state and char not in self._goto[state]:
+                    state = fail[state]
+                fail[child] = self._goto[state].get(char, 0)
+                self._out[child] |= self._out[fail[child]]
+        queue = deque([0])
+        while queue:
+            node = queue.popleft()
+            children = list(self._goto[node].values())
+            for char in alphabet:
+                if char not in self._goto[node] and node != 0:
+                    state = self._goto[fail[node]].get(char, 0)
+                    if state:
+                        self._goto[node][char] = state
+            queue.extend(children)
+        self._out = [frozenset(out) for out in self._out]
+
+    def find(self, text):
+        """Returns the set of words contained in text."""
+        goto = self._goto
+        out = self._out
+        found = set()
+        node = 0
+        for char in text:
+            node = goto[node].get(char, 0)
+            if out[node]:
+                found.update(out[node])
+        return found
+
+
+class KeywordMatcher:
+    """Keywords of all projects in config, compiled once.
+
+    A single-word keyword matches if it is a substring of the text,
+    a multi-word keyword matches if all of its words are.
+    """
+    def __init__(self, config):
+        self.config = tuple(config)
+        self._projects = []
+        self._keywords_by_word = {}
+        for i, conf in enumerate(self.config):
+            keywords = []
+            for keyword in conf.keywords:
+                keyword_list = keyword.lower().split()
+                if len(keyword_list) == 0:
+                    continue
+                for word in set(keyword_list):
+                    self._keywords_by_word.setdefault(word, []).append(
+                        (i, len(keywords)))
+                keywords.append((' '.join(keyword_list), set(keyword_list)))
+            self._projects.append((conf.slug, set(conf.lang), keywords))
+        self._automaton = Automaton(self._keywords_by_word)
+
+    def match(self, tweet):
+        """Returns a dict of slugs with the lists of matching keywords."""
+        found = self._automaton.find(tweet.keyword_matching_text)
+        candidates = set()
+        for word in found:
+            candidates.update(self._keywords_by_word[word])
+
+        matching_keywords = {}
+        for i, j in sorted(candidates):
+            slug, lang, keywords = self._projects[i]
+            # Filter by language setting
+            if not (tweet.lang in lang or
+                    len(lang) == 0 or tweet.lang == 'und'):
+                continue
+            keyword, words = keywords[j]
+            if words <= found:
+                matching_keywords.setdefault(slug, []).append(keyword)
+        return matching_keywords
+
+
+_compiled = None
+
 
 def match_keywords(tweet, config):
-    """For each project in config, match project keywords with text."""
-    matching_keywords = defaultdict(list)
-    for conf in config:
-        matching_keywords = {
-            **matching_keywords,
-            **_match_to_conf_keywords(tweet, conf)}
+    """For each project in config, match project keywords with text.
+
+    Config is either a list of project configs or a compiled
+    ``KeywordMatcher``. A list is compiled on first use and the result is
+    reused for as long as the same configs are passed.
+    """
+    start = time.perf_counter()
+    if not isinstance(config, KeywordMatcher):
+        config = _get_matcher(config)
+    matching_keywords = config.match(tweet)
+    _match_seconds.observe(time.perf_counter() - start)
     return matching_keywords
 
 
-def _match_to_conf_keywords(tweet, conf):
-    """Match project keywords with text."""
-    # Filter by language setting
-    if tweet.lang in conf.lang or \
-            len(conf.lang) == 0 or tweet.lang == 'und':
-        matching_keywords = defaultdict(list)
-        keywords = [kw.lower().split() for kw in conf.keywords]
-        for keyword_list in keywords:
-            if len(keyword_list) == 1:
-                if keyword_list[0] in tweet.keyword_matching_text:
-                    matching_keywords[conf.slug].append(
-                        keyword_list[0])
-            else:
-                # Keywords with more than one word:
-                # Check if all words are contained in text
-                match_result = re.findall(
-                    r'{}'.format(
-                        '|'.join(keyword_list)), tweet.keyword_matching_text)
-                if set(match_result) == set(keyword_list):
-                    matching_keywords[conf.slug].append(
-                        ' '.join(keyword_list))
-        return matching_keywords
-    else:
-        return {}
+def _get_matcher(config):
+    global _compiled
+    config = tuple(config)
+    matcher = _compiled
+    if matcher is None or len(matcher.config) != len(config) or any(
+            old is not new for old, new in zip(matcher.config, config)):
+        matcher = KeywordMatcher(config)
+        _compiled = matcher
+        logger.debug(
+            'Compiled keywords for %d project(s).', len(matcher.config))
+    return matcher
@@ -0,0 +1,93 @@
+"""
+Encodes tweets as Firehose JSONL records.
+
+A tweet is serialized once, the small per-project fields are spliced into
+the serialized bytes. With the default json backend the output is identical
+to ``json.dumps`` of the tweet with the fields added.
+"""
+
+import json
+
+from ..env import TwiEnv
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+if TwiEnv.JSON_BACKEND == 'orjson' and orjson is not None:
+    dumps = orjson.dumps
+    ITEM_SEPARATOR, KEY_SEPARATOR = b',', b':'
+else:
+    def dumps(obj):
+        return json.dumps(obj).encode()
+    ITEM_SEPARATOR, KEY_SEPARATOR = b', ', b': '
+
+
+def encode_record(body, **fields):
+    """Appends fields to a serialized JSON object and terminates the line."""
+    if not fields:
+        return body + b'\n'
+    extra = ITEM_SEPARATOR.join(
+        dumps(key) + KEY_SEPARATOR + dumps(value)
+        for key, value in fields.items())
+    if body.strip() == b'{}':
+        return b'{' + extra + b'}\n'
+    return body[:body.rindex(b'}')] + ITEM_SEPARATOR + extra + b'}\n'
+
+
+def scan_response(data_raw):
+    """Parses only the 'data' object and the 'matching_rules' list of a v2
+    stream response, skipping 'includes', which holds most of the payload.
+    Returns None if the response doesn't have the expected layout.
+    """
+    text = data_raw.decode('utf-8') if isinstance(data_raw, bytes) \
+        else data_raw
+    text = text.strip()
+    # Twitter sends 'data' first and 'matching_rules' last
+    if not text.startswith('{"data"'):
+        return
+    try:
+        data = _decode_value(text, len('{"data"'))
+        matching_rules = _decode_value(
+            text, text.rindex('"matching_rules"') + len('"matching_rules"'))
+    except ValueError:
+        return
+    if not isinstance(data, dict) or not isinstance(matching_rules, list):
+        return
+    return {'data': data, 'matching_rules': matching_rules}
+
+
+_decoder = json.JSONDecoder()
+
+
+def _decode_value(text, index):
+    """Decodes the JSON value after the colon following index."""
+    index = text.index(':', index) + 1
+    while text[index] in ' \t\r\n':
+        index += 1
+    return _decoder.raw_decode(text, index)[0]
+
+
+class Record:
+    """A tweet that is serialized at most once."""
+    def __init__(self, obj, body=None):
+        self.obj = obj
+        self._body = body
+
+    @classmethod
+    def from_raw(cls, data_raw, obj=None):
+        """A record that forwards already serialized bytes."""
+        if isinstance(data_raw, str):
+            data_raw = data_raw.encode()
+        return cls(obj, data_raw.strip())
+
+    @property
+    def body(self):
+        if self._body is None:
+            self._body = dumps(self.obj)
+        return self._body
+
+    def encode(self, **fields):
+        return encode_record(self.body, **fields)
@@ -0,0 +1,405 @@
+"""
+Streamer throughput benchmark
+=============================
+
+Replays a tweet corpus through the streamer with in-process stand-ins for
+Firehose and S3 and reports tweets/s, per-tweet latency and peak RSS.
+
+    python benchmark.py --mode v1-handle --n-tweets 20000
+    python benchmark.py --mode v2-stream --corpus recorded_v2.jsonl
+    python benchmark.py --mode es-cached --n-tweets 10000
+
+Modes:
+  v1-handle  tasks.handle_tweet on v1.1 status dicts
+  v1-stream  stream.Stream.on_data on raw v1.1 lines (reader + workers,
+             worker processes with NUM_PROCESSES > 0)
+  v2-handle  tasks_v2.handle_response on raw v2 lines
+  v2-stream  stream_v2.Stream.on_data on raw v2 lines
+  es-uncached  s3_to_es.statuses_to_es on chunks of ES_LOAD_CHUNK_SIZE
+               statuses, calling the geocoder for every location
+  es-cached    the same, through the geocoding cache
+
+In the es modes latencies are per chunk and the geocoder is a stand-in
+that takes --geocode-latency seconds per lookup.
+
+A recorded corpus is a JSONL file of raw stream lines of the matching API
+version. Without one, a corpus is generated (see --n-projects,
+--n-tweets, --match-rate).
+"""
+
+import argparse
+import io
+import json
+import os
+import random
+import resource
+import string
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+# Tells spawned worker processes which fakes to install
+FAKES_ENV = 'BENCHMARK_FAKES'
+
+
+class FakeFirehose:
+    """Stand-in for the boto3 Firehose client, counts what it receives.
+    With a ``log_path``, each call is also logged there, for the parent to
+    count what worker processes sent.
+    """
+    def __init__(self, latency=0., log_path=None):
+        self.latency = latency
+        self.records = 0
+        self.bytes = 0
+        self.calls = 0
+        self._lock = threading.Lock()
+        self._log = None
+        if log_path is not None:
+            self._log = os.open(
+                log_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+
+    def put_record(self, DeliveryStreamName, Record):
+        return self.put_record_batch(DeliveryStreamName, [Record])
+
+    def put_record_batch(self, DeliveryStreamName, Records):
+        time.sleep(self.latency)
+        size = sum(len(record['Data']) for record in Records)
+        with self._lock:
+            self.calls += 1
+            self.records += len(Records)
+            self.bytes += size
+        if self._log is not None:
+            os.write(self._log, f'{len(Records)} {size}\n'.encode())
+        return {
+            'FailedPutCount': 0,
+            'RequestResponses': [{'RecordId': '0'} for _ in Records]}
+
+
+class FakeS3:
+    """Stand-in for the boto3 S3 client, serves objects from a dict."""
+    def __init__(self, objects):
+        self.objects = objects
+
+    def get_object(self, Bucket, Key, **kwargs):
+        return {
+            'Body': io.BytesIO(self.objects[Key]),
+            'ETag': '"0"', 'VersionId': None}
+
+
+class FakeGeocode:
+    """Stand-in for the geocoder, counts lookups."""
+    def __init__(self, latency=0.):
+        self.latency = latency
+        self.lookups = 0
+
+    def decode(self, input_string):
+        time.sleep(self.latency)
+        self.lookups += 1
+        return []
+
+
+def install_fakes(stream_config, latency, log_path=None):
+    """Replaces the AWS clients in awstools.session. Must run before any
+    other awstools module is imported.
+    """
+    from awstools import session
+    from awstools.env import AWSEnv
+
+    session.firehose = FakeFirehose(latency, log_path)
+    session.s3 = FakeS3({
+        AWSEnv.STREAM_CONFIG_S3_KEY: json.dumps(stream_config).encode()})
+    return session.firehose
+
+
+def read_worker_log(path):
+    """Sums the calls logged by the fakes of worker processes."""
+    records = size = calls = 0
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                n, nbytes = line.split()
+                records += int(n)
+                size += int(nbytes)
+                calls += 1
+    return records, size, calls
+
+
+if __name__ == '__mp_main__' and FAKES_ENV in os.environ:
+    # Worker processes are spawned, and import this script again before
+    # the target, and so before any awstools module
+    _fakes = json.loads(os.environ[FAKES_ENV])
+    with open(_fakes['stream_config_path']) as f:
+        install_fakes(json.load(f), _fakes['latency'], _fakes['log_path'])
+
+
+def random_word(rng):
+    return ''.join(rng.choices(string.ascii_lowercase, k=rng.randint(3, 9)))
+
+
+def generate_config(rng, n_projects, n_keywords):
+    return [{
+        'keywords': [
+            ' '.join(random_word(rng) for _ in range(rng.choice([1, 1, 2])))
+            for _ in range(n_keywords)],
+        'lang': ['en'],
+        'locales': ['en'],
+        'slug': f'project_{i}',
+        'es_index_name': f'project_{i}',
+        'storage_mode': rng.choice(['s3', 's3-es', 's3-es-no-retweets']),
+        'image_storage_mode': 'inactive',
+        'model_endpoints': None,
+        'covid': False,
+        'auto_mturking': False,
+        'tweets_per_batch': None
+    } for i in range(n_projects)]
+
+
+def generate_text(rng, keywords, match_rate):
+    words = [random_word(rng) for _ in range(rng.randint(8, 40))]
+    if rng.random() < match_rate:
+        words.insert(rng.randrange(len(words)), rng.choice(keywords))
+    return ' '.join(words)
+
+
+def generate_v1(rng, config, n_tweets, match_rate):
+    keywords = [kw for conf in config for kw in conf['keywords']]
+    created_at = datetime(2021, 1, 1)
+    for i in range(n_tweets):
+        created_at += timedelta(milliseconds=rng.randint(1, 50))
+        user = {
+            'id': rng.randint(10**6, 10**9),
+            'id_str': str(rng.randint(10**6, 10**9)),
+            'name': random_word(rng), 'screen_name': random_word(rng),
+            'location': rng.choice(['London', 'USA', 'Lagos, Nigeria', None]),
+            'description': generate_text(rng, keywords, 0),
+            'followers_count': rng.randint(0, 10**5),
+        }
+        status = {
+            'created_at': created_at.strftime('%a %b %d %H:%M:%S +0000 %Y'),
+            'id': 10**18 + i, 'id_str': str(10**18 + i),
+            'text': generate_text(rng, keywords, match_rate),
+            'in_reply_to_status_id': None, 'in_reply_to_user_id': None,
+            'user': user, 'lang': 'en', 'coordinates': None, 'place': None,
+            'entities': {'hashtags': [], 'urls': [], 'user_mentions': []},
+            'is_quote_status': False, 'retweet_count': 0,
+        }
+        if rng.random() < 0.5:
+            status['retweeted_status'] = dict(
+                status, id=10**17 + i, id_str=str(10**17 + i))
+        yield json.dumps(status, separators=(',', ':')).encode()
+
+
+def generate_v2(rng, config, n_tweets, match_rate):
+    """The API only sends tweets that matched a rule, the rest carry the
+    tag of a rule without a project in the config and are dropped.
+    """
+    for i, line in enumerate(generate_v1(rng, config, n_tweets, match_rate)):
+        status = json.loads(line)
+        data = {
+            'id': status['id_str'], 'text': status['text'],
+            'author_id': status['user']['id_str'], 'lang': 'en',
+            'created_at': '2021-01-01T00:00:00.000Z',
+            'entities': status['entities'],
+        }
+        if 'retweeted_status' in status:
+            data['referenced_tweets'] = [
+                {'type': 'retweeted', 'id': str(10**17 + i)}]
+        text = f" {status['text']} "
+        if any(f' {kw} ' in text
+               for conf in config for kw in conf['keywords']):
+            slugs = rng.sample(
+                [conf['slug'] for conf in config],
+                1 if rng.random() < 0.8 else min(3, len(config)))
+        else:
+            slugs = ['unconfigured-project']
+        yield json.dumps({
+            'data': data,
+            'includes': {'users': [status['user']] * 3, 'tweets': [data] * 2},
+            'matching_rules': [
+                {'id': str(j), 'tag': slug} for j, slug in enumerate(slugs)]
+        }, separators=(',', ':')).encode()
+
+
+def load_corpus(path):
+    with open(path, 'rb') as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(int(len(values) * q), len(values) - 1)]
+
+
+def chunks(items, size):
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def fake_predictions(size, rng):
+    from awstools.s3_to_es import Predictions
+
+    labels = ['positive', 'negative', 'neutral']
+    predictions = Predictions(size)
+    for run_name in ['run_a', 'run_b']:
+        outputs = []
+        for _ in range(size):
+            probabilities = [rng.random() for _ in labels]
+            outputs.append({
+                'labels': labels, 'label_vals': [1, -1, 0],
+                'probabilities': probabilities})
+        predictions.add(
+            'sentiment', run_name, outputs, primary=run_name == 'run_a')
+    return predictions
+
+
+def run(mode, corpus, firehose, geocode_latency=0., worker_log=None):
+    from awstools.config import config_manager
+    from awstools.firehose import batch_producer
+
+    geocoder = None
+    if mode.startswith('es'):
+        from awstools import s3_to_es
+        from awstools.env import ESEnv
+        from awstools.geo import CachedGeocode
+        geocoder = FakeGeocode(geocode_latency)
+        s3_to_es.geo_code = geocoder
+        if mode == 'es-cached':
+            s3_to_es.geo_code = CachedGeocode(geocoder)
+        statuses = [json.loads(line) for line in corpus]
+        rng = random.Random(0)
+        items = [
+            (chunk, fake_predictions(len(chunk), rng))
+            for chunk in chunks(statuses, ESEnv.LOAD_CHUNK_SIZE)]
+
+        def call(item):
+            s3_to_es.statuses_to_es(*item)
+    elif mode == 'v1-handle':
+        from streamer.tasks import handle_tweet
+        items = [json.loads(line) for line in corpus]
+
+        def call(status):
+            handle_tweet(status, config_manager)
+    elif mode == 'v1-stream':
+        from streamer.stream import Stream
+        stream = Stream('', '', '', '')
+        call = stream.on_data
+        items = corpus
+    elif mode == 'v2-handle':
+        from streamer.tasks_v2 import handle_response
+        items = corpus
+
+        def call(data_raw):
+            handle_response(data_raw, config_manager)
+    elif mode == 'v2-stream':
+        from streamer.stream_v2 import Stream
+        stream = Stream('')
+        call = stream.on_data
+        items = corpus
+    else:
+        raise ValueError(f'Unknown mode {mode}.')
+
+    latencies = []
+    start = time.perf_counter()
+    for item in items:
+        t = time.perf_counter()
+        call(item)
+        latencies.append(time.perf_counter() - t)
+    records, size, calls = 0, 0, 0
+    if mode == 'v1-stream':
+        from streamer.pipeline import ProcessPipeline
+        if isinstance(stream.pipeline, ProcessPipeline):
+            # The worker processes flush their producers when stopped
+            stream.pipeline.join()
+            stream.pipeline.close()
+            records, size, calls = read_worker_log(worker_log)
+        else:
+            # Wait for the workers
+            stream.pipeline.q.join()
+    batch_producer.flush()
+    elapsed = time.perf_counter() - start
+    records += firehose.records
+    size += firehose.bytes
+    calls += firehose.calls
+
+    result = {
+        'mode': mode,
+        'tweets': len(corpus),
+        'tweets_per_s': round(len(corpus) / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 4),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 4),
+        'firehose_records': records,
+        'firehose_calls': calls,
+        'firehose_mb': round(size / 2**20, 2),
+        'peak_rss_mb': round(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+    if geocoder is not None:
+        result['geocode_lookups'] = geocoder.lookups
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument(
+        '--mode', default='v1-handle',
+        choices=[
+            'v1-handle', 'v1-stream', 'v2-handle', 'v2-stream',
+            'es-uncached', 'es-cached'])
+    parser.add_argument(
+        '--corpus', type=str, default=None,
+        help='JSONL file of recorded raw stream lines')
+    parser.add_argument(
+        '--stream-config', type=str, default=None,
+        help='stream.json to use instead of a generated one')
+    parser.add_argument('--n-tweets', type=int, default=10000)
+    parser.add_argument('--n-projects', type=int, default=20)
+    parser.add_argument(
+        '--n-keywords', type=int, default=20,
+        help='keywords per generated project')
+    parser.add_argument(
+        '--match-rate', type=float, default=0.7,
+        help='share of generated v1 tweets containing a keyword')
+    parser.add_argument(
+        '--firehose-latency', type=float, default=0.,
+        help='seconds each fake Firehose call takes')
+    parser.add_argument(
+        '--geocode-latency', type=float, default=0.0001,
+        help='seconds each fake geocoder lookup takes')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    if args.stream_config:
+        with open(args.stream_config) as f:
+            stream_config = json.load(f)
+    else:
+        stream_config = generate_config(rng, args.n_projects, args.n_keywords)
+
+    firehose = install_fakes(stream_config, args.firehose_latency)
+    # For the worker processes of v1-stream
+    fakes_dir = tempfile.mkdtemp(prefix='benchmark-')
+    stream_config_path = os.path.join(fakes_dir, 'stream.json')
+    with open(stream_config_path, 'w') as f:
+        json.dump(stream_config, f)
+    worker_log = os.path.join(fakes_dir, 'firehose.log')
+    os.environ[FAKES_ENV] = json.dumps({
+        'stream_config_path': stream_config_path,
+        'latency': args.firehose_latency,
+        'log_path': worker_log})
+
+    if args.corpus:
+        corpus = load_corpus(args.corpus)
+    elif not args.mode.startswith('v2'):
+        corpus = list(generate_v1(
+            rng, stream_config, args.n_tweets, args.match_rate))
+    else:
+        corpus = list(generate_v2(
+            rng, stream_config, args.n_tweets, args.match_rate))
+
+    print(json.dumps(run(
+        args.mode, corpus, firehose, args.geocode_latency, worker_log),
+        indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,192 @@
+import io
+import json
+
+import pytest
+from botocore.exceptions import ClientError
+
+from awstools.config import ConfigManager, ConfigState, StorageMode
+
+
+def project(slug, keywords):
+    return {
+        'keywords': keywords, 'lang': ['en'], 'locales': ['en'],
+        'slug': slug, 'es_index_name': slug, 'storage_mode': 's3',
+        'image_storage_mode': 'inactive', 'model_endpoints': None,
+        'covid': False, 'auto_mturking': False, 'tweets_per_batch': None}
+
+
+class FakeS3:
+    def __init__(self, config):
+        self.put(config, '"1"')
+        self.calls = 0
+
+    def put(self, config, etag):
+        self.body = json.dumps(config).encode()
+        self.etag = etag
+
+    def get_object(self, Bucket, Key, IfNoneMatch=None, **kwargs):
+        self.calls += 1
+        if IfNoneMatch == self.etag:
+            raise ClientError(
+                {'Error': {'Code': '304', 'Message': 'Not Modified'}},
+                'GetObject')
+        return {
+            'Body': io.BytesIO(self.body), 'ETag': self.etag,
+            'VersionId': self.etag}
+
+
+def test_reload_etag_unchanged():
+    s3 = FakeS3([project('a', ['apple'])])
+    manager = ConfigManager(s3_client=s3)
+    state = manager.state
+    changes = []
+    manager.add_listener(lambda old, new: changes.append(new))
+
+    assert not manager.reload()
+    assert manager.state is state
+    assert s3.calls == 2
+    assert changes == []
+
+
+def test_reload_config_unchanged():
+    s3 = FakeS3([project('a', ['apple'])])
+    manager = ConfigManager(s3_client=s3)
+    state = manager.state
+    changes = []
+    manager.add_listener(lambda old, new: changes.append(new))
+
+    # Rewritten with the same content
+    s3.put([project('a', ['apple'])], '"2"')
+    assert not manager.reload()
+    assert manager.state is state
+    assert (state.etag, state.version_id) == ('"2"', '"2"')
+    assert changes == []
+
+    # The next poll is a conditional GET with the new ETag
+    assert not manager.reload()
+    assert manager.state is state
+
+
+def test_reload_changed():
+    s3 = FakeS3([project('a', ['apple'])])
+    manager = ConfigManager(s3_client=s3)
+    calls = []
+    manager.add_preparer(lambda old, new: calls.append(
+        ('prepare', manager.state is old)))
+    manager.add_listener(lambda old, new: calls.append(
+        ('listen', manager.state is new)))
+
+    s3.put([project('a', ['apple']), project('b', ['banana'])], '"2"')
+    assert manager.reload()
+    assert manager.get_conf_by_slug('b').keywords == ['banana']
+    # Prepared before the swap, listeners after it
+    assert calls == [('prepare', True), ('listen', True)]
+
+
+def test_reload_preparer_failure():
+    s3 = FakeS3([project('a', ['apple'])])
+    manager = ConfigManager(s3_client=s3)
+    state = manager.state
+    failures = [RuntimeError('Delivery stream not ready.')]
+
+    def prepare(old, new):
+        if failures:
+            raise failures.pop()
+
+    manager.add_preparer(prepare)
+    s3.put([project('b', ['banana'])], '"2"')
+    assert not manager.reload()
+    assert manager.state is state
+
+    # Retried on the next reload
+    assert manager.reload()
+    assert manager.get_conf_by_slug('b') is not None
+
+
+def test_reload_listener_failure():
+    s3 = FakeS3([project('a', ['apple'])])
+    manager = ConfigManager(s3_client=s3)
+    calls = []
+
+    def fail(old, new):
+        raise RuntimeError('Listener failed.')
+
+    manager.add_listener(fail)
+    manager.add_listener(lambda old, new: calls.append(new))
+    s3.put([project('b', ['banana'])], '"2"')
+    assert manager.reload()
+    # The other listeners still run
+    assert calls == [manager.state]
+
+
+def test_manager_with_state_only_changes_on_apply():
+    s3 = FakeS3([project('a', ['apple'])])
+    state = ConfigState([project('a', ['apple'])])
+    manager = ConfigManager(s3_client=s3, state=state)
+    assert s3.calls == 0
+    assert manager.state is state
+
+    calls = []
+    manager.add_preparer(lambda old, new: calls.append('prepare'))
+    assert not manager.apply(ConfigState([project('a', ['apple'])]))
+    assert manager.apply(ConfigState([project('b', ['banana'])]))
+    assert manager.get_conf_by_slug('b') is not None
+    assert calls == ['prepare']
+    assert s3.calls == 0
+
+
+def state_config():
+    """Covid and non-covid projects, every storage mode, out of order."""
+    modes = ['s3', 's3-es', 's3-no-retweets', 's3-es-no-retweets', 'test-mode']
+    raw = []
+    for i, mode in enumerate(modes):
+        for covid in (True, False):
+            conf = project(f'{mode}-{covid}-{i}'[::-1], [mode, f'kw{i}'])
+            conf.update(
+                storage_mode=mode, covid=covid, lang=['en', f'l{i % 2}'])
+            raw.append(conf)
+    return raw
+
+
+def test_config_state_indexes_match_linear_scans():
+    state = ConfigState(state_config())
+    config = state.config
+    assert [conf.slug for conf in config] == sorted(
+        conf['slug'] for conf in state_config())
+
+    # get_conf_by_slug
+    for conf in config:
+        assert state.get_conf_by_slug(conf.slug) is next(
+            c for c in config if c.slug == conf.slug)
+    assert state.get_conf_by_slug('missing') is None
+
+    # covid
+    for covid in (True, False):
+        assert list(state.covid(covid)) == [
+            conf for conf in config if conf.covid == covid]
+    assert len(state.covid(True)) == len(state.covid(False)) == 5
+
+    # filter_config
+    keywords, lang = set(), set()
+    for conf in config:
+        if not conf.covid:
+            keywords.update(conf.keywords)
+            lang.update(conf.lang)
+    assert state.filter_config.keywords == keywords
+    assert state.filter_config.lang == lang
+
+    # storage_modes
+    assert set(state.storage_modes) == set(StorageMode)
+    for mode in StorageMode:
+        assert list(state.storage_modes[mode]) == [
+            conf for conf in config if conf.storage_mode == mode]
+        assert len(state.storage_modes[mode]) == 2
+
+
+def test_config_state_indexes_are_read_only():
+    state = ConfigState(state_config())
+    with pytest.raises(TypeError):
+        state.slugs['new'] = None
+    with pytest.raises(TypeError):
+        state.storage_modes[StorageMode.S3] = ()
+    assert isinstance(state.filter_config.keywords, frozenset)
@@ -0,0 +1,58 @@
+from streamer.utils.dedup import RotatingBloomFilter
+
+
+def test_rotating_bloom_filter():
+    now = [0.]
+    seen = RotatingBloomFilter(
+        window=10, capacity=1000, error_rate=0.001, clock=lambda: now[0])
+    assert not seen.add(b'1:a')
+    assert not seen.add(b'1:b')
+    assert seen.add(b'1:a')
+
+    # Still remembered from the previous filter, and kept in the new one
+    now[0] = 15
+    assert seen.add(b'1:a')
+    now[0] = 25
+    assert seen.add(b'1:a')
+    # Forgotten after two windows without a hit
+    now[0] = 45
+    assert not seen.add(b'1:b')
+
+
+def test_rotating_bloom_filter_error_rate():
+    seen = RotatingBloomFilter(window=60, capacity=10000, error_rate=0.01)
+    for i in range(10000):
+        seen.add(f'{i}:a'.encode())
+    # Only probe, adding the keys would go beyond the capacity
+    false_positives = sum(
+        seen._contains(seen._current, seen._positions(f'{i}:b'.encode()))
+        for i in range(10000))
+    assert false_positives < 200
+
+
+def test_rotating_bloom_filter_counts_both_filters():
+    now = [0.]
+    seen = RotatingBloomFilter(
+        window=10, capacity=100, error_rate=1e-6, clock=lambda: now[0])
+    for i in range(100):
+        seen.add(f'{i}:a'.encode())
+    now[0] = 15
+    for i in range(100):
+        seen.add(f'{i}:b'.encode())
+    assert seen.keys == 200
+    # Both filters at capacity
+    assert seen.false_positive_rate() < 1e-6
+    for i in range(100):
+        seen.add(f'{i}:c'.encode())
+    assert seen.false_positive_rate() > 1e-6
+
+
+def test_rotating_bloom_filter_forgets_after_idle_gap():
+    now = [0.]
+    seen = RotatingBloomFilter(
+        window=10, capacity=1000, error_rate=0.001, clock=lambda: now[0])
+    assert not seen.add(b'1:a')
+    # Two windows without any key, the previous filter is outdated too
+    now[0] = 25
+    assert not seen.add(b'1:a')
+    assert seen.keys == 1
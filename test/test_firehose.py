@@ -0,0 +1,170 @@
+import asyncio
+import threading
+import time
+
+from awstools.firehose import AsyncBatchProducer, BatchProducer, pack_record
+from awstools.spool import Spool
+
+
+class StubFirehose:
+    """Records the batches it receives, fails the records in ``fail``
+    once.
+    """
+    def __init__(self, fail=()):
+        self.fail = set(fail)
+        self.batches = []
+
+    def put_record_batch(self, DeliveryStreamName, Records):
+        batch = [record['Data'] for record in Records]
+        self.batches.append(batch)
+        results = []
+        for data in batch:
+            if data in self.fail:
+                self.fail.discard(data)
+                results.append({'ErrorCode': 'ServiceUnavailableException'})
+            else:
+                results.append({'RecordId': '0'})
+        return {
+            'FailedPutCount': sum('ErrorCode' in r for r in results),
+            'RequestResponses': results}
+
+
+def test_retries_only_failed_records():
+    client = StubFirehose(fail=[b'2'])
+    producer = BatchProducer(client, max_retries=2)
+
+    assert producer.send('stream', [b'1', b'2', b'3']) == []
+    assert client.batches == [[b'1', b'2', b'3'], [b'2']]
+
+
+def test_splits_by_records_and_bytes():
+    client = StubFirehose()
+    producer = BatchProducer(client)
+    producer.send('stream', [b'x'] * 1200)
+    assert [len(batch) for batch in client.batches] == [500, 500, 200]
+
+    client.batches = []
+    producer.send('stream', [b'x' * 900 * 1024] * 10)
+    assert [len(batch) for batch in client.batches] == [4, 4, 2]
+
+
+def test_flushes_after_interval():
+    client = StubFirehose()
+    producer = BatchProducer(client, interval=0.05)
+    producer.put('stream', b'1')
+    deadline = time.time() + 5
+    while not client.batches and time.time() < deadline:
+        time.sleep(0.01)
+    assert client.batches == [[b'1']]
+    producer.close()
+
+
+def test_quiet_stream_flushes_while_busy_stream_sends():
+    release = threading.Event()
+
+    class BusyFirehose(StubFirehose):
+        def put_record_batch(self, DeliveryStreamName, Records):
+            if DeliveryStreamName == 'busy':
+                release.wait(5)
+            return super().put_record_batch(DeliveryStreamName, Records)
+
+    client = BusyFirehose()
+    producer = BatchProducer(
+        client, max_records=2, interval=0.05, num_senders=2)
+    # A full batch keeps one sender occupied
+    producer.put('busy', b'busy')
+    producer.put('busy', b'busy')
+    for data in [b'1', b'2', b'3']:
+        producer.put('quiet', data)
+        deadline = time.time() + 1
+        while [data] not in client.batches and time.time() < deadline:
+            time.sleep(0.01)
+        assert [data] in client.batches
+    release.set()
+    producer.close()
+
+
+def test_close_sends_everything():
+    client = StubFirehose()
+    producer = BatchProducer(client, max_records=3, interval=60)
+    for i in range(10):
+        producer.put('stream', str(i).encode())
+    senders = list(producer._senders)
+    producer.close()
+
+    assert sorted(data for batch in client.batches for data in batch) == \
+        sorted(str(i).encode() for i in range(10))
+    assert not any(sender.is_alive() for sender in senders)
+    assert not producer._flusher.is_alive()
+
+
+def test_adopt_spool_replays_orphaned_records(tmp_path):
+    spool = Spool(str(tmp_path))
+    spool.append([pack_record('stream', b'1'), pack_record('stream', b'2')])
+    spool.close()
+    client = StubFirehose()
+    producer = BatchProducer(client)
+    producer.adopt_spool(Spool(str(tmp_path)))
+
+    assert producer._adopted[0].replay()
+    assert client.batches == [[b'1', b'2']]
+    assert Spool(str(tmp_path)).segments() == []
+    producer.close()
+
+
+def test_spools_when_saturated(tmp_path):
+    entered = threading.Event()
+    release = threading.Event()
+
+    class BlockingFirehose(StubFirehose):
+        def put_record_batch(self, DeliveryStreamName, Records):
+            entered.set()
+            release.wait(5)
+            return super().put_record_batch(DeliveryStreamName, Records)
+
+    spool = Spool(str(tmp_path))
+    producer = BatchProducer(
+        BlockingFirehose(), max_records=1, num_senders=1, max_pending=1,
+        spool=spool)
+    producer.put('stream', b'1')
+    assert entered.wait(5)
+    # b'2' waits for the busy sender, b'3' finds the producer saturated
+    producer.put('stream', b'2')
+    producer.put('stream', b'3')
+
+    spool.rotate()
+    assert [
+        payload for path in spool.segments()
+        for _, payload in spool.read(path)
+    ] == [pack_record('stream', b'3')]
+    release.set()
+    producer.close()
+
+
+def test_async_producer_replays_records_spooled_when_saturated(tmp_path):
+    release = threading.Event()
+
+    class BlockingFirehose(StubFirehose):
+        def put_record_batch(self, DeliveryStreamName, Records):
+            release.wait(5)
+            return super().put_record_batch(DeliveryStreamName, Records)
+
+    client = BlockingFirehose()
+    producer = BatchProducer(client, max_records=1, spool=Spool(str(tmp_path)))
+    producer.replayer.interval = 0.05
+    sender = AsyncBatchProducer(producer, concurrency=2)
+
+    async def run():
+        for i in range(10):
+            await sender.put('stream', str(i).encode())
+        release.set()
+        await sender.close()
+
+    asyncio.run(run())
+    deadline = time.time() + 5
+    while producer.replayer.replayed < 8 and time.time() < deadline:
+        time.sleep(0.01)
+    assert producer.replayer.replayed == 8
+    assert sorted(data for batch in client.batches for data in batch) == \
+        sorted(str(i).encode() for i in range(10))
+    producer.close()
@@ -0,0 +1,110 @@
+import os
+
+import pytest
+
+from awstools.geo import CachedGeocode, MappedGeocode, build_index
+
+geonames = [
+    ['2658434', 'Switzerland', 'Switzerland', 'Schweiz,Suisse', '47.00016',
+     '8.01427', 'A', 'PCLI', 'CH', '', '00', '', '', '', '8484130'],
+    ['2657896', 'Zürich', 'Zurich', 'Zuerich,Zurigo', '47.36667', '8.55',
+     'P', 'PPLA', 'CH', '', 'ZH', '', '', '', '341730'],
+    ['4197000', 'Georgia', 'Georgia', 'GA', '32.75042', '-83.50018',
+     'A', 'ADM1', 'US', '', 'GA', '', '', '', '10519475'],
+    ['614540', 'Georgia', 'Georgia', 'Sakartvelo', '42.0', '43.5',
+     'A', 'PCLI', 'GE', '', '00', '', '', '', '3731000'],
+    ['5128581', 'New York City', 'New York City', 'New York,NYC',
+     '40.71427', '-74.00597', 'P', 'PPL', 'US', '', 'NY', '', '', '',
+     '8175133'],
+    ['5128638', 'New York', 'New York', '', '43.00035', '-75.4999',
+     'A', 'ADM1', 'US', '', 'NY', '', '', '', '19274244'],
+    ['2658011', 'Winterthur', 'Winterthur', '', '47.5', '8.75',
+     'P', 'PPLA2', 'CH', '', 'ZH', '', '', '', '91908'],
+    ['6255148', 'Europe', 'Europe', '', '48.69096', '9.14062',
+     'L', 'CONT', '', '', '00', '', '', '', '741000000'],
+    ['1', 'Tiny', 'Tiny', '', '47.0', '8.0',
+     'P', 'PPL', 'CH', '', 'ZH', '', '', '', '10'],
+]
+
+
+@pytest.fixture
+def geo_code(tmp_path):
+    path = tmp_path / 'geonames.txt'
+    path.write_text('\n'.join('\t'.join(row) for row in geonames) + '\n')
+    build_index([str(path)], str(tmp_path / 'index'))
+    geo_code = MappedGeocode(str(tmp_path / 'index'))
+    yield geo_code
+    geo_code.close()
+
+
+def names(places):
+    return [(place['name'], place['location_type']) for place in places]
+
+
+def test_mapped_geocode(geo_code):
+    # In order of appearance
+    assert names(geo_code.decode('zurich, SWITZERLAND')) == [
+        ('Zurich', 'city'), ('Switzerland', 'country')]
+    assert names(geo_code.decode('Europe/Zurigo')) == [
+        ('Europe', 'continent'), ('Zurigo', 'city')]
+    # Large cities, then first-level divisions, then countries
+    assert geo_code.decode('New York')[0]['geoname_id'] == '5128581'
+    assert geo_code.decode('Georgia')[0]['country_code'] == 'US'
+    # Longest names first, matched between ASCII word boundaries
+    assert names(geo_code.decode('new york city!')) == [
+        ('New York City', 'city')]
+    assert geo_code.decode('New-York') == []
+    assert geo_code.decode('Winterthurer') == []
+    # Under 30000 inhabitants
+    assert geo_code.decode('Tiny') == []
+    assert geo_code.decode('') == []
+
+    assert geo_code.nearest(47.4, 8.5)['geoname_id'] == '2657896'
+    assert geo_code.nearest(-10., 10.) is None
+
+
+@pytest.mark.skipif(
+    not os.environ.get('ES_GEONAMES_PATH'),
+    reason='needs the geonames dump geocode was built from')
+def test_mapped_geocode_matches_geocode(tmp_path):
+    geocode = pytest.importorskip('geocode.geocode')
+    reference = geocode.Geocode()
+    reference.load()
+    build_index([os.environ['ES_GEONAMES_PATH']], str(tmp_path))
+    geo_code = MappedGeocode(str(tmp_path))
+
+    for location in [
+            'London', 'london, uk', 'New York, NY', 'NYC', 'Georgia',
+            'Zürich, Switzerland', 'Lagos, Nigeria', 'Paris - France',
+            'somewhere over the rainbow', 'Europe', 'Bay Area', '']:
+        assert geo_code.decode(location) == reference.decode(location)
+    geo_code.close()
+
+
+class CountingGeocode:
+    def __init__(self):
+        self.calls = 0
+
+    def decode(self, input_string):
+        self.calls += 1
+        return [{'name': input_string}]
+
+
+def test_cached_geocode():
+    counting = CountingGeocode()
+    geo_code = CachedGeocode(counting, maxsize=2)
+
+    assert geo_code.decode('London') == [{'name': 'London'}]
+    assert geo_code.decode(' london ') == [{'name': 'London'}]
+    # Not the same location for the geocoder
+    assert geo_code.decode('London, UK') == [{'name': 'London, UK'}]
+    assert (counting.calls, geo_code.hits, geo_code.misses) == (2, 1, 2)
+
+    # Callers get copies
+    geo_code.decode('London, UK')[0]['name'] = 'Paris'
+    assert geo_code.decode('London, UK') == [{'name': 'London, UK'}]
+
+    # Evicts the least recently used entry
+    geo_code.decode('Lagos, Nigeria')
+    geo_code.decode('London')
+    assert counting.calls == 4
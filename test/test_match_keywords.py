@@ -0,0 +1,73 @@
+from types import SimpleNamespace
+
+from streamer.utils.match_keywords import (Automaton, KeywordMatcher,
+                                           match_keywords)
+
+config = [
+    SimpleNamespace(
+        keywords=["Simon and Garfunkel", "garfunkel"],
+        lang=["en"],
+        slug="simongarfunkel"),
+    SimpleNamespace(
+        keywords=["flabbergasted"],
+        lang=["en", "de"],
+        slug="flabbergasted"),
+    SimpleNamespace(
+        keywords=["flabbergasted", "astonished"],
+        lang=[],
+        slug="flabberstonished"),
+]
+
+
+def tweet(text, lang="en"):
+    return SimpleNamespace(keyword_matching_text=text, lang=lang)
+
+
+def test_automaton():
+    automaton = Automaton(["he", "she", "his", "hers"])
+
+    assert automaton.find("ushers") == {"he", "she", "hers"}
+    assert automaton.find("") == set()
+    assert automaton.find("this") == {"his"}
+
+
+def test_match_keywords():
+    assert match_keywords(
+        tweet("and then simon met garfunkel"), config
+    ) == {"simongarfunkel": ["simon and garfunkel", "garfunkel"]}
+
+    assert match_keywords(
+        tweet("garfunkel"), config
+    ) == {"simongarfunkel": ["garfunkel"]}
+
+    assert match_keywords(
+        tweet("i was flabbergasted and astonished"), config
+    ) == {
+        "flabbergasted": ["flabbergasted"],
+        "flabberstonished": ["flabbergasted", "astonished"]
+    }
+
+    assert match_keywords(tweet("nothing here"), config) == {}
+
+
+def test_match_keywords_lang():
+    assert match_keywords(
+        tweet("flabbergasted garfunkel", lang="fr"), config
+    ) == {"flabberstonished": ["flabbergasted"]}
+
+    assert match_keywords(
+        tweet("flabbergasted garfunkel", lang="und"), config
+    ) == {
+        "simongarfunkel": ["garfunkel"],
+        "flabbergasted": ["flabbergasted"],
+        "flabberstonished": ["flabbergasted"]
+    }
+
+
+def test_matcher_is_reused():
+    matcher = KeywordMatcher(config)
+
+    assert match_keywords(tweet("astonished"), matcher) == {
+        "flabberstonished": ["astonished"]}
+    assert match_keywords(tweet("astonished"), config) == \
+        match_keywords(tweet("astonished"), config[:])
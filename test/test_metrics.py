@@ -0,0 +1,129 @@
+import threading
+from urllib.error import HTTPError
+from urllib.request import urlopen
+
+import pytest
+
+from awstools.metrics import Registry
+
+
+def test_registry():
+    metrics = Registry()
+    metrics.counter('tweets_matched_total', project='a').inc()
+    metrics.counter('tweets_matched_total', project='a').inc(2)
+    metrics.gauge('queue_depth', func=lambda: 5)
+    histogram = metrics.histogram('latency_seconds', buckets=(.1, 1.))
+    for value in [.05, .5, .5, 2.]:
+        histogram.observe(value)
+
+    assert histogram.quantile(.5) == 1.
+    assert histogram.quantile(1.) == float('inf')
+    assert metrics.render().splitlines() == [
+        '# TYPE latency_seconds histogram',
+        'latency_seconds_bucket{le="0.1"} 1',
+        'latency_seconds_bucket{le="1.0"} 3',
+        'latency_seconds_bucket{le="+Inf"} 4',
+        'latency_seconds_sum 3.05',
+        'latency_seconds_count 4',
+        '# TYPE queue_depth gauge',
+        'queue_depth 5',
+        '# TYPE tweets_matched_total counter',
+        'tweets_matched_total{project="a"} 3',
+    ]
+
+
+def run_threads(target, n=8):
+    threads = [threading.Thread(target=target) for _ in range(n)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def test_counter_from_several_threads():
+    metrics = Registry()
+
+    def count():
+        for _ in range(10000):
+            # Looked up each time, as the callers do
+            metrics.counter('tweets_received_total', version='v1').inc()
+        metrics.counter('tweets_matched_total', project='a').inc(5)
+
+    run_threads(count)
+    assert metrics.counter('tweets_received_total', version='v1').value \
+        == 80000
+    assert metrics.counter('tweets_matched_total', project='a').value == 40
+    assert len(metrics.collect()) == 2
+
+
+def test_gauge_from_several_threads():
+    metrics = Registry()
+    values = iter(range(8))
+    lock = threading.Lock()
+
+    def set_gauge():
+        with lock:
+            value = next(values)
+        for _ in range(1000):
+            metrics.gauge('queue_depth', queue='received').set(value)
+
+    run_threads(set_gauge)
+    assert metrics.gauge('queue_depth', queue='received').value in range(8)
+    assert len(metrics.collect()) == 1
+
+    # A gauge read from a function sees the current value
+    depth = [3]
+    metrics.gauge('queue_depth', func=lambda: depth[0], queue='records')
+    depth[0] = 7
+    assert 'queue_depth{queue="records"} 7' in metrics.render()
+
+
+def test_label_escaping():
+    metrics = Registry()
+    metrics.counter('tweets_matched_total', project='say "hi"').inc()
+    metrics.counter('tweets_matched_total', project='back\\slash').inc()
+    metrics.counter('tweets_matched_total', project='two\nlines').inc()
+
+    assert metrics.render().splitlines()[1:] == [
+        'tweets_matched_total{project="back\\\\slash"} 1',
+        'tweets_matched_total{project="say \\"hi\\""} 1',
+        'tweets_matched_total{project="two\\nlines"} 1',
+    ]
+
+
+def test_http_endpoint():
+    metrics = Registry()
+    metrics.counter('tweets_matched_total', project='a').inc(2)
+    metrics.histogram('match_seconds', buckets=(.1,)).observe(.05)
+    metrics.start_http_server(0, host='127.0.0.1')
+    port = metrics._server.server_address[1]
+    try:
+        with urlopen(f'http://127.0.0.1:{port}/metrics') as response:
+            assert response.status == 200
+            assert response.headers['Content-Type'] == \
+                'text/plain; version=0.0.4'
+            body = response.read().decode('utf-8')
+        assert body == metrics.render()
+        assert body.endswith('\n')
+        assert body.splitlines() == [
+            '# TYPE match_seconds histogram',
+            'match_seconds_bucket{le="0.1"} 1',
+            'match_seconds_bucket{le="+Inf"} 1',
+            'match_seconds_sum 0.05',
+            'match_seconds_count 1',
+            '# TYPE tweets_matched_total counter',
+            'tweets_matched_total{project="a"} 2',
+        ]
+
+        # Served live
+        metrics.counter('tweets_matched_total', project='a').inc()
+        with urlopen(f'http://127.0.0.1:{port}/metrics') as response:
+            assert 'tweets_matched_total{project="a"} 3' in \
+                response.read().decode('utf-8')
+
+        with pytest.raises(HTTPError) as exc_info:
+            urlopen(f'http://127.0.0.1:{port}/other')
+        assert exc_info.value.code == 404
+    finally:
+        metrics._server.shutdown()
+        metrics._server.server_close()
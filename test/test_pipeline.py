@@ -0,0 +1,262 @@
+import queue
+import tempfile
+import threading
+import time
+
+from awstools.config import ConfigManager, ConfigState
+from awstools.metrics import metrics
+from streamer import pipeline as pipeline_module
+from streamer.pipeline import (
+    Pipeline, ProcessPipeline, Spill, adopt_orphaned_spools, get_spill)
+
+
+def append_line(data_raw, shed):
+    # Runs in the worker processes
+    path, line = data_raw.split(b' ', 1)
+    with open(path, 'ab') as f:
+        f.write(line + b'\n')
+
+
+def append_slugs(data_raw, shed):
+    # Runs in the worker processes, with the config they were sent
+    from awstools.config import config_manager
+    with open(data_raw, 'a') as f:
+        f.write(' '.join(sorted(config_manager.slugs)) + '\n')
+
+
+def project(slug):
+    return {
+        'keywords': [slug], 'lang': ['en'], 'locales': ['en'],
+        'slug': slug, 'es_index_name': slug, 'storage_mode': 's3',
+        'image_storage_mode': 'inactive', 'model_endpoints': None,
+        'covid': False, 'auto_mturking': False, 'tweets_per_batch': None}
+
+
+def set_config_manager(monkeypatch, *slugs):
+    manager = ConfigManager(
+        state=ConfigState([project(slug) for slug in slugs]))
+    monkeypatch.setattr(pipeline_module, 'config_manager', manager)
+    return manager
+
+
+def test_process_pipeline(tmp_path, monkeypatch):
+    monkeypatch.setenv('AWS_KF_SPOOL_DIR', '')
+    set_config_manager(monkeypatch)
+    path = str(tmp_path / 'out.txt').encode()
+    pipeline = ProcessPipeline(
+        append_line, num_processes=2, batch_size=3, batch_interval=0.01)
+    for i in range(10):
+        pipeline.put(path + b' ' + str(i).encode())
+    pipeline.join()
+    pipeline.close()
+
+    with open(path, 'rb') as f:
+        lines = f.read().split()
+    assert sorted(int(line) for line in lines) == list(range(10))
+    assert not any(process.is_alive() for process in pipeline._processes)
+
+
+def test_spill_round_trip(tmp_path):
+    spill = Spill(str(tmp_path))
+    spill.write({'id': 1})
+    spill.write({'id': 2})
+    path, = spill.segments()
+    spill.write({'id': 3})
+
+    assert list(spill.read(path)) == [{'id': 1}, {'id': 2}]
+    assert [
+        item for path in spill.segments() for item in spill.read(path)
+    ] == [{'id': 1}, {'id': 2}, {'id': 3}]
+
+
+def test_process_pipeline_sends_prepared_configs(tmp_path, monkeypatch):
+    monkeypatch.setenv('AWS_KF_SPOOL_DIR', '')
+    manager = set_config_manager(monkeypatch, 'a')
+    path = tmp_path / 'slugs.txt'
+    pipeline = ProcessPipeline(append_slugs, num_processes=1, batch_size=1)
+    pipeline.put(str(path))
+    pipeline.join()
+    assert path.read_text().split('\n')[-2] == 'a'
+
+    # Not sent if preparing fails
+    def fail(old, new):
+        raise RuntimeError('Delivery stream not ready.')
+
+    manager.add_preparer(fail)
+    assert not manager.apply(ConfigState([project('a'), project('c')]))
+    manager._preparers.remove(fail)
+    assert manager.apply(ConfigState([project('a'), project('b')]))
+    deadline = time.time() + 5
+    while path.read_text().split('\n')[-2] != 'a b' and \
+            time.time() < deadline:
+        pipeline.put(str(path))
+        pipeline.join()
+    pipeline.close()
+
+    assert 'a b' in path.read_text().split('\n')
+    assert 'a c' not in path.read_text()
+
+
+def test_pipeline_spills_and_replays_in_order(tmp_path):
+    # No workers, the queue is drained by hand
+    spilled = metrics.counter('pipeline_items_total', event='spilled')
+    before = spilled.value
+    pipeline = Pipeline(
+        lambda item, shed: None, num_workers=0, max_size=3,
+        spill=Spill(str(tmp_path)))
+    for i in range(5):
+        pipeline.put(i)
+    assert pipeline.counts['spilled'] == 2
+    assert spilled.value - before == 2
+
+    assert [pipeline.q.get_nowait() for _ in range(3)] == [0, 1, 2]
+    pipeline._replay()
+    assert [pipeline.q.get_nowait() for _ in range(2)] == [3, 4]
+    assert pipeline.counts['replayed'] == 2
+    assert Spill(str(tmp_path)).segments() == []
+
+
+def test_pipeline_sheds_above_threshold(tmp_path):
+    handled = []
+    entered = threading.Event()
+    release = threading.Event()
+
+    def handle(item, shed):
+        handled.append((item, shed))
+        entered.set()
+        release.wait(5)
+        # Item 1 is matched, and handled anyway
+        return shed and item == 2
+
+    pipeline = Pipeline(
+        handle, num_workers=1, max_size=10, shed_threshold=0.5,
+        spill=Spill(str(tmp_path)))
+    pipeline.put(0)
+    assert entered.wait(5)
+    for i in range(1, 8):
+        pipeline.put(i)
+    release.set()
+    pipeline.q.join()
+
+    # Items 1 and 2 were taken with at least 5 items left in the queue
+    assert handled == [(i, i in (1, 2)) for i in range(8)]
+    assert pipeline.counts['shed'] == 1
+
+
+class AdoptingProducer:
+    def __init__(self):
+        self.adopted = []
+
+    def adopt_spool(self, spool):
+        self.adopted.append(spool.directory)
+
+
+def test_adopt_orphaned_spools(tmp_path):
+    for name in ['worker-0', 'worker-1', 'worker-2', 'other']:
+        (tmp_path / name).mkdir()
+    directory = str(tmp_path)
+
+    # Worker processes own worker-0 and worker-1
+    producer = AdoptingProducer()
+    adopt_orphaned_spools(2, directory, producer)
+    assert producer.adopted == [directory, str(tmp_path / 'worker-2')]
+
+    # Worker threads own the top-level spool
+    producer = AdoptingProducer()
+    adopt_orphaned_spools(0, directory, producer)
+    assert producer.adopted == [
+        str(tmp_path / f'worker-{i}') for i in range(3)]
+
+
+def test_process_pipeline_counts_replayed_items(tmp_path):
+    spill = Spill(str(tmp_path), serialize=bytes, deserialize=bytes)
+    pipeline = ProcessPipeline(append_line, batch_size=2, spill=spill)
+    # Not started, the queue is drained by hand
+    pipeline.q = queue.Queue()
+    for i in range(3):
+        spill.write(str(i).encode())
+    pipeline._replay()
+
+    assert [pipeline.q.get_nowait() for _ in range(2)] == [
+        [b'0', b'1'], [b'2']]
+    assert pipeline.counts['replayed'] == 3
+
+
+def test_pipeline_spills_queued_items_on_close(tmp_path):
+    release = threading.Event()
+    spill = Spill(str(tmp_path))
+    pipeline = Pipeline(
+        lambda item, shed: release.wait(5), num_workers=1,
+        drain_timeout=0.2, spill=spill)
+    for i in range(3):
+        pipeline.put(i)
+    pipeline.close()
+    release.set()
+
+    # The worker holds the first item, the others are spilled
+    assert [item for path in spill.segments() for item in spill.read(path)] \
+        == [1, 2]
+    assert pipeline.counts['spilled'] == 2
+
+
+def test_pipeline_drops_queued_items_on_close_without_persistent_spill(
+        tmp_path):
+    release = threading.Event()
+    spill = Spill(str(tmp_path), persistent=False)
+    pipeline = Pipeline(
+        lambda item, shed: release.wait(5), num_workers=1,
+        drain_timeout=0.2, spill=spill)
+    for i in range(3):
+        pipeline.put(i)
+    pipeline.close()
+    release.set()
+
+    assert spill.segments() == []
+    assert pipeline.counts['spilled'] == 0
+
+
+def test_get_spill(tmp_path):
+    assert get_spill(str(tmp_path)).persistent
+    spill = get_spill('')
+    assert not spill.persistent
+    assert spill.directory.startswith(tempfile.gettempdir())
+
+
+def test_process_pipeline_replay_doesnt_block_on_a_full_queue(tmp_path):
+    spill = Spill(str(tmp_path), serialize=bytes, deserialize=bytes)
+    pipeline = ProcessPipeline(append_line, batch_size=2, spill=spill)
+    # No workers take from the queue
+    pipeline.q = queue.Queue(maxsize=1)
+    for i in range(5):
+        spill.write(str(i).encode())
+    pipeline._replay()
+
+    assert pipeline.q.get_nowait() == [b'0', b'1']
+    assert [item for path in spill.segments() for item in spill.read(path)] \
+        == [b'2', b'3', b'4']
+    assert pipeline.counts['replayed'] == 2
+
+
+class StoppedProcess:
+    def join(self, timeout=None):
+        pass
+
+
+def test_process_pipeline_spills_queued_batches_on_close(
+        tmp_path, monkeypatch):
+    set_config_manager(monkeypatch)
+    spill = Spill(str(tmp_path), serialize=bytes, deserialize=bytes)
+    pipeline = ProcessPipeline(
+        append_line, batch_size=2, drain_timeout=0.1, spill=spill)
+    # Workers that stopped taking batches
+    pipeline.q = queue.Queue()
+    pipeline._processes = [StoppedProcess()]
+    pipeline._monitor_thread = threading.Thread(target=lambda: None)
+    pipeline._monitor_thread.start()
+    pipeline.q.put([b'0', b'1'])
+    pipeline._batch = [b'2']
+    pipeline.close()
+
+    assert [item for path in spill.segments() for item in spill.read(path)] \
+        == [b'0', b'1', b'2']
+    assert pipeline.counts['spilled'] == 3
@@ -0,0 +1,55 @@
+import json
+
+from streamer.utils.records import Record, encode_record, scan_response
+
+status = {
+    "id_str": "850006245121695744",
+    "text": "Héllo \"world\" ☃",
+    "user": {"id": 2244994945, "screen_name": "TwitterDev"},
+    "entities": {},
+}
+
+
+def test_encode_record():
+    record = Record(status)
+
+    assert record.encode() == f'{json.dumps(status)}\n'.encode()
+
+    for slug, keywords in [("flabbergasted", ["flabbergasted"]),
+                           ("astonished", ["astonished", "wow"])]:
+        expected = dict(status, project=slug, matching_keywords=keywords)
+        assert record.encode(
+            project=slug, matching_keywords=keywords
+        ) == f'{json.dumps(expected)}\n'.encode()
+
+
+def test_encode_record_empty():
+    assert encode_record(b'{}', project="a") == b'{"project": "a"}\n'
+    assert json.loads(encode_record(b'{"a": {}}', project=None)) == {
+        "a": {}, "project": None}
+
+
+response = (
+    b'{"data":{"id":"1","text":"RT hi","referenced_tweets":'
+    b'[{"type":"retweeted","id":"2"}]},'
+    b'"includes":{"users":[{"id":"3","name":"\\"matching_rules\\":[]"}]},'
+    b'"matching_rules":[{"id":"4","tag":"flabbergasted"}]}\r\n'
+)
+
+
+def test_scan_response():
+    assert scan_response(response) == {
+        "data": {
+            "id": "1", "text": "RT hi",
+            "referenced_tweets": [{"type": "retweeted", "id": "2"}]},
+        "matching_rules": [{"id": "4", "tag": "flabbergasted"}]
+    }
+    assert scan_response(b'{"errors":[{"title":"operational-disconnect"}]}') \
+        is None
+
+
+def test_raw_record():
+    record = Record.from_raw(response)
+
+    assert json.loads(record.encode(project="flabbergasted")) == dict(
+        json.loads(response), project="flabbergasted")
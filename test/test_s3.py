@@ -0,0 +1,118 @@
+import gzip
+import io
+import json
+
+import pytest
+
+from botocore.exceptions import ClientError
+
+from awstools.s3 import S3ConfigCache, iter_s3_jsonl
+
+
+class FakeS3:
+    def __init__(self):
+        self.body = b'{"a": 1}'
+        self.etag = '"1"'
+        self.calls = 0
+        self.error = None
+
+    def get_object(self, Bucket, Key, IfNoneMatch=None, **kwargs):
+        self.calls += 1
+        if self.error is not None:
+            raise self.error
+        if IfNoneMatch == self.etag:
+            raise ClientError(
+                {'Error': {'Code': '304', 'Message': 'Not Modified'}},
+                'GetObject')
+        return {'Body': io.BytesIO(self.body), 'ETag': self.etag}
+
+
+def test_config_cache():
+    s3 = FakeS3()
+    cache = S3ConfigCache(ttl=0, s3_client=s3)
+
+    cache.begin()
+    assert cache.get('bucket', 'key') == {'a': 1}
+    assert cache.get('bucket', 'key') == {'a': 1}
+    assert s3.calls == 1
+
+    # Revalidated in the next invocation
+    cache.begin()
+    assert cache.get('bucket', 'key') == {'a': 1}
+    assert s3.calls == 2
+
+    s3.body, s3.etag = b'{"a": 2}', '"2"'
+    cache.begin()
+    assert cache.get('bucket', 'key') == {'a': 2}
+    assert s3.calls == 3
+
+
+def test_config_cache_serves_stale_value_on_error():
+    s3 = FakeS3()
+    cache = S3ConfigCache(ttl=0, s3_client=s3)
+    s3.error = ClientError(
+        {'Error': {'Code': 'InternalError', 'Message': ''}}, 'GetObject')
+
+    cache.begin()
+    with pytest.raises(ClientError):
+        cache.get('bucket', 'key')
+
+    s3.error = None
+    assert cache.get('bucket', 'key') == {'a': 1}
+
+    s3.error = ClientError(
+        {'Error': {'Code': 'InternalError', 'Message': ''}}, 'GetObject')
+    cache.begin()
+    assert cache.get('bucket', 'key') == {'a': 1}
+
+    # Revalidated once S3 is back
+    s3.error = None
+    s3.body, s3.etag = b'{"a": 2}', '"2"'
+    assert cache.get('bucket', 'key') == {'a': 2}
+
+
+class FakeBody:
+    def __init__(self, data):
+        self.data = data
+
+    def iter_chunks(self, chunk_size):
+        for i in range(0, len(self.data), chunk_size):
+            yield self.data[i:i + chunk_size]
+
+
+class FakeObjectS3:
+    def __init__(self, data):
+        self.data = data
+
+    def get_object(self, Bucket, Key):
+        return {'Body': FakeBody(self.data)}
+
+
+def jsonl(records):
+    return b''.join(json.dumps(record).encode() + b'\n' for record in records)
+
+
+def test_iter_s3_jsonl_chunks():
+    records = [{'id': i, 'text': 'x' * i} for i in range(5)]
+    # Reads of 7 bytes split most lines
+    chunks = list(iter_s3_jsonl(
+        'bucket', 'key', chunk_size=2, s3_client=FakeObjectS3(jsonl(records)),
+        read_size=7))
+    assert chunks == [records[:2], records[2:4], records[4:]]
+
+
+def test_iter_s3_jsonl_gzip_members_and_trailing_line():
+    records = [{'id': i} for i in range(4)]
+    # Firehose concatenates gzip members, the last line has no newline
+    data = gzip.compress(jsonl(records[:2])) + gzip.compress(
+        jsonl(records[2:]).rstrip(b'\n'))
+    chunks = list(iter_s3_jsonl(
+        'bucket', 'key', s3_client=FakeObjectS3(data), read_size=5))
+    assert chunks == [records]
+
+
+def test_iter_s3_jsonl_skips_malformed_lines():
+    data = b'{"id": 0}\n{"id": 1\n\n{"id": 2}'
+    chunks = list(iter_s3_jsonl(
+        'bucket', 'key', s3_client=FakeObjectS3(data)))
+    assert chunks == [[{'id': 0}, {'id': 2}]]
@@ -0,0 +1,216 @@
+import io
+import json
+import threading
+import time
+
+import pytest
+from botocore.exceptions import ClientError
+
+from awstools import s3_to_es
+from awstools.env import SMEnv
+
+
+def client_error(code, status_code, message=''):
+    return ClientError({
+        'Error': {'Code': code, 'Message': message},
+        'ResponseMetadata': {'HTTPStatusCode': status_code}
+    }, 'InvokeEndpoint')
+
+
+class StubSageMaker:
+    """Predicts each text as its own label, after raising ``errors`` one
+    call at a time. Batches above ``max_batch`` texts are too large.
+    """
+    def __init__(self, errors=(), max_batch=None):
+        self.errors = list(errors)
+        self.max_batch = max_batch
+        self.batches = []
+
+    def invoke_endpoint(self, EndpointName, Body, ContentType):
+        batch = json.loads(Body)['text']
+        self.batches.append(batch)
+        if self.max_batch is not None and len(batch) > self.max_batch:
+            raise client_error('RequestEntityTooLarge', 413)
+        if self.errors:
+            raise self.errors.pop(0)
+        return {'Body': io.BytesIO(json.dumps({'predictions': [
+            {'labels': [text], 'probabilities': [1.]} for text in batch
+        ]}).encode())}
+
+
+@pytest.fixture
+def stub_sagemaker(monkeypatch):
+    def install(**kwargs):
+        stub = StubSageMaker(**kwargs)
+        monkeypatch.setattr(s3_to_es, 'sagemaker', stub)
+        return stub
+
+    monkeypatch.setattr(s3_to_es.time, 'sleep', lambda seconds: None)
+    return install
+
+
+def test_load_to_es_counts_conflicts_and_errors(monkeypatch):
+    actions = []
+
+    def streaming_bulk(client, action_iter, **kwargs):
+        assert kwargs['raise_on_error'] is False
+        for action in action_iter:
+            actions.append(action)
+            _id = action['_id']
+            if _id == '2':
+                yield False, {'create': {
+                    '_id': _id, 'status': 409,
+                    'error': {'type': 'version_conflict_engine_exception'}}}
+            elif _id == '3':
+                yield False, {'create': {
+                    '_id': _id, 'status': 400,
+                    'error': {'type': 'mapper_parsing_exception'}}}
+            else:
+                yield True, {'create': {'_id': _id, 'status': 201}}
+
+    monkeypatch.setattr(
+        'elasticsearch.helpers.streaming_bulk', streaming_bulk)
+    statuses_es = [{'id': str(i), 'text': f'tweet {i}'} for i in range(5)]
+
+    assert s3_to_es.load_to_es(statuses_es, 'project') == (3, 1, 1)
+    assert [action['_op_type'] for action in actions] == ['create'] * 5
+    assert actions[0] == {
+        '_op_type': 'create', '_index': 'project', '_id': '0',
+        '_source': {'text': 'tweet 0'}}
+
+
+def test_predictions_are_per_document():
+    labels = ['positive', 'negative']
+    predictions = s3_to_es.Predictions(3)
+    predictions.add('sentiment', 'run_a', [
+        {'labels': labels, 'label_vals': [1, -1],
+         'probabilities': [0.9, 0.1]},
+        {'labels': labels, 'label_vals': [1, -1],
+         'probabilities': [0.2, 0.8]},
+        None
+    ], primary=True)
+
+    first, second, third = [predictions.document(i) for i in range(3)]
+    positive = {'probability': 0.9, 'label': 'positive', 'label_val': 1}
+    negative = {'probability': 0.8, 'label': 'negative', 'label_val': -1}
+    assert first == {'sentiment': {'endpoints': {
+        'run_a': positive, 'primary': positive}}}
+    assert second == {'sentiment': {'endpoints': {
+        'run_a': negative, 'primary': negative}}}
+    assert third == {'sentiment': {'endpoints': {
+        'run_a': s3_to_es.PREDICTION_MISSING}}}
+
+    # No dict is shared between documents
+    first['sentiment']['endpoints']['run_a']['label'] = 'changed'
+    third['sentiment']['endpoints']['run_a']['changed'] = True
+    assert predictions.document(0) == {'sentiment': {'endpoints': {
+        'run_a': positive, 'primary': positive}}}
+    assert predictions.document(1) == second
+    assert s3_to_es.PREDICTION_MISSING == {'missing': True}
+
+
+def test_invoke_endpoint_retries_transient_errors(stub_sagemaker):
+    sagemaker = stub_sagemaker(
+        errors=[client_error('ThrottlingException', 400)])
+
+    assert s3_to_es.invoke_endpoint('endpoint', ['a', 'b']) == [
+        {'labels': ['a'], 'probabilities': [1.]},
+        {'labels': ['b'], 'probabilities': [1.]}]
+    assert sagemaker.batches == [['a', 'b'], ['a', 'b']]
+
+
+def test_invoke_endpoint_splits_too_large_batches(stub_sagemaker):
+    sagemaker = stub_sagemaker(max_batch=1)
+
+    outputs = s3_to_es.invoke_endpoint('endpoint', ['a', 'b', 'c'])
+    assert [output['labels'] for output in outputs] == [['a'], ['b'], ['c']]
+    assert sagemaker.batches == [
+        ['a', 'b', 'c'], ['a'], ['b', 'c'], ['b'], ['c']]
+
+
+def test_invoke_endpoint_gives_up_on_permanent_errors(stub_sagemaker):
+    # A size in the message alone doesn't make the batch too large
+    sagemaker = stub_sagemaker(errors=[
+        client_error('ValidationError', 400, 'Invalid input size')])
+
+    outputs = s3_to_es.invoke_endpoint('endpoint', ['a', 'b'])
+    assert outputs == [None, None]
+    assert sagemaker.batches == [['a', 'b']]
+
+    predictions = s3_to_es.Predictions(2)
+    predictions.add('sentiment', 'run_a', outputs)
+    assert predictions.document(0) == {'sentiment': {'endpoints': {
+        'run_a': s3_to_es.PREDICTION_MISSING}}}
+
+
+class SlowSageMaker(StubSageMaker):
+    """Answers later batches first and records the requests in flight
+    per endpoint.
+    """
+    def __init__(self):
+        super().__init__()
+        self.in_flight = {}
+        self.max_in_flight = {}
+        self._lock = threading.Lock()
+
+    def invoke_endpoint(self, EndpointName, Body, ContentType):
+        with self._lock:
+            self.in_flight[EndpointName] = \
+                self.in_flight.get(EndpointName, 0) + 1
+            self.max_in_flight[EndpointName] = max(
+                self.max_in_flight.get(EndpointName, 0),
+                self.in_flight[EndpointName])
+        time.sleep(0.1 - int(json.loads(Body)['text'][0]) * 0.005)
+        with self._lock:
+            self.in_flight[EndpointName] -= 1
+        return super().invoke_endpoint(EndpointName, Body, ContentType)
+
+
+def test_predict_all_keeps_order_and_endpoint_concurrency(monkeypatch):
+    sagemaker = SlowSageMaker()
+    monkeypatch.setattr(s3_to_es, 'sagemaker', sagemaker)
+    texts = [str(i) for i in range(16)]
+    # No standardization, so that the texts come back as labels
+    config = {'standardize_func_name': None}
+
+    results = s3_to_es.predict_all(
+        [('endpoint_a', config, 1), ('endpoint_b', config, 2)], texts)
+    for outputs in results:
+        assert [output['labels'] for output in outputs] == [
+            [text] for text in texts]
+        # Labels are numbers, so label values are added
+        assert [output['label_vals'] for output in outputs] == [
+            [int(text)] for text in texts]
+    assert sagemaker.max_in_flight == {
+        'endpoint_a': SMEnv.ENDPOINT_CONCURRENCY,
+        'endpoint_b': SMEnv.ENDPOINT_CONCURRENCY}
+
+
+def test_predict_all_preprocesses_once_per_config(monkeypatch):
+    monkeypatch.setattr(s3_to_es, 'sagemaker', StubSageMaker())
+    monkeypatch.setattr(
+        s3_to_es, 'get_standardize_func', lambda name: getattr(str, name))
+    calls = []
+    preprocess = s3_to_es.preprocess
+
+    def counting_preprocess(preprocessing_config, texts):
+        calls.append(preprocessing_config)
+        return preprocess(preprocessing_config, texts)
+
+    monkeypatch.setattr(s3_to_es, 'preprocess', counting_preprocess)
+    upper = {'standardize_func_name': 'upper'}
+    jobs = [
+        ('endpoint_a', upper, 1),
+        ('endpoint_b', {'standardize_func_name': 'lower'}, 1),
+        # Same config as endpoint_a, in a separate dict
+        ('endpoint_c', dict(upper), 2)]
+
+    results = s3_to_es.predict_all(jobs, ['a', 'B'])
+    assert calls == [upper, {'standardize_func_name': 'lower'}]
+    assert [[output['labels'] for output in outputs] for outputs in results] \
+        == [[['A'], ['B']], [['a'], ['b']], [['A'], ['B']]]
+    # The configs are left untouched
+    assert [job[1] for job in jobs] == [
+        {'standardize_func_name': 'upper'},
+        {'standardize_func_name': 'lower'},
+        {'standardize_func_name': 'upper'}]
@@ -0,0 +1,68 @@
+import os
+
+from awstools.spool import Replayer, Spool
+
+
+def test_spool_round_trip(tmp_path):
+    spool = Spool(str(tmp_path), segment_bytes=64)
+    spool.append([b'a' * 20, b'b' * 20, b'c' * 20, b''])
+    spool.rotate()
+
+    segments = spool.segments()
+    assert len(segments) == 2
+    assert [
+        payload for path in segments for _, payload in spool.read(path)
+    ] == [b'a' * 20, b'b' * 20, b'c' * 20, b'']
+
+
+def test_spool_stops_at_truncated_record(tmp_path):
+    spool = Spool(str(tmp_path), use_mmap=True)
+    spool.append([b'first', b'second'])
+    spool.rotate()
+    path, = spool.segments()
+    with open(path, 'r+b') as f:
+        f.truncate(os.path.getsize(path) - 1)
+
+    assert [payload for _, payload in spool.read(path)] == [b'first']
+
+
+def test_replayer(tmp_path):
+    spool = Spool(str(tmp_path))
+    spool.append([b'1', b'2', b'3'])
+    received = []
+
+    def sink(payloads):
+        received.extend(payloads)
+        # Refuses the first attempt at b'3'
+        if b'3' in payloads and received.count(b'3') == 1:
+            return [b'3']
+        return []
+
+    replayer = Replayer(spool, sink, batch_size=2)
+    # The refused record goes back to the spool
+    assert not replayer.replay()
+    assert replayer.replay()
+    assert received == [b'1', b'2', b'3', b'3']
+    assert spool.segments() == [] and not spool.pending
+
+
+def test_replayer_quarantines_corrupt_segment(tmp_path):
+    spool = Spool(str(tmp_path))
+    spool.append([b'first', b'second', b'third'])
+    spool.rotate()
+    path, = spool.segments()
+    size = os.path.getsize(path)
+    with open(path, 'r+b') as f:
+        # Flip a byte of the second payload
+        f.seek(2 * 8 + len(b'first') + 1)
+        f.write(b'X')
+    received = []
+
+    replayer = Replayer(spool, lambda payloads: received.extend(payloads))
+    assert replayer.replay()
+    assert received == [b'first']
+    # The records after the corrupt one are kept, but not replayed again
+    assert spool.segments() == []
+    corrupt, = os.listdir(tmp_path)
+    assert corrupt.endswith('.corrupt')
+    assert os.path.getsize(tmp_path / corrupt) == size
@@ -0,0 +1,69 @@
+import json
+
+from streamer import stream
+from streamer.stream import Stream, handle_raw
+
+
+class FakePipeline:
+    def __init__(self):
+        self.items = []
+
+    def put(self, item):
+        self.items.append(item)
+
+
+def make_stream(monkeypatch):
+    s = Stream('', '', '', '')
+    s.pipeline = FakePipeline()
+    calls = []
+    for name in ('on_delete', 'on_limit', 'on_warning'):
+        monkeypatch.setattr(
+            s, name, lambda *args, name=name: calls.append((name, args)))
+    return s, calls
+
+
+def test_on_data_queues_raw_tweet_bytes(monkeypatch):
+    s, calls = make_stream(monkeypatch)
+    line = b'{"created_at": "Mon Jan 01 00:00:00 +0000 2024", "id": 1}'
+
+    s.on_data(line)
+    s.on_data(line.decode())
+
+    assert s.pipeline.items == [line, line]
+    assert calls == []
+
+
+def test_on_data_leaves_control_messages_to_tweepy(monkeypatch):
+    s, calls = make_stream(monkeypatch)
+
+    s.on_data(b'{"delete": {"status": {"id": 1, "user_id": 2}}}')
+    s.on_data(b'{"limit": {"track": 5}}')
+    s.on_data(b'{"warning": {"code": "FALLING_BEHIND", "message": ""}}')
+
+    assert s.pipeline.items == []
+    assert [name for name, _ in calls] == [
+        'on_delete', 'on_limit', 'on_warning']
+
+
+def test_on_data_reencodes_tweets_in_another_key_order(monkeypatch):
+    s, _ = make_stream(monkeypatch)
+    status = {'id': 1, 'in_reply_to_status_id': None, 'text': 'hello'}
+
+    s.on_data(json.dumps(status).encode())
+
+    assert [json.loads(item) for item in s.pipeline.items] == [status]
+
+
+def test_handle_raw_parses_and_handles_tweet(monkeypatch):
+    handled = []
+    monkeypatch.setattr(
+        stream, 'handle_tweet',
+        lambda status, config_manager, store_unmatched:
+            handled.append((status, store_unmatched)) or not store_unmatched)
+
+    assert not handle_raw(b'{"created_at": "", "id": 1}', shed=False)
+    assert handle_raw(b'{"created_at": "", "id": 2}', shed=True)
+
+    assert handled == [
+        ({'created_at': '', 'id': 1}, True),
+        ({'created_at': '', 'id': 2}, False)]
@@ -0,0 +1,166 @@
+import asyncio
+import itertools
+import json
+from types import SimpleNamespace
+
+from tweepy import StreamRule
+
+from awstools.config import ConfigState
+from streamer import stream_v2
+from streamer.stream_v2 import AsyncStream, create_rule, sync_rules
+from streamer.tasks_v2 import rule_slugs
+
+
+def conf(slug, keywords):
+    return SimpleNamespace(keywords=keywords, lang=['en'], slug=slug)
+
+
+class FakeClient:
+    def __init__(self, rules):
+        self.rules = {
+            str(i): StreamRule(rule.value, rule.tag, str(i))
+            for i, rule in enumerate(rules)}
+        self.added = []
+        self.deleted = []
+
+    def get_rules(self):
+        return SimpleNamespace(data=list(self.rules.values()) or None)
+
+    def add_rules(self, rules):
+        self.added.extend(rules)
+        for rule in rules:
+            rule_id = str(len(self.rules) + len(self.deleted))
+            self.rules[rule_id] = StreamRule(rule.value, rule.tag, rule_id)
+
+    def delete_rules(self, ids):
+        self.deleted.extend(ids)
+        for rule_id in ids:
+            del self.rules[rule_id]
+
+
+def test_sync_rules_unchanged():
+    config = [conf('a', ['apple']), conf('b', ['banana'])]
+    client = FakeClient(map(create_rule, config))
+    sync_rules(client, config)
+    assert client.added == [] and client.deleted == []
+
+
+def test_sync_rules_add_and_delete():
+    client = FakeClient(map(create_rule, [
+        conf('a', ['apple']), conf('b', ['banana'])]))
+    sync_rules(client, [
+        conf('a', ['apple']), conf('b', ['banana', 'plantain']),
+        conf('c', ['cherry'])])
+
+    assert client.deleted == ['1']
+    assert sorted(rule.tag for rule in client.added) == ['b', 'c']
+    assert sorted(
+        (rule.tag, rule.value) for rule in client.rules.values()) == [
+        ('a', '(apple) lang:en'), ('b', '(banana OR plantain) lang:en'),
+        ('c', '(cherry) lang:en')]
+
+
+def test_sync_rules_delete_all():
+    client = FakeClient(map(create_rule, [conf('a', ['apple'])]))
+    sync_rules(client, [])
+    assert client.deleted == ['0'] and client.added == []
+
+
+class FakeSender:
+    def __init__(self, block=False):
+        self.block = block
+        self.records = []
+        self.closed = False
+
+    async def put(self, stream_name, data):
+        if self.block:
+            await asyncio.Event().wait()
+        self.records.append((stream_name, data))
+
+    async def close(self):
+        self.closed = True
+
+
+tweet_ids = itertools.count()
+
+
+def response():
+    return json.dumps({
+        'data': {'id': str(next(tweet_ids)), 'text': 'apple'},
+        'matching_rules': [{'id': '1', 'tag': 'a'}]}).encode()
+
+
+def async_stream(monkeypatch, sender, feed, wait_forever=False):
+    monkeypatch.setattr(
+        stream_v2, 'config_manager', SimpleNamespace(state=ConfigState([{
+            'keywords': ['apple'], 'lang': ['en'], 'locales': ['en'],
+            'slug': 'a', 'es_index_name': 'a', 'storage_mode': 's3',
+            'image_storage_mode': 'inactive', 'model_endpoints': None,
+            'covid': False, 'auto_mturking': False,
+            'tweets_per_batch': None}])))
+    stream = AsyncStream('token', sender=sender, drain_timeout=0.5)
+
+    async def fake_filter(**params):
+        for _ in range(feed):
+            await stream.on_data(response())
+        if wait_forever:
+            await asyncio.Event().wait()
+
+    stream.filter = fake_filter
+    return stream
+
+
+def test_async_stream_drains_on_stop(monkeypatch):
+    sender = FakeSender()
+    stream = async_stream(monkeypatch, sender, feed=3)
+    asyncio.run(asyncio.wait_for(stream.run(), 5))
+
+    assert len(sender.records) == 3
+    assert sender.closed
+
+
+def test_async_stream_drain_timeout(monkeypatch):
+    sender = FakeSender(block=True)
+    stream = async_stream(monkeypatch, sender, feed=3)
+    # Returns after the drain timeout instead of hanging
+    asyncio.run(asyncio.wait_for(stream.run(), 5))
+    assert sender.closed
+
+
+def test_async_stream_cancelled_with_its_tasks(monkeypatch):
+    # Records stay queued, they can't drain once the tasks are cancelled
+    sender = FakeSender(block=True)
+    stream = async_stream(monkeypatch, sender, feed=3, wait_forever=True)
+
+    async def main():
+        run = asyncio.ensure_future(stream.run())
+        await asyncio.sleep(0.1)
+        # Like asyncio.run on Ctrl-C: everything is cancelled at once
+        for task in asyncio.all_tasks():
+            if task is not asyncio.current_task():
+                task.cancel()
+        await asyncio.wait([run], timeout=5)
+        return run
+
+    run = asyncio.run(main())
+    assert run.done()
+    assert stream.records.qsize() > 0
+    assert sender.closed
+
+
+def test_sync_rules_keeps_rules_of_other_prefixes():
+    client = FakeClient([
+        create_rule(conf('a', ['apple']), 'prod:'),
+        create_rule(conf('a', ['apple']), 'staging:'),
+        create_rule(conf('b', ['banana']), 'staging:')])
+    sync_rules(client, [conf('a', ['apple'])], 'staging:')
+
+    assert client.deleted == ['2'] and client.added == []
+    assert sorted(rule.tag for rule in client.rules.values()) == [
+        'prod:a', 'staging:a']
+
+
+def test_rule_slugs_strips_the_prefix():
+    assert rule_slugs([
+        {'id': '1', 'tag': 'staging:a'}, {'id': '2', 'tag': 'prod:b'},
+        {'id': '3', 'tag': 'staging:c'}], 'staging:') == ['a', 'c']